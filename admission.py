@@ -0,0 +1,275 @@
+import os
+import time
+import heapq
+import asyncio
+import threading
+from collections import Counter, deque
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Admission control settings
+ADMISSION_MAX_CONCURRENT = int(os.getenv('ADMISSION_MAX_CONCURRENT', '4'))  # Ollama calls in flight per backend
+ADMISSION_INTERACTIVE_RESERVED = int(os.getenv('ADMISSION_INTERACTIVE_RESERVED', '1'))  # slots bulk work cannot use
+ADMISSION_PER_USER = int(os.getenv('ADMISSION_PER_USER', '2'))  # running + queued chats per user
+ADMISSION_RATE = float(os.getenv('ADMISSION_RATE', '10'))  # calls per second (0 = unlimited)
+ADMISSION_BURST = int(os.getenv('ADMISSION_BURST', '20'))
+ADMISSION_MAX_QUEUE = int(os.getenv('ADMISSION_MAX_QUEUE', '32'))  # waiting interactive requests before rejecting
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv('ADMISSION_QUEUE_TIMEOUT', '15'))  # seconds an interactive request waits
+ADMISSION_MAX_HOLD = float(os.getenv('ADMISSION_MAX_HOLD', '600'))  # slots held longer are reclaimed
+
+# Priorities: lower runs first
+INTERACTIVE = 0
+BULK = 1
+
+class AdmissionRejected(Exception):
+    """Raised when a request cannot be admitted; carries what the client should be told"""
+
+    def __init__(self, reason, queue_position=None, retry_after=1.0):
+        super().__init__(reason)
+        self.reason = reason
+        self.queue_position = queue_position
+        self.retry_after = retry_after
+
+class TokenBucket:
+    """Global rate limit: rate tokens per second, up to burst saved up (caller holds the lock)"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+
+    def wait_time(self):
+        """Seconds until a token is available (0 if one is available now)"""
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        if self.rate > 0:
+            self.tokens -= 1
+
+class Ticket:
+    """One request's place in the admission queue, then its slot"""
+
+    def __init__(self, user_id, priority, seq):
+        self.user_id = user_id
+        self.priority = priority
+        self.seq = seq
+        self.queued_at = time.monotonic()
+        self.granted_at = None
+        self.released = False
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+class AdmissionController:
+    """Limit and order the calls that reach Ollama.
+
+    At most max_concurrent calls per routable Ollama backend run at once
+    (backends is the BackendPool; without one the limit is max_concurrent),
+    so adding servers raises the cap and losing one lowers it. Bulk work (document
+    analysis) can never take the slots reserved for interactive chat. Each
+    user may have per_user interactive requests running or queued, and a
+    token bucket caps the overall call rate. Waiting requests are served
+    interactive first, then in arrival order. When max_queue interactive
+    requests are already waiting, or one has waited queue_timeout, it is
+    rejected right away with its queue position instead of piling up behind
+    Ollama's own timeout. Bulk work always queues: it has no deadline and
+    is bounded by the analysis workers that submit it.
+    """
+
+    def __init__(self, max_concurrent=ADMISSION_MAX_CONCURRENT, interactive_reserved=ADMISSION_INTERACTIVE_RESERVED,
+                 per_user=ADMISSION_PER_USER, rate=ADMISSION_RATE, burst=ADMISSION_BURST,
+                 max_queue=ADMISSION_MAX_QUEUE, queue_timeout=ADMISSION_QUEUE_TIMEOUT, max_hold=ADMISSION_MAX_HOLD,
+                 backends=None):
+        self.per_backend = max(1, max_concurrent)
+        self.interactive_reserved = interactive_reserved
+        self.backends = backends
+        self.per_user = per_user
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.max_hold = max_hold
+        self.bucket = TokenBucket(rate, burst)
+
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.waiting = []  # heap of tickets
+        self.running = {}  # ticket -> None, in grant order
+        self.running_by_priority = Counter()
+        self.per_user_counts = Counter()
+        self.seq = 0
+
+        self.admitted = 0
+        self.rejected = Counter()
+        self.reclaimed = 0
+        self.recent_waits = deque(maxlen=200)
+
+    @property
+    def max_concurrent(self):
+        # With every backend down, still admit one backend's worth so calls fail fast to the fallback
+        count = self.backends.routable_count() if self.backends is not None else 1
+        return self.per_backend * max(1, count)
+
+    @property
+    def bulk_limit(self):
+        return max(1, self.max_concurrent - self.interactive_reserved)
+
+    # --- queue bookkeeping (caller holds the lock) ---
+
+    def _enqueue(self, user_id, priority):
+        if user_id is not None and self.per_user_counts[user_id] >= self.per_user:
+            self.rejected['user_limit'] += 1
+            raise AdmissionRejected('user_limit', retry_after=2.0)
+        if priority == INTERACTIVE:
+            queued = sum(1 for other in self.waiting if other.priority == INTERACTIVE)
+            if queued >= self.max_queue:
+                self.rejected['queue_full'] += 1
+                raise AdmissionRejected('queue_full', queue_position=queued + 1, retry_after=5.0)
+
+        self.seq += 1
+        ticket = Ticket(user_id, priority, self.seq)
+        heapq.heappush(self.waiting, ticket)
+        if user_id is not None:
+            self.per_user_counts[user_id] += 1
+        return ticket
+
+    def _reclaim_stale(self):
+        """Free slots whose holder never released them (e.g. a stream that was never started)"""
+        now = time.monotonic()
+        for ticket in list(self.running):
+            if now - ticket.granted_at > self.max_hold:
+                print(f"⚠️ Reclaiming admission slot held for {now - ticket.granted_at:.0f}s")
+                self.reclaimed += 1
+                self._release(ticket)
+
+    def _try_grant(self, ticket):
+        """Grant the slot if ticket is first in line and capacity allows; else return seconds to wait"""
+        self._reclaim_stale()
+        if self.waiting[0] is not ticket:
+            return None
+        if len(self.running) >= self.max_concurrent:
+            return None
+        if ticket.priority == BULK and self.running_by_priority[BULK] >= self.bulk_limit:
+            return None
+        wait = self.bucket.wait_time()
+        if wait > 0:
+            return wait
+
+        self.bucket.take()
+        heapq.heappop(self.waiting)
+        ticket.granted_at = time.monotonic()
+        self.running[ticket] = None
+        self.running_by_priority[ticket.priority] += 1
+        self.admitted += 1
+        self.recent_waits.append(ticket.granted_at - ticket.queued_at)
+        # The next ticket may be able to go too (e.g. a free slot and bucket tokens)
+        self.changed.notify_all()
+        return 0
+
+    def _position(self, ticket):
+        return 1 + sum(1 for other in self.waiting if other < ticket)
+
+    def _abandon(self, ticket, reason):
+        position = self._position(ticket)
+        self.waiting.remove(ticket)
+        heapq.heapify(self.waiting)
+        if ticket.user_id is not None:
+            self.per_user_counts[ticket.user_id] -= 1
+        self.rejected[reason] += 1
+        self.changed.notify_all()
+        return AdmissionRejected(reason, queue_position=position, retry_after=max(1.0, self.queue_timeout / 2))
+
+    def _release(self, ticket):
+        if ticket.released:
+            return
+        ticket.released = True
+        self.running.pop(ticket, None)
+        self.running_by_priority[ticket.priority] -= 1
+        if ticket.user_id is not None:
+            self.per_user_counts[ticket.user_id] -= 1
+        self.changed.notify_all()
+
+    # --- public API ---
+
+    def acquire(self, user_id=None, priority=INTERACTIVE, timeout=None):
+        """Wait for a slot and return its ticket; raises AdmissionRejected.
+
+        timeout defaults to queue_timeout for interactive requests and to no
+        limit for bulk work, which runs in background jobs.
+        """
+        if timeout is None and priority == INTERACTIVE:
+            timeout = self.queue_timeout
+        deadline = time.monotonic() + timeout if timeout is not None else None
+
+        with self.lock:
+            ticket = self._enqueue(user_id, priority)
+            while True:
+                wait = self._try_grant(ticket)
+                if wait == 0:
+                    return ticket
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    raise self._abandon(ticket, 'timeout')
+                # Wake up for a release, or when the bucket refills
+                self.changed.wait(timeout=min(filter(None, (wait, remaining, 1.0))))
+
+    async def acquire_async(self, user_id=None, priority=INTERACTIVE, timeout=None, poll_interval=0.05):
+        """asyncio version of acquire; polls instead of holding a thread while queued"""
+        if timeout is None and priority == INTERACTIVE:
+            timeout = self.queue_timeout
+        deadline = time.monotonic() + timeout if timeout is not None else None
+
+        with self.lock:
+            ticket = self._enqueue(user_id, priority)
+        try:
+            while True:
+                with self.lock:
+                    wait = self._try_grant(ticket)
+                    if wait == 0:
+                        return ticket
+                    if deadline is not None and time.monotonic() >= deadline:
+                        raise self._abandon(ticket, 'timeout')
+                await asyncio.sleep(max(poll_interval, min(wait or 0, 1.0)))
+        except asyncio.CancelledError:
+            with self.lock:
+                if ticket.granted_at is None:
+                    self._abandon(ticket, 'cancelled')
+            raise
+
+    def release(self, ticket):
+        """Give a slot back; safe to call more than once"""
+        with self.lock:
+            self._release(ticket)
+
+    @contextmanager
+    def slot(self, user_id=None, priority=INTERACTIVE, timeout=None):
+        ticket = self.acquire(user_id, priority, timeout)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    def stats(self):
+        """Current load, queue and rejection counts"""
+        with self.lock:
+            waits = list(self.recent_waits)
+            return {
+                "running": len(self.running),
+                "running_bulk": self.running_by_priority[BULK],
+                "max_concurrent": self.max_concurrent,
+                "per_backend": self.per_backend,
+                "bulk_limit": self.bulk_limit,
+                "queued_interactive": sum(1 for ticket in self.waiting if ticket.priority == INTERACTIVE),
+                "queued_bulk": sum(1 for ticket in self.waiting if ticket.priority == BULK),
+                "admitted": self.admitted,
+                "rejected": dict(self.rejected),
+                "reclaimed": self.reclaimed,
+                "avg_wait_ms": round(sum(waits) / len(waits) * 1000) if waits else None
+            }
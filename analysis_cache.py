@@ -0,0 +1,181 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Cache configuration
+ANALYSIS_CACHE_DIR = os.getenv('ANALYSIS_CACHE_DIR', 'analysis_cache')
+ANALYSIS_CACHE_MAX_ENTRIES = int(os.getenv('ANALYSIS_CACHE_MAX_ENTRIES', '200'))
+ANALYSIS_CACHE_MAX_BYTES = int(os.getenv('ANALYSIS_CACHE_MAX_BYTES', str(256 * 1024 * 1024)))
+ANALYSIS_CACHE_MAX_AGE = int(os.getenv('ANALYSIS_CACHE_MAX_AGE', str(7 * 24 * 3600)))  # seconds
+
+def hash_file(file_path, block_size=1024 * 1024):
+    """Return the SHA-256 hex digest of a file's contents"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+class AnalysisCache:
+    """Content-addressed on-disk cache of document analysis results.
+
+    Entries are JSON files named after a key derived from the file's content
+    hash, the model name and the prompt version, so re-uploading the same
+    document (under any filename) reuses earlier work while a model or prompt
+    change invalidates it. Eviction is by age first, then least recently used
+    until both the entry count and total size fit the configured limits.
+    """
+
+    def __init__(self, cache_dir=ANALYSIS_CACHE_DIR, max_entries=ANALYSIS_CACHE_MAX_ENTRIES,
+                 max_bytes=ANALYSIS_CACHE_MAX_BYTES, max_age=ANALYSIS_CACHE_MAX_AGE):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def make_key(self, file_hash, model, prompt_version):
+        """Build the cache key for a document/model/prompt combination"""
+        raw = f"{file_hash}:{model}:{prompt_version}"
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, key, need=None):
+        """Return the cached entry for key, or None if there is none.
+
+        need names the field the caller is after (e.g. 'summary'); an entry
+        without it is still returned, so partial work is reused, but counts
+        as a miss in the stats.
+        """
+        entry_path = self._entry_path(key)
+        try:
+            with open(entry_path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            with self.lock:
+                self.misses += 1
+            return None
+
+        if time.time() - entry.get('created_at', 0) > self.max_age:
+            self._remove(entry_path)
+            with self.lock:
+                self.misses += 1
+                self.evictions += 1
+            return None
+
+        # Touch the file so eviction treats it as recently used
+        try:
+            os.utime(entry_path, None)
+        except OSError:
+            pass
+
+        with self.lock:
+            if need is None or need in entry:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return entry
+
+    def put(self, key, entry):
+        """Store (or merge into) the entry for key and enforce the size limits"""
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+        entry_path = self._entry_path(key)
+        existing = {}
+        try:
+            with open(entry_path, 'r', encoding='utf-8') as f:
+                existing = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+        # The entry's age restarts with the new fields, so they get the full max_age
+        merged = {**existing, **entry, 'created_at': entry.get('created_at', time.time())}
+
+        # Write to a temp file and rename so readers never see a partial entry
+        tmp_path = f"{entry_path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(merged, f)
+            os.replace(tmp_path, entry_path)
+        except OSError as e:
+            print(f"❌ Error writing analysis cache entry: {e}")
+            self._remove(tmp_path)
+            return False
+
+        self._evict()
+        return True
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _scan(self):
+        """List (path, size, mtime) for every cache entry"""
+        entries = []
+        if not os.path.exists(self.cache_dir):
+            return entries
+        for dir_entry in os.scandir(self.cache_dir):
+            if dir_entry.name.endswith('.json'):
+                try:
+                    stat = dir_entry.stat()
+                except OSError:
+                    continue
+                entries.append((dir_entry.path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def _evict(self):
+        """Drop expired entries, then the least recently used ones over the limits"""
+        with self.lock:
+            now = time.time()
+            entries = []
+            for path, size, mtime in self._scan():
+                if now - mtime > self.max_age:
+                    self._remove(path)
+                    self.evictions += 1
+                else:
+                    entries.append((path, size, mtime))
+
+            entries.sort(key=lambda e: e[2])  # oldest access first
+            total_bytes = sum(size for _, size, _ in entries)
+            while entries and (len(entries) > self.max_entries or total_bytes > self.max_bytes):
+                path, size, _ = entries.pop(0)
+                self._remove(path)
+                total_bytes -= size
+                self.evictions += 1
+
+    def clear(self):
+        """Remove every cached entry"""
+        with self.lock:
+            for path, _, _ in self._scan():
+                self._remove(path)
+
+    def stats(self):
+        """Return hit/miss counters and current cache usage"""
+        entries = self._scan()
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "evictions": self.evictions,
+                "entries": len(entries),
+                "bytes": sum(size for _, size, _ in entries),
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "max_age_seconds": self.max_age
+            }
@@ -0,0 +1,172 @@
+import os
+import time
+import asyncio
+import secrets
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Job queue settings
+ANALYSIS_JOB_WORKERS = int(os.getenv('ANALYSIS_JOB_WORKERS', '2'))  # documents analyzed at once
+ANALYSIS_JOB_TTL = int(os.getenv('ANALYSIS_JOB_TTL', '3600'))  # seconds to keep finished jobs
+
+class AnalysisJob:
+    """State of one background document analysis"""
+
+    def __init__(self, user_id, filename, file_path, kind='analyze', after=None):
+        self.id = secrets.token_hex(8)
+        self.user_id = user_id
+        self.filename = filename
+        self.file_path = file_path
+        self.kind = kind  # 'prepare' (extract and chunk only) or 'analyze'
+        self.after = after  # job that must finish before this one starts
+        self.done = threading.Event()
+        self.status = 'queued'  # queued -> running -> completed | failed
+        self.stage = None
+        self.chunks_done = 0
+        self.chunks_total = None
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.events = []  # analysis events (sections, summary tokens) for streaming subscribers
+        self.events_changed = threading.Condition()
+
+    @property
+    def finished(self):
+        return self.status in ('completed', 'failed')
+
+    def publish(self, event):
+        """Record an analysis event and wake up streaming subscribers"""
+        with self.events_changed:
+            self.events.append(event)
+            self.events_changed.notify_all()
+
+    def iter_events(self):
+        """Yield every event from the start, then new ones as they arrive, until the job finishes"""
+        index = 0
+        while True:
+            with self.events_changed:
+                while index >= len(self.events) and not self.finished:
+                    self.events_changed.wait(timeout=1.0)
+                new_events = self.events[index:]
+                index = len(self.events)
+                finished = self.finished
+            yield from new_events
+            if finished and index >= len(self.events):
+                return
+
+    async def aiter_events(self, poll_interval=0.25):
+        """asyncio version of iter_events; polls instead of holding a thread while waiting"""
+        index = 0
+        while True:
+            with self.events_changed:
+                new_events = self.events[index:]
+                index = len(self.events)
+                finished = self.finished
+            for event in new_events:
+                yield event
+            if finished and index >= len(self.events):
+                return
+            if not new_events:
+                await asyncio.sleep(poll_interval)
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "filename": self.filename,
+            "status": self.status,
+            "stage": self.stage,
+            "progress": {
+                "chunks_done": self.chunks_done,
+                "chunks_total": self.chunks_total
+            },
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at
+        }
+
+class AnalysisJobQueue:
+    """Run document analyses on a worker pool and track their progress.
+
+    analyze_fn and prepare_fn are called as fn(file_path, progress=callback)
+    and the callback receives (stage, chunks_done, chunks_total) updates.
+    analyze_fn also gets on_event=job.publish for streaming its partial output.
+    """
+
+    def __init__(self, analyze_fn, prepare_fn=None, workers=ANALYSIS_JOB_WORKERS, ttl=ANALYSIS_JOB_TTL):
+        self.handlers = {'analyze': analyze_fn, 'prepare': prepare_fn}
+        self.ttl = ttl
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='analysis-job')
+        self.lock = threading.Lock()
+        self.jobs = {}
+
+    def submit(self, user_id, filename, file_path, kind='analyze', after=None):
+        """Queue a job and return it; with after, it starts once that job has finished"""
+        job = AnalysisJob(user_id, filename, file_path, kind, after)
+        with self.lock:
+            self._prune()
+            self.jobs[job.id] = job
+        self.executor.submit(self._run, job)
+        print(f"Queued {kind} job {job.id} for {filename}")
+        return job
+
+    def get(self, job_id):
+        """Return a job by id, or None"""
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list_jobs(self, visible):
+        """Return jobs for which visible(job) is true, newest first"""
+        with self.lock:
+            jobs = [job for job in self.jobs.values() if visible(job)]
+        return sorted(jobs, key=lambda job: job.created_at, reverse=True)
+
+    def _prune(self):
+        """Forget finished jobs older than the TTL (caller holds the lock)"""
+        cutoff = time.time() - self.ttl
+        expired = [job_id for job_id, job in self.jobs.items()
+                   if job.finished and job.finished_at is not None and job.finished_at < cutoff]
+        for job_id in expired:
+            del self.jobs[job_id]
+
+    def _run(self, job):
+        if job.after is not None:
+            # The earlier job was queued first, so it is already running or next in line
+            job.after.done.wait()
+            job.after = None
+
+        job.status = 'running'
+        job.started_at = time.time()
+
+        def progress(stage, chunks_done=0, chunks_total=None):
+            job.stage = stage
+            job.chunks_done = chunks_done
+            job.chunks_total = chunks_total
+
+        try:
+            if job.kind == 'analyze':
+                job.result = self.handlers[job.kind](job.file_path, progress=progress, on_event=job.publish)
+            else:
+                job.result = self.handlers[job.kind](job.file_path, progress=progress)
+            job.stage = 'done'
+            # finished_at first: once the status is final, _prune compares it
+            job.finished_at = time.time()
+            job.status = 'completed'
+            print(f"✅ {job.kind.capitalize()} job {job.id} completed for {job.filename}")
+        except Exception as e:
+            job.error = str(e)
+            job.finished_at = time.time()
+            job.status = 'failed'
+            print(f"❌ {job.kind.capitalize()} job {job.id} failed: {e}")
+        finally:
+            job.done.set()
+            with job.events_changed:
+                job.events_changed.notify_all()
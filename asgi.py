@@ -0,0 +1,363 @@
+# Asyncio serving mode: uvicorn asgi:application --host 0.0.0.0 --port 5000
+#
+# /api/chat, /api/upload and the auth routes are served by an async Quart app,
+# so a streaming chat waits on Ollama without holding a thread. Every other
+# route falls through to the Flask app in backend.py (run in a thread pool),
+# which also still works on its own with `python backend.py`.
+import os
+import secrets
+from datetime import datetime
+import httpx
+from quart import Quart, request, jsonify, session, Response
+from quart.utils import run_sync
+from asgiref.wsgi import WsgiToAsgi
+from werkzeug.security import check_password_hash, generate_password_hash
+from dotenv import load_dotenv
+
+import backend
+from backend import (
+    app as flask_app, users_db, user_sessions, uploaded_files, ALLOWED_UPLOAD_EXTENSIONS, NO_UPLOADS_REPLY,
+    user_directory,
+    check_signup_data, find_taken_account, create_file_user, find_file_user, public_user,
+    plan_chat, find_latest_upload, get_analysis_job, analysis_status_reply, AnalysisStream,
+    upload_path, register_upload, generate_fallback_response, admission, admission_key, busy_reply,
+    chat_options, use_response_cache, response_cache
+)
+from admission import AdmissionRejected, INTERACTIVE
+from ollama_client import AsyncOllamaClient, OllamaUnavailable
+from sse import sse_frame, awith_heartbeats, astream_ollama_chat
+from database import init_async_database, create_user_in_db_async, get_user_from_db_async
+
+# Load environment variables
+load_dotenv()
+
+ASGI_HOST = os.getenv('ASGI_HOST', '0.0.0.0')
+ASGI_PORT = int(os.getenv('ASGI_PORT', '5000'))
+
+ASYNC_PATHS = {
+    '/api/chat',
+    '/api/upload',
+    '/api/auth/signup',
+    '/api/auth/login',
+    '/api/auth/logout',
+    '/api/auth/check',
+    '/api/auth/auto-login',
+}
+
+asgi_app = Quart(__name__)
+
+# Same key and cookie settings as Flask, so sessions work across both apps
+asgi_app.secret_key = flask_app.secret_key
+asgi_app.config['SESSION_COOKIE_HTTPONLY'] = flask_app.config['SESSION_COOKIE_HTTPONLY']
+asgi_app.config['SESSION_COOKIE_SECURE'] = flask_app.config['SESSION_COOKIE_SECURE']
+asgi_app.config['PERMANENT_SESSION_LIFETIME'] = flask_app.config['PERMANENT_SESSION_LIFETIME']
+asgi_app.config['RESPONSE_TIMEOUT'] = None  # streams last as long as the generation
+
+ollama = None
+
+@asgi_app.before_serving
+async def startup():
+    global ollama
+    ollama = AsyncOllamaClient(backend.ollama_backends)
+    if backend.USE_DATABASE:
+        await init_async_database()
+
+@asgi_app.after_serving
+async def shutdown():
+    await ollama.aclose()
+
+@asgi_app.after_request
+async def add_cors_headers(response):
+    """Match the Flask CORS setup: any origin, with credentials"""
+    origin = request.headers.get('Origin')
+    if origin:
+        response.headers['Access-Control-Allow-Origin'] = origin
+        response.headers['Access-Control-Allow-Credentials'] = 'true'
+        response.headers['Access-Control-Allow-Methods'] = 'GET, POST, PUT, DELETE, OPTIONS'
+        response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization'
+    return response
+
+def stream_response(frames):
+    """Async counterpart of sse.sse_response"""
+    return Response(frames,
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             'Connection': 'keep-alive',
+                             'X-Accel-Buffering': 'no'})
+
+async def get_current_user():
+    """Get current authenticated user (without chat history in database mode)"""
+    user_id = session.get('user_id')
+    if not user_id:
+        return None
+    if backend.USE_DATABASE:
+        return await get_user_from_db_async(user_id=user_id)
+    # The store may read the user's file, under its lock; keep that off the event loop
+    return await run_sync(users_db.get)(user_id)
+
+def create_user_session(user_id, remember_me=False):
+    """Create a user session"""
+    session['user_id'] = user_id
+    session['login_time'] = datetime.now().isoformat()
+    if remember_me:
+        session.permanent = True
+
+    user_sessions[user_id] = {
+        'login_time': datetime.now().isoformat(),
+        'remember_me': remember_me
+    }
+
+@asgi_app.route('/api/auth/signup', methods=['POST', 'OPTIONS'])
+async def signup():
+    """Handle user registration"""
+    if request.method == 'OPTIONS':
+        return '', 200
+
+    try:
+        data = await request.get_json()
+        error, email, username, password = check_signup_data(data or {})
+        if error:
+            return jsonify({"success": False, "message": error}), 400
+
+        taken = find_taken_account(email, username)
+        if taken:
+            return jsonify({"success": False, "message": taken}), 400
+
+        user_id = secrets.token_hex(16)
+        if backend.USE_DATABASE:
+            # Hash in a thread before opening the session; it would block the event loop
+            password_hash = await run_sync(generate_password_hash)(password)
+            success, message = await create_user_in_db_async(user_id, email, username, password_hash)
+            if not success:
+                return jsonify({"success": False, "message": message}), 400
+            user_directory.add(user_id, email, username)
+            print(f"New user registered in PostgreSQL: {username} ({email}) with ID: {user_id}")
+        else:
+            # Password hashing and the file write are blocking
+            taken = await run_sync(create_file_user)(user_id, email, username, password)
+            if taken:
+                return jsonify({"success": False, "message": taken}), 400
+
+        uploaded_files[user_id] = {}
+
+        return jsonify({
+            "success": True,
+            "message": "Account created successfully! You can now sign in.",
+            "user": {"id": user_id, "username": username, "email": email}
+        })
+
+    except Exception as e:
+        print(f"Signup error: {str(e)}")
+        return jsonify({"success": False, "message": "Registration failed. Please try again."}), 500
+
+@asgi_app.route('/api/auth/login', methods=['POST', 'OPTIONS'])
+async def login():
+    """Handle user login"""
+    if request.method == 'OPTIONS':
+        return '', 200
+
+    try:
+        data = await request.get_json()
+        if not data or not data.get('email', '').strip() or not data.get('password', '').strip():
+            return jsonify({"success": False, "message": "Please fill in all fields"}), 400
+
+        email_or_username = data['email'].strip().lower()
+        password = data['password']
+        remember_me = data.get('rememberMe', False)
+
+        if backend.USE_DATABASE:
+            user_id = user_directory.find(email_or_username)
+            user = await get_user_from_db_async(user_id=user_id) if user_id else None
+            if user is None:
+                user = await get_user_from_db_async(email_or_username=email_or_username)
+                if user:
+                    user_directory.add(user['id'], user['email'], user['username'])
+        else:
+            user = await run_sync(find_file_user)(email_or_username)
+
+        # Password hashes are deliberately slow; check off the event loop
+        if not user or not await run_sync(check_password_hash)(user['password_hash'], password):
+            print("Login failed for that email/username")
+            return jsonify({"success": False, "message": "Invalid email/username or password"}), 401
+
+        create_user_session(user['id'], remember_me)
+        print(f"User logged in: {user['username']}")
+
+        return jsonify({
+            "success": True,
+            "message": "Login successful!",
+            "user": public_user(user['id'], user)
+        })
+
+    except Exception as e:
+        print(f"Login error: {str(e)}")
+        return jsonify({"success": False, "message": "Login failed. Please try again."}), 500
+
+@asgi_app.route('/api/auth/logout', methods=['POST'])
+async def logout():
+    """Handle user logout"""
+    user_id = session.get('user_id')
+    if user_id:
+        user_sessions.pop(user_id, None)
+        session.clear()
+        print(f"User logged out: {user_id}")
+
+    return jsonify({"success": True, "message": "Logged out successfully"})
+
+@asgi_app.route('/api/auth/check', methods=['GET'])
+async def check_auth():
+    """Check if user is authenticated"""
+    user = await get_current_user()
+    if user:
+        return jsonify({"authenticated": True, "user": public_user(user['id'], user)})
+    return jsonify({"authenticated": False}), 401
+
+@asgi_app.route('/api/auth/auto-login', methods=['POST'])
+async def auto_login():
+    """Auto-login for persistent sessions"""
+    user = await get_current_user()
+    if user:
+        return jsonify({
+            "success": True,
+            "message": "Auto-login successful",
+            "user": public_user(user['id'], user)
+        })
+    return jsonify({"success": False, "message": "No active session"}), 401
+
+async def generate_analysis_stream(job, filename, file_info):
+    """Async counterpart of backend.generate_analysis_stream"""
+    stream = AnalysisStream(job, filename, file_info)
+    try:
+        for frame in stream.start_frames():
+            yield frame
+        async for event in job.aiter_events():
+            for frame in stream.event_frames(event):
+                yield frame
+        for frame in stream.end_frames():
+            yield frame
+    except Exception as e:
+        print(f"Streaming error: {e}")
+        yield sse_frame({'error': str(e)})
+
+@asgi_app.route('/api/chat', methods=['POST'])
+async def chat():
+    data = await request.get_json()
+    user_message = data.get('message', '')
+    stream = data.get('stream', True)  # Default to streaming
+    user_id = session.get('user_id')
+    user = await get_current_user()
+    print(f"Received message from {user['username'] if user else 'guest'}: {user_message} (stream: {stream})")
+
+    mode, messages = await run_sync(plan_chat)(user_id, user_message, data.get('chat_id'), session.get('guest_id'))
+    if mode == 'analysis':
+        latest_upload = find_latest_upload(user_id)
+        if not latest_upload:
+            return jsonify({"reply": NO_UPLOADS_REPLY})
+
+        filename, file_info = latest_upload
+        job = get_analysis_job(filename, file_info)
+        if stream and job.status != 'failed':
+            return stream_response(awith_heartbeats(generate_analysis_stream(job, filename, file_info)))
+        return jsonify(analysis_status_reply(job, filename, file_info))
+
+    options = chat_options(data)
+    cacheable = use_response_cache(stream, options)
+    if cacheable:
+        if response_cache.uses_embeddings:
+            # The near-duplicate lookup calls the embedding model; keep it off the event loop
+            cached = await run_sync(response_cache.get)(ollama.model, messages, options)
+        else:
+            cached = response_cache.get(ollama.model, messages, options)
+        if cached:
+            return jsonify({"reply": cached[0], "cached": cached[1]})
+
+    # Queued without holding a thread; interactive chat goes ahead of document analysis
+    client_key = admission_key(user_id, request.remote_addr)
+    try:
+        ticket = await admission.acquire_async(client_key, INTERACTIVE)
+    except AdmissionRejected as e:
+        print(f"Chat not admitted ({e.reason}, queue position {e.queue_position})")
+        return jsonify(busy_reply(e)), 429, {'Retry-After': str(int(e.retry_after + 0.5))}
+
+    try:
+        if stream:
+            # Identical requests already in flight share that generation
+            response = await ollama.open_chat_stream(messages, operation='chat', options=options, affinity=client_key)
+            if response.status_code != 200:
+                print(f"Ollama API error: {response.status_code}")
+                await response.aclose()
+                raise OllamaUnavailable("Ollama not responding")
+            # The stream hands the slot back when it finishes or the client leaves
+            stream_ticket, ticket = ticket, None
+            return stream_response(astream_ollama_chat(response, on_close=lambda: admission.release(stream_ticket)))
+
+        reply = await ollama.chat(messages, operation='chat', options=options, affinity=client_key)
+        if reply is None:
+            raise OllamaUnavailable("Ollama not responding")
+        if cacheable:
+            if response_cache.uses_embeddings:
+                await run_sync(response_cache.put)(ollama.model, messages, options, reply)
+            else:
+                response_cache.put(ollama.model, messages, options, reply)
+        return jsonify({"reply": reply})
+
+    except (OllamaUnavailable, httpx.ConnectError, httpx.ConnectTimeout):
+        print("ERROR: Could not connect to Ollama API. Using fallback response.")
+        return jsonify({"reply": generate_fallback_response(user_message, user_id)})
+
+    except httpx.TimeoutException:
+        print("ERROR: Ollama API timeout. Using fallback response.")
+        return jsonify({"reply": generate_fallback_response(user_message, user_id)})
+
+    except Exception as e:
+        print(f"ERROR: {str(e)}")
+        return jsonify({"reply": f"AI backend error: {str(e)}"})
+
+    finally:
+        if ticket is not None:
+            admission.release(ticket)
+
+@asgi_app.route('/api/upload', methods=['POST'])
+async def upload_file():
+    try:
+        user_id = session.get('user_id')
+        user = await get_current_user()
+        if not user_id:
+            # One ID per session, so chat can find the guest's own uploads
+            user_id = session.get('guest_id') or f"guest_{secrets.token_hex(8)}"
+            session['guest_id'] = user_id
+            print(f"Guest upload with ID: {user_id}")
+
+        files = await request.files
+        if 'file' not in files:
+            return jsonify({"error": "No file provided"}), 400
+
+        file = files['file']
+        if file.filename == '':
+            return jsonify({"error": "No file selected"}), 400
+
+        if not any(file.filename.lower().endswith(ext) for ext in ALLOWED_UPLOAD_EXTENSIONS):
+            return jsonify({"error": "Only PDF and Excel files (.pdf, .xlsx, .xls) are supported"}), 400
+
+        filename, file_path = upload_path(user_id, file.filename)
+        await file.save(file_path)
+        return jsonify(await run_sync(register_upload)(user, user_id, filename, file_path))
+
+    except Exception as e:
+        print(f"Upload error: {str(e)}")
+        return jsonify({"error": f"Upload failed: {str(e)}"}), 500
+
+flask_fallback = WsgiToAsgi(flask_app)
+
+async def application(scope, receive, send):
+    """Route the hot paths to the async app and everything else to Flask"""
+    if scope['type'] == 'lifespan' or scope.get('path') in ASYNC_PATHS:
+        await asgi_app(scope, receive, send)
+    else:
+        await flask_fallback(scope, receive, send)
+
+if __name__ == '__main__':
+    import uvicorn
+
+    print(f"Starting asyncio server on http://localhost:{ASGI_PORT}")
+    uvicorn.run(application, host=ASGI_HOST, port=ASGI_PORT)
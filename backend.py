@@ -5,21 +5,37 @@ import json
 import os
 from werkzeug.utils import secure_filename
 from werkzeug.security import generate_password_hash, check_password_hash
-import PyPDF2
-import pdfplumber
-from typing import List
+from typing import List, Iterable, Iterator
 import re
+import atexit
 import secrets
 from datetime import datetime, timedelta
 from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+from analysis_cache import AnalysisCache, hash_file
+from ollama_client import OllamaClient, BackendPool, OLLAMA_POOL_SIZE
+from pdf_extraction import iter_pdf_pages
+from excel_extraction import extract_excel_summary
+from analysis_jobs import AnalysisJobQueue
+from retrieval import DocumentIndexStore, RETRIEVAL_CHUNK_TOKENS, RETRIEVAL_MIN_SCORE, RETRIEVAL_CONFIDENT_SCORE
+from chunking import iter_token_chunks
+from sse import sse_frame, sse_response, with_heartbeats, stream_ollama_chat, stream_totals
+from admission import AdmissionController, AdmissionRejected, INTERACTIVE, BULK
+from response_cache import ResponseCache, is_deterministic, RESPONSE_CACHE_ENABLED, RESPONSE_CACHE_EMBED_MODEL
+from conversation_context import ConversationContext, CHAT_HISTORY_MESSAGES
+from user_directory import UserDirectory
+from user_store import LazyUserStore, UserJournal, chat_journal_entry
 
 # Import database functions
 try:
     from database import (
         init_database, create_user_in_db, get_user_from_db,
         update_user_chat_history, save_uploaded_file_to_db,
-        get_user_files_from_db
+        get_user_files_from_db, get_chat_history_from_db, get_chat_messages_from_db,
+        get_recent_chat_messages_from_db,
+        apply_chat_changes_to_db, get_chat_changes_from_db, user_cache,
+        remove_db_session, database_stats
     )
     DATABASE_AVAILABLE = True
 except ImportError as e:
@@ -49,10 +65,15 @@ app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(days=7)
 # Store uploaded files and their analysis (per user)
 uploaded_files = {}
 
-# File-based user storage (persistent across server restarts)
-users_db = {}
+# File-based user storage (persistent across server restarts); records load on first use
+# and changes are written behind through an append-only journal
+user_journal = UserJournal('users')
+users_db = LazyUserStore('users', journal=user_journal)
 user_sessions = {}
 
+# Email/username -> user id indexes for signup and login, in both storage modes
+user_directory = UserDirectory()
+
 def ensure_users_directory():
     """Create users directory if it doesn't exist"""
     users_dir = 'users'
@@ -62,18 +83,19 @@ def ensure_users_directory():
     return users_dir
 
 def save_user_to_file(user_id, user_data):
-    """Save individual user data to file"""
-    users_dir = ensure_users_directory()
-    user_file = os.path.join(users_dir, f"{user_id}.json")
-
-    try:
-        with open(user_file, 'w') as f:
-            json.dump(user_data, f, indent=2)
-        print(f"✅ User saved to file: {user_file}")
+    """Journal a user's full record and wait until it is on disk"""
+    if user_journal.write(user_id, {'user': user_data}, wait=True):
+        print(f"✅ User saved to file: {user_id}")
         return True
-    except Exception as e:
-        print(f"❌ Error saving user to file: {e}")
-        return False
+    print(f"❌ Error saving user to file: {user_id}")
+    return False
+
+def save_chat_changes_to_file(user_id, user, version):
+    """Journal what one chat sync changed; written behind, batched with other saves.
+
+    Call with users_db.user_lock(user_id) held, together with the change itself.
+    """
+    user_journal.write(user_id, chat_journal_entry(user, version))
 
 def load_user_from_file(user_id):
     """Load individual user data from file"""
@@ -89,22 +111,17 @@ def load_user_from_file(user_id):
     return None
 
 def load_all_users():
-    """Load all users from files into memory"""
-    users_dir = ensure_users_directory()
-    loaded_count = 0
-
-    if os.path.exists(users_dir):
-        for filename in os.listdir(users_dir):
-            if filename.endswith('.json'):
-                user_id = filename[:-5]  # Remove .json extension
-                user_data = load_user_from_file(user_id)
-                if user_data:
-                    users_db[user_id] = user_data
-                    uploaded_files[user_id] = {}  # Initialize file storage
-                    loaded_count += 1
-
-    print(f"✅ Loaded {loaded_count} users from files")
-    return loaded_count
+    """Load the user index; full user records are read from their files on first use"""
+    ensure_users_directory()
+    # Replays changes the previous run journaled but did not compact yet
+    user_journal.start()
+    atexit.register(user_journal.close)
+    user_count = users_db.load_index()
+    for user_id, entry in users_db.entries():
+        user_directory.add(user_id, entry['email'], entry['username'])
+
+    print(f"✅ Indexed {user_count} users from files")
+    return user_count
 
 def create_test_user():
     """Create a test user for debugging"""
@@ -114,6 +131,7 @@ def create_test_user():
     existing_user = load_user_from_file(test_user_id)
     if existing_user:
         users_db[test_user_id] = existing_user
+        user_directory.add(test_user_id, existing_user['email'], existing_user['username'])
         uploaded_files[test_user_id] = {}
         print(f"✅ Test user loaded from file: testuser (test@example.com)")
         return
@@ -129,6 +147,7 @@ def create_test_user():
     }
 
     users_db[test_user_id] = test_user_data
+    user_directory.add(test_user_id, test_user_data['email'], test_user_data['username'])
     uploaded_files[test_user_id] = {}
     save_user_to_file(test_user_id, test_user_data)
     print(f"✅ Test user created and saved: testuser (test@example.com)")
@@ -150,6 +169,12 @@ else:
     load_all_users()
     create_test_user()
 
+@app.teardown_appcontext
+def end_database_session(exception=None):
+    """Return the request's database session to the pool, also when the request failed"""
+    if USE_DATABASE:
+        remove_db_session()
+
 # Authentication helper functions
 def require_auth(f):
     """Decorator to require authentication for routes"""
@@ -161,11 +186,13 @@ def require_auth(f):
     return decorated_function
 
 def get_current_user():
-    """Get current authenticated user"""
+    """Get current authenticated user (without chat history in database mode)"""
     user_id = session.get('user_id')
-    if user_id and user_id in users_db:
-        return users_db[user_id]
-    return None
+    if not user_id:
+        return None
+    if USE_DATABASE:
+        return get_user_from_db(user_id=user_id)
+    return users_db.get(user_id)
 
 def create_user_session(user_id, remember_me=False):
     """Create a user session"""
@@ -216,85 +243,176 @@ def validate_user_input(data, required_fields):
 
     return errors
 
+def check_signup_data(data):
+    """Return (error message, email, username, password) for a signup request"""
+    # Simple validation for signup
+    if not data.get('email') or not data.get('username') or not data.get('password'):
+        print("Signup failed: Missing required fields")
+        return "Please fill in all fields", None, None, None
+
+    # Basic email validation
+    email = data['email'].strip().lower()
+    if '@' not in email or '.' not in email:
+        print("Signup failed: Invalid email format")
+        return "Please enter a valid email address", None, None, None
+
+    # Basic password validation
+    password = data['password']
+    if len(password) < 6:
+        print("Signup failed: Password too short")
+        return "Password must be at least 6 characters", None, None, None
+
+    return None, email, data['username'].strip(), password
+
+def find_taken_account(email, username):
+    """Return an error message if the email or username is already registered.
+
+    In database mode only users seen by this process are indexed; the
+    database's own check in create_user_in_db is authoritative.
+    """
+    return user_directory.taken(email, username)
+
+def create_file_user(user_id, email, username, password):
+    """Create a user in file storage; returns an error message if the email or username was just taken"""
+    # Claim the email and username first so concurrent signups cannot both get them
+    taken = user_directory.reserve(user_id, email, username)
+    if taken:
+        return taken
+
+    user_data = {
+        'id': user_id,
+        'email': email,
+        'username': username,
+        'password_hash': generate_password_hash(password),
+        'created_at': datetime.now().isoformat(),
+        'chat_history': {}
+    }
+
+    # Save to memory
+    users_db[user_id] = user_data
+
+    # Save to file (persistent storage)
+    save_user_to_file(user_id, user_data)
+
+    print(f"New user registered in files: {username} ({email}) with ID: {user_id}")
+    return None
+
+def find_file_user(email_or_username):
+    """Find a file-storage user by email or username"""
+    user_id = user_directory.find(email_or_username)
+    return users_db.get(user_id) if user_id else None
+
+def find_db_user(email_or_username):
+    """Find a database user by email or username, by primary key when the directory knows the id"""
+    user_id = user_directory.find(email_or_username)
+    user = get_user_from_db(user_id=user_id) if user_id else None
+    if user is None:
+        user = get_user_from_db(email_or_username=email_or_username)
+        if user:
+            user_directory.add(user['id'], user['email'], user['username'])
+    return user
+
+def public_user(user_id, user):
+    """User fields safe to return to the browser"""
+    return {
+        "id": user_id,
+        "username": user['username'],
+        "email": user['email']
+    }
+
+# Bump whenever the analysis prompts or extracted text format change so cached results are recomputed
+ANALYSIS_PROMPT_VERSION = 4
+
+# Document analysis concurrency settings
+ANALYSIS_WORKERS = int(os.getenv('ANALYSIS_WORKERS', '4'))  # max chunks in flight to Ollama
+ANALYSIS_MAX_CHUNKS = int(os.getenv('ANALYSIS_MAX_CHUNKS', '0'))  # 0 = analyze every chunk
+SUMMARY_MAX_INPUT_CHARS = int(os.getenv('SUMMARY_MAX_INPUT_CHARS', '3000'))  # per summary prompt
+
+# Work started as soon as a file is uploaded:
+#   full    - extract, chunk and summarize in the background (default)
+#   extract - only extract and chunk; summarization waits until the user asks
+#   off     - nothing until the user asks
+EAGER_ANALYSIS = os.getenv('EAGER_ANALYSIS', 'full').lower()
+
+# Sampling options for chat replies; pinning either makes replies cacheable
+CHAT_TEMPERATURE = os.getenv('CHAT_TEMPERATURE')  # e.g. 0 for deterministic replies
+CHAT_SEED = os.getenv('CHAT_SEED')
+CHAT_OPTION_TYPES = {'temperature': float, 'seed': int}  # options a request may set
+
+# Enables admin endpoints that change server state (e.g. draining an Ollama backend)
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
+
+# Ollama servers (OLLAMA_URLS), health-checked in the background
+ollama_backends = BackendPool()
+ollama_backends.start_health_checks()
+
+# Shared Ollama client; the pool leaves room for interactive chat on top of the analysis workers
+ollama_client = OllamaClient(ollama_backends, pool_size=max(OLLAMA_POOL_SIZE, ANALYSIS_WORKERS + 4))
+
+# Shared cache of extracted text, chunk points and summaries keyed by file content
+analysis_cache = AnalysisCache()
+
+# Admission control in front of Ollama: interactive chat is served before document analysis;
+# the concurrency cap scales with the number of routable backends
+admission = AdmissionController(backends=ollama_backends)
+
+# Replies to deterministic chat requests, reused for repeated questions (and, when
+# RESPONSE_CACHE_SIMILARITY is set, for questions the embedding model finds near-identical)
+response_cache = ResponseCache(embed_fn=lambda text: ollama_client.embed(text, RESPONSE_CACHE_EMBED_MODEL))
+
+def chat_options(data):
+    """Ollama options for a chat request: server defaults, overridden by the request's own"""
+    options = {}
+    if CHAT_TEMPERATURE is not None:
+        options['temperature'] = float(CHAT_TEMPERATURE)
+    if CHAT_SEED is not None:
+        options['seed'] = int(CHAT_SEED)
+
+    requested = data.get('options') or {}
+    if isinstance(requested, dict):
+        for name, cast in CHAT_OPTION_TYPES.items():
+            if requested.get(name) is not None:
+                try:
+                    options[name] = cast(requested[name])
+                except (TypeError, ValueError):
+                    pass
+    return options or None
+
+def use_response_cache(stream, options):
+    """Only non-streaming replies with pinned sampling are cached"""
+    return RESPONSE_CACHE_ENABLED and not stream and is_deterministic(options)
+
+def is_analysis_error(text):
+    """Check if an analyzer output is an error message rather than a result"""
+    return not text or text.startswith(("Error", "Analysis error", "Summary error", "Could not create summary"))
+
 class DocumentAnalyzer:
     def __init__(self):
-        self.ollama_url = 'http://localhost:11434/api/chat'
+        self.model = ollama_client.model
+        # Shared across requests so the total number of in-flight chunk calls stays bounded
+        self.executor = ThreadPoolExecutor(max_workers=ANALYSIS_WORKERS, thread_name_prefix='analysis')
 
     def extract_pdf_text(self, pdf_path: str) -> str:
-        """Extract text from PDF using multiple methods"""
+        """Extract text from PDF, page by page (pdfplumber with per-page PyPDF2 fallback)"""
         try:
-            # Try pdfplumber first (better extraction)
-            text = ""
-            with pdfplumber.open(pdf_path) as pdf:
-                for page in pdf.pages:
-                    page_text = page.extract_text()
-                    if page_text:
-                        text += page_text + "\n"
-
-            if text.strip():
-                return text.strip()
-
-            # Fallback to PyPDF2
-            with open(pdf_path, 'rb') as file:
-                reader = PyPDF2.PdfReader(file)
-                text = ""
-                for page in reader.pages:
-                    text += page.extract_text() + "\n"
-
-            return text.strip()
+            return "\n".join(iter_pdf_pages(pdf_path)).strip()
         except Exception as e:
             return f"Error extracting text: {str(e)}"
 
     def extract_excel_text(self, excel_path: str) -> str:
-        """Extract text from Excel files"""
+        """Extract a compact summary (schema, column statistics, sample rows) from Excel files"""
         try:
-            import pandas as pd
-
-            # Read all sheets
-            excel_file = pd.ExcelFile(excel_path)
-            all_text = []
-
-            for sheet_name in excel_file.sheet_names:
-                df = pd.read_excel(excel_path, sheet_name=sheet_name)
-
-                # Convert DataFrame to text
-                sheet_text = f"Sheet: {sheet_name}\n"
-                sheet_text += df.to_string(index=False, na_rep='')
-                all_text.append(sheet_text)
-
-            return "\n\n".join(all_text)
-
+            return extract_excel_summary(excel_path)
         except Exception as e:
             return f"Error extracting Excel data: {str(e)}"
 
-    def chunk_text_for_tinyllama(self, text: str, max_chunk_size: int = 400) -> List[str]:
-        """Split text into chunks suitable for TinyLlama"""
-        # Clean text
-        text = re.sub(r'\s+', ' ', text).strip()
-
-        # Split by sentences
-        sentences = re.split(r'[.!?]+', text)
-        chunks = []
-        current_chunk = ""
-
-        for sentence in sentences:
-            sentence = sentence.strip()
-            if not sentence:
-                continue
+    def chunk_text_for_tinyllama(self, text: str, max_tokens: int = None) -> List[str]:
+        """Split text into token-budgeted chunks suitable for TinyLlama"""
+        return [chunk['text'] for chunk in self.iter_chunks([text], max_tokens)]
 
-            test_chunk = current_chunk + " " + sentence + "."
-
-            if len(test_chunk) <= max_chunk_size:
-                current_chunk = test_chunk
-            else:
-                if current_chunk:
-                    chunks.append(current_chunk.strip())
-                current_chunk = sentence + "."
-
-        if current_chunk:
-            chunks.append(current_chunk.strip())
-
-        return chunks
+    def iter_chunks(self, pages: Iterable[str], max_tokens: int = None) -> Iterator[dict]:
+        """Yield chunks (text, token count, character offsets) as soon as enough page text has arrived"""
+        return iter_token_chunks(pages, max_tokens)
 
     def analyze_with_tinyllama(self, text_chunk: str) -> str:
         """Analyze text chunk with TinyLlama"""
@@ -307,28 +425,76 @@ Key points:
 •"""
 
         try:
-            response = requests.post(
-                self.ollama_url,
-                json={
-                    "model": "tinyllama",
-                    "messages": [{"role": "user", "content": prompt}],
-                    "stream": False
-                },
-                timeout=120
-            )
-
-            if response.status_code == 200:
-                data = response.json()
-                if "message" in data and "content" in data["message"]:
-                    return data["message"]["content"]
+            with admission.slot(priority=BULK):
+                content = ollama_client.chat([{"role": "user", "content": prompt}], operation='analysis')
+            if content is not None:
+                return content
 
             return "Error: Could not analyze this section"
         except Exception as e:
             return f"Analysis error: {str(e)}"
 
-    def create_summary(self, all_points: List[str]) -> str:
-        """Create final summary from all points"""
+    def collect_chunk_results(self, futures, progress=None) -> Iterator[str]:
+        """Yield chunk analyses submitted to the worker pool as they finish, in chunk order"""
+        for i, future in enumerate(futures):
+            result = future.result()
+            print(f"Analyzed chunk {i+1}/{len(futures)}")
+            if progress:
+                progress('analyzing', i + 1, len(futures))
+            yield result
+
+    def group_for_summary(self, all_points: List[str]) -> List[List[str]]:
+        """Group points into batches that each fit in one summary prompt, splitting oversized ones"""
+        groups = []
+        current = []
+        current_size = 0
+        pieces = (points[start:start + SUMMARY_MAX_INPUT_CHARS]
+                  for points in all_points
+                  for start in range(0, max(len(points), 1), SUMMARY_MAX_INPUT_CHARS))
+        for points in pieces:
+            if current and current_size + len(points) > SUMMARY_MAX_INPUT_CHARS:
+                groups.append(current)
+                current = []
+                current_size = 0
+            current.append(points)
+            current_size += len(points) + 2
+        if current:
+            groups.append(current)
+        return groups
+
+    def create_summary(self, all_points: List[str], on_token=None) -> str:
+        """Create final summary from all points, map-reducing long documents
+
+        on_token, if given, receives the final summary's tokens as Ollama produces them.
+        """
+        points = all_points
+        size = len("\n\n".join(points))
+        groups = self.group_for_summary(points)
+
+        # Summarize each batch in parallel, then the partial summaries, until they fit in one prompt
+        while len(groups) > 1:
+            futures = [self.executor.submit(self.summarize_points, group) for group in groups]
+            points = [future.result() for future in futures]
+            for summary in points:
+                if is_analysis_error(summary):
+                    return summary
+
+            reduced = len("\n\n".join(points))
+            if reduced >= size:
+                # The partial summaries are not getting shorter; summarize_points truncates what is left
+                print(f"⚠️ Summary reduction stalled at {reduced} characters")
+                break
+            size = reduced
+            groups = self.group_for_summary(points)
+
+        return self.summarize_points(points, on_token)
+
+    def summarize_points(self, all_points: List[str], on_token=None) -> str:
+        """Summarize a batch of points with a single TinyLlama call"""
         combined_points = "\n\n".join(all_points)
+        if len(combined_points) > SUMMARY_MAX_INPUT_CHARS:
+            print(f"⚠️ Summary input truncated from {len(combined_points)} to {SUMMARY_MAX_INPUT_CHARS} characters")
+            combined_points = combined_points[:SUMMARY_MAX_INPUT_CHARS]
 
         prompt = f"""
 Based on these key points from a document, create a brief summary:
@@ -338,70 +504,201 @@ Based on these key points from a document, create a brief summary:
 Summary:"""
 
         try:
-            response = requests.post(
-                self.ollama_url,
-                json={
-                    "model": "tinyllama",
-                    "messages": [{"role": "user", "content": prompt}],
-                    "stream": False
-                },
-                timeout=120
-            )
-
-            if response.status_code == 200:
-                data = response.json()
-                if "message" in data and "content" in data["message"]:
-                    return data["message"]["content"]
+            with admission.slot(priority=BULK):
+                if on_token:
+                    return self.stream_summary(prompt, on_token)
+
+                content = ollama_client.chat([{"role": "user", "content": prompt}], operation='summary')
+            if content is not None:
+                return content
 
             return "Could not create summary"
         except Exception as e:
             return f"Summary error: {str(e)}"
 
-    def analyze_document_full(self, file_path: str) -> dict:
-        """Complete document analysis for PDF or Excel files"""
-        # Determine file type and extract text accordingly
-        if file_path.lower().endswith('.pdf'):
-            text = self.extract_pdf_text(file_path)
-            doc_type = "PDF"
+    def stream_summary(self, prompt: str, on_token) -> str:
+        """Run a summary prompt with Ollama streaming, passing each token to on_token"""
+        response = ollama_client.post_chat([{"role": "user", "content": prompt}], operation='summary', stream=True)
+        try:
+            if response.status_code != 200:
+                return "Could not create summary"
+
+            parts = []
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                line_data = json.loads(line.decode('utf-8'))
+                content = line_data.get('message', {}).get('content')
+                if content:
+                    parts.append(content)
+                    on_token(content)
+                if line_data.get('done', False):
+                    break
+            return "".join(parts) or "Could not create summary"
+        finally:
+            response.close()
+
+    def document_cache_key(self, file_path: str) -> str:
+        """Cache key for a file's content under the current model and prompts"""
+        return analysis_cache.make_key(hash_file(file_path), self.model, ANALYSIS_PROMPT_VERSION)
+
+    def iter_document_pages(self, file_path: str, cached: dict) -> Iterator[str]:
+        """Yield a document's text page by page (the whole text at once for cached or Excel files)"""
+        if 'text' in cached:
+            yield cached['text']
+        elif file_path.lower().endswith('.pdf'):
+            yield from iter_pdf_pages(file_path)
         elif file_path.lower().endswith(('.xlsx', '.xls')):
             text = self.extract_excel_text(file_path)
-            doc_type = "Excel"
+            if text.startswith("Error"):
+                raise ValueError("Could not extract readable text from Excel file")
+            yield text
         else:
+            raise ValueError("Unsupported file type")
+
+    def iter_document_chunks(self, file_path: str, cached: dict, pages: List[str]) -> Iterator[dict]:
+        """Yield a document's chunks as soon as they are ready
+
+        Cached chunks are reused; otherwise pages stream from the extractor into
+        the chunker. Page text is appended to pages so the caller can cache it.
+        """
+        if 'chunks' in cached:
+            pages.append(cached['text'])
+            yield from cached['chunks']
+            return
+
+        def record_pages(source):
+            for page_text in source:
+                pages.append(page_text)
+                yield page_text
+
+        yield from self.iter_chunks(record_pages(self.iter_document_pages(file_path, cached)))
+
+    def prepare_document(self, file_path: str, progress=None) -> dict:
+        """Extract and chunk a document ahead of time so a later analysis skips straight to the LLM"""
+        if progress:
+            progress('extracting')
+
+        cache_key = self.document_cache_key(file_path)
+        cached = analysis_cache.get(cache_key, need='chunks') or {}
+        if 'chunks' in cached:
+            return {"success": True, "chunks": len(cached['chunks']), "cached": True}
+
+        pages = []
+        try:
+            chunks = list(self.iter_document_chunks(file_path, cached, pages))
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+
+        # Kept unstripped so chunk offsets index straight into the cached text
+        text = "\n".join(pages)
+        if len(text.strip()) < 50 or not chunks:
+            return {"success": False, "error": "Could not extract readable text from PDF"}
+
+        analysis_cache.put(cache_key, {"text": text, "chunks": chunks})
+        print(f"Prepared {len(chunks)} chunks for {os.path.basename(file_path)}")
+        return {"success": True, "chunks": len(chunks)}
+
+    def analyze_document_full(self, file_path: str, progress=None, on_event=None) -> dict:
+        """Complete document analysis for PDF or Excel files
+
+        progress, if given, is called as progress(stage, chunks_done, chunks_total).
+        on_event, if given, receives partial output for streaming: a "section"
+        event as each chunk's points arrive, then "summary_start" and one
+        "summary_token" event per token of the final summary.
+        """
+        if not file_path.lower().endswith(('.pdf', '.xlsx', '.xls')):
             return {
                 "success": False,
                 "error": "Unsupported file type"
             }
 
-        if text.startswith("Error") or len(text) < 50:
+        # Reuse earlier work on identical content
+        cache_key = self.document_cache_key(file_path)
+        cached = analysis_cache.get(cache_key, need='summary') or {}
+        if 'summary' in cached:
+            print(f"Analysis cache hit for {os.path.basename(file_path)}")
             return {
-                "success": False,
-                "error": "Could not extract readable text from PDF"
+                "success": True,
+                "chunks_processed": cached['chunks_processed'],
+                "summary": cached['summary'],
+                "detailed_points": cached['points'],
+                "cached": True
             }
 
-        # Split into chunks
-        chunks = self.chunk_text_for_tinyllama(text)
+        if progress:
+            progress('extracting')
 
-        if not chunks:
+        # Stream pages into the chunker and hand each chunk to the worker pool
+        # right away, so analysis of early pages overlaps parsing of later ones
+        pages = []
+        chunks = []
+        futures = []
+
+        try:
+            for chunk in self.iter_document_chunks(file_path, cached, pages):
+                chunks.append(chunk)
+                if ANALYSIS_MAX_CHUNKS <= 0 or len(futures) < ANALYSIS_MAX_CHUNKS:
+                    futures.append(self.executor.submit(self.analyze_with_tinyllama, chunk['text']))
+        except Exception as e:
+            for future in futures:
+                future.cancel()
             return {
                 "success": False,
-                "error": "No content to analyze"
+                "error": f"Error extracting text: {str(e)}"
             }
 
-        # Analyze each chunk (limit to first 3 chunks for speed)
+        text = "\n".join(pages)
+        if len(text.strip()) < 50 or not chunks:
+            for future in futures:
+                future.cancel()
+            return {
+                "success": False,
+                "error": "Could not extract readable text from PDF"
+            }
+
+        if 'chunks' not in cached:
+            analysis_cache.put(cache_key, {"text": text, "chunks": chunks})
+
+        print(f"Analyzing {len(futures)} of {len(chunks)} chunks with {ANALYSIS_WORKERS} workers...")
+
         all_points = []
-        max_chunks = min(3, len(chunks))  # Process max 3 chunks for speed
-        for i, chunk in enumerate(chunks[:max_chunks]):
-            print(f"Analyzing chunk {i+1}/{max_chunks}...")
-            points = self.analyze_with_tinyllama(chunk)
-            if points and not points.startswith("Error"):
+        failed = False
+        if progress:
+            progress('analyzing', 0, len(futures))
+
+        for i, points in enumerate(self.collect_chunk_results(futures, progress)):
+            if is_analysis_error(points):
+                failed = True
+            else:
                 all_points.append(f"Section {i+1}:\n{points}")
+                if on_event:
+                    on_event({"type": "section", "index": i + 1, "points": all_points[-1]})
 
         # Create summary if multiple chunks
+        chunks = chunks[:len(futures)]
         if len(chunks) > 1 and all_points:
-            summary = self.create_summary(all_points)
+            if progress:
+                progress('summarizing', len(futures), len(futures))
+            if on_event:
+                on_event({"type": "summary_start"})
+                summary = self.create_summary(
+                    all_points,
+                    on_token=lambda token: on_event({"type": "summary_token", "content": token})
+                )
+            else:
+                summary = self.create_summary(all_points)
         else:
             summary = all_points[0] if all_points else "No analysis available"
 
+        # Only cache complete results so an Ollama outage is retried next time
+        if not failed and all_points and not is_analysis_error(summary):
+            analysis_cache.put(cache_key, {
+                "chunks_processed": len(chunks),
+                "points": all_points,
+                "summary": summary
+            })
+
         return {
             "success": True,
             "chunks_processed": len(chunks),
@@ -412,6 +709,381 @@ Summary:"""
 # Initialize document analyzer
 document_analyzer = DocumentAnalyzer()
 
+# Retrieval indexes over uploaded documents, used to answer questions about them
+document_indexes = DocumentIndexStore()
+
+# Messages asking for a whole-document summary rather than a specific question
+ANALYSIS_REQUEST_WORDS = ['analyze', 'analyse', 'summary', 'summarize', 'summarise', 'points']
+DOCUMENT_WORDS = ['pdf', 'excel', 'spreadsheet', 'document', 'data']
+
+def upload_owner(file_path):
+    """Uploads live in uploads/<owner_id>/, so the owner is the parent directory"""
+    return os.path.basename(os.path.dirname(file_path))
+
+def index_uploaded_document(file_path):
+    """Build the retrieval index for an upload from its cached text; False if not extracted yet"""
+    cached = analysis_cache.get(document_analyzer.document_cache_key(file_path), need='text') or {}
+    if 'text' not in cached:
+        return False
+    # Smaller chunks than for summarization so several excerpts fit in one prompt
+    chunks = list(iter_token_chunks([cached['text']], RETRIEVAL_CHUNK_TOKENS))
+    document_indexes.add(upload_owner(file_path), os.path.basename(file_path), chunks)
+    return True
+
+def with_indexing(handler):
+    """Wrap a job handler so successfully extracted documents are indexed for retrieval"""
+    def run(file_path, progress=None, **kwargs):
+        result = handler(file_path, progress=progress, **kwargs)
+        if result['success']:
+            index_uploaded_document(file_path)
+        return result
+    return run
+
+def find_document_context(owner_id, question):
+    """Return the chunks of the owner's documents most relevant to the question.
+
+    owner_id is the signed-in user or the session's guest id; nobody else's
+    uploads are searched. Only documents already indexed are searched.
+    Indexes are built when an upload's extraction or analysis job succeeds
+    (see with_indexing), so the chat path never hashes or reads files.
+    Unless the question mentions a document or one of the file names, only
+    a strong match (RETRIEVAL_CONFIDENT_SCORE) counts, so general questions
+    are not answered from the uploads.
+    """
+    if not owner_id:
+        return []
+    documents = [(owner_id, filename) for filename in uploaded_files.get(owner_id, {})
+                 if document_indexes.get(owner_id, filename) is not None]
+    if not documents:
+        return []
+
+    question_lower = question.lower()
+    about_documents = (any(word in question_lower for word in DOCUMENT_WORDS)
+                       or any(os.path.splitext(filename)[0].lower() in question_lower for _, filename in documents))
+    min_score = RETRIEVAL_MIN_SCORE if about_documents else RETRIEVAL_CONFIDENT_SCORE
+    return document_indexes.search(documents, question, min_score=min_score)
+
+def build_document_messages(question, hits):
+    """Chat messages that answer a question from retrieved document excerpts only"""
+    excerpts = "\n\n".join(f"[{i+1}] ({hit['filename']}) {hit['text']}" for i, hit in enumerate(hits))
+    return [
+        {
+            "role": "system",
+            "content": "Answer the user's question using only these excerpts from their uploaded documents. "
+                       "If the answer is not in the excerpts, say so.\n\n" + excerpts
+        },
+        {"role": "user", "content": question}
+    ]
+
+# Background analysis jobs, queued at upload time and polled through /api/jobs
+analysis_jobs = AnalysisJobQueue(with_indexing(document_analyzer.analyze_document_full),
+                                 with_indexing(document_analyzer.prepare_document))
+
+def start_upload_job(user_id, filename, file_path):
+    """Start eager pre-analysis of a new upload according to EAGER_ANALYSIS"""
+    if EAGER_ANALYSIS == 'full':
+        return analysis_jobs.submit(user_id, filename, file_path, kind='analyze')
+    if EAGER_ANALYSIS == 'extract':
+        return analysis_jobs.submit(user_id, filename, file_path, kind='prepare')
+    return None
+
+def can_access_job(job, user_id):
+    """Jobs are visible to their owner; guest uploads are shared like guest files in chat"""
+    return job.user_id == user_id or job.user_id.startswith('guest_')
+
+def format_analysis_reply(filename, result):
+    """Build the chat reply for a finished document analysis"""
+    if not result['success']:
+        return f"❌ Could not analyze PDF: {result['error']}"
+
+    # Determine document type for response
+    doc_icon = "📄" if filename.lower().endswith('.pdf') else "📊"
+    doc_type = "PDF" if filename.lower().endswith('.pdf') else "Excel"
+    return f"""{doc_icon} {doc_type} Analysis Complete for "{filename}"
+
+🔍 Summary:
+{result['summary']}
+
+📊 Processed {result['chunks_processed']} sections of the document.
+
+💡 You can ask me specific questions about the content!"""
+
+def analysis_is_incomplete(result):
+    """Check if a finished analysis should be redone on the next request"""
+    return not result['success'] or not result['detailed_points'] or is_analysis_error(result['summary'])
+
+class AnalysisStream:
+    """Turn a job's analysis events into SSE frames (shared by the WSGI and ASGI servers)"""
+
+    def __init__(self, job, filename, file_info):
+        self.job = job
+        self.filename = filename
+        self.file_info = file_info
+        self.sent = []
+        self.saw_events = False
+        self.summary_started = False
+        self.summary_streamed = False
+
+    def content_frame(self, content):
+        self.sent.append(content)
+        return sse_frame({'content': content})
+
+    def start_frames(self):
+        doc_icon = "📄" if self.filename.lower().endswith('.pdf') else "📊"
+        doc_type = "PDF" if self.filename.lower().endswith('.pdf') else "Excel"
+        return [self.content_frame(f"{doc_icon} {doc_type} Analysis for \"{self.filename}\"\n\n")]
+
+    def event_frames(self, event):
+        self.saw_events = True
+        if event['type'] == 'section':
+            return [self.content_frame(f"{event['points']}\n\n")]
+        if event['type'] == 'summary_start':
+            self.summary_started = True
+            return [self.content_frame("🔍 Summary:\n")]
+        if event['type'] == 'summary_token':
+            self.summary_streamed = True
+            return [self.content_frame(event['content'])]
+        return []
+
+    def end_frames(self):
+        """Frames once the job has finished"""
+        job = self.job
+        if job.status == 'failed':
+            print(f"PDF analysis error: {job.error}")
+            # Forget the failed job so the next request retries
+            self.file_info.pop('job_id', None)
+            return [sse_frame({'error': format_analysis_error(job.error), 'job_id': job.id})]
+
+        result = job.result
+        if analysis_is_incomplete(result):
+            # Incomplete (e.g. Ollama was down); analyze again next time
+            self.file_info.pop('job_id', None)
+
+        frames = []
+        if not self.saw_events or not result['success']:
+            # Cached or failed analysis: nothing was streamed, send the whole reply
+            frames.append(self.content_frame(format_analysis_reply(self.filename, result)))
+        else:
+            if not self.summary_streamed and self.summary_started:
+                frames.append(self.content_frame(result['summary']))
+            frames.append(self.content_frame(
+                f"\n\n📊 Processed {result['chunks_processed']} sections of the document.\n\n"
+                "💡 You can ask me specific questions about the content!"
+            ))
+
+        frames.append(sse_frame({'done': True, 'full_content': ''.join(self.sent), 'job_id': job.id}))
+        return frames
+
+def generate_analysis_stream(job, filename, file_info):
+    """Stream a document analysis as it runs: section points as chunks finish, then summary tokens"""
+    stream = AnalysisStream(job, filename, file_info)
+    try:
+        yield from stream.start_frames()
+        for event in job.iter_events():
+            yield from stream.event_frames(event)
+        yield from stream.end_frames()
+    except Exception as e:
+        print(f"Streaming error: {e}")
+        yield sse_frame({'error': str(e)})
+
+def find_latest_upload(user_id):
+    """Return (filename, file_info) of the newest upload the user can analyze, or None"""
+    # Check for uploaded files (works for both authenticated and guest users)
+    all_user_files = {}
+
+    # If authenticated, check their files
+    if user_id:
+        all_user_files.update(uploaded_files.get(user_id, {}))
+
+    # Also check for guest files in this session
+    for uid, files in uploaded_files.items():
+        if uid.startswith('guest_'):
+            all_user_files.update(files)
+
+    if not all_user_files:
+        return None
+    return max(all_user_files.items(), key=lambda x: x[1]['upload_time'])
+
+def get_analysis_job(filename, file_info):
+    """Return the upload's analysis job, queuing one if it has not been analyzed yet"""
+    job = analysis_jobs.get(file_info.get('job_id'))
+    if job is None or job.kind == 'prepare':
+        # Summarization reuses any extraction already done (or in progress) at upload
+        file_path = file_info['path']
+        job = analysis_jobs.submit(upload_owner(file_path), filename, file_path, after=job)
+        file_info['job_id'] = job.id
+    return job
+
+def analysis_status_reply(job, filename, file_info):
+    """Non-streaming chat reply for an analysis job: its result, error or progress"""
+    if job.status == 'completed':
+        result = job.result
+        if analysis_is_incomplete(result):
+            # Incomplete (e.g. Ollama was down); analyze again next time
+            file_info.pop('job_id', None)
+        return {"reply": format_analysis_reply(filename, result), "job_id": job.id}
+
+    if job.status == 'failed':
+        print(f"PDF analysis error: {job.error}")
+        # Forget the failed job so the next request retries
+        file_info.pop('job_id', None)
+        return {"reply": format_analysis_error(job.error), "job_id": job.id}
+
+    if job.chunks_total:
+        progress_text = f"{job.chunks_done}/{job.chunks_total} sections analyzed"
+    else:
+        progress_text = "extracting text"
+    return {
+        "reply": f"⏳ Still analyzing \"{filename}\" ({progress_text}). Ask me again in a moment for the summary.",
+        "job_id": job.id
+    }
+
+ALLOWED_UPLOAD_EXTENSIONS = ['.pdf', '.xlsx', '.xls']
+
+def upload_path(user_id, filename):
+    """Secure the filename and return (filename, path) in the user's uploads directory"""
+    # Create user-specific uploads directory
+    upload_dir = os.path.join('uploads', user_id)
+    if not os.path.exists(upload_dir):
+        os.makedirs(upload_dir)
+
+    filename = secure_filename(filename)
+    return filename, os.path.join(upload_dir, filename)
+
+def register_upload(user, user_id, filename, file_path):
+    """Record a saved upload, start its background job and build the upload response"""
+    # A re-upload under the same name replaces the old content
+    document_indexes.remove(user_id, filename)
+
+    # Initialize user files storage if not exists
+    if user_id not in uploaded_files:
+        uploaded_files[user_id] = {}
+
+    # Start extraction (and optionally analysis) in the background right away
+    job = start_upload_job(user_id, filename, file_path)
+
+    # Store file info for this user
+    uploaded_files[user_id][filename] = {
+        'path': file_path,
+        'upload_time': datetime.now().isoformat(),
+        'size': os.path.getsize(file_path),
+        'job_id': job.id if job else None
+    }
+
+    # Different messages for authenticated vs guest users
+    if user:
+        print(f"File uploaded by {user['username']}: {filename} ({uploaded_files[user_id][filename]['size']} bytes)")
+        message = f"✅ PDF uploaded successfully! Now you can ask me to 'analyze the PDF' or ask questions about it."
+    else:
+        print(f"File uploaded by guest {user_id}: {filename} ({uploaded_files[user_id][filename]['size']} bytes)")
+        message = f"✅ PDF uploaded successfully! You can analyze it in this session. For persistent file storage, please log in."
+
+    return {
+        "filename": filename,
+        "message": message,
+        "size": uploaded_files[user_id][filename]['size'],
+        "job_id": job.id if job else None
+    }
+
+def admission_key(user_id, remote_addr):
+    """Whose concurrency allowance a chat counts against: the user, or the client address for guests"""
+    return user_id or f"addr:{remote_addr}"
+
+def busy_reply(rejection):
+    """Reply body for a chat that was not admitted (sent with status 429)"""
+    if rejection.reason == 'user_limit':
+        reply = "⏳ You already have replies in progress. Please wait for them to finish."
+    elif rejection.queue_position:
+        reply = (f"⏳ The assistant is busy right now (you were #{rejection.queue_position} in line). "
+                 f"Please try again in about {rejection.retry_after:.0f} seconds.")
+    else:
+        reply = "⏳ The assistant is busy right now. Please try again in a moment."
+    return {
+        "reply": reply,
+        "error": "busy",
+        "reason": rejection.reason,
+        "queue_position": rejection.queue_position,
+        "retry_after": rejection.retry_after
+    }
+
+NO_UPLOADS_REPLY = "📁 No documents uploaded yet. Please upload a PDF or Excel file first, then ask me to analyze it."
+
+def summarize_conversation(summary, turns, max_words):
+    """Fold older chat turns into a conversation's running summary (runs in the background)"""
+    transcript = "\n".join(f"{turn['role'].capitalize()}: {turn['content']}" for turn in turns)
+    prompt = f"""Update the summary of this conversation between a user and an assistant.
+Keep the facts, names, numbers and open questions that later replies may need, in at most {max_words} words.
+
+Summary so far: {summary or "(none)"}
+
+New turns:
+{transcript}
+
+Updated summary:"""
+    with admission.slot(priority=BULK):
+        return ollama_client.chat([{"role": "user", "content": prompt}], operation='summary')
+
+# Earlier turns of each conversation, fitted into the prompt under a token budget
+conversation_context = ConversationContext(summarize_conversation)
+
+def get_chat_history(user_id, chat_id, start=0):
+    """Stored messages of one of the user's chats from index start on, oldest first, as (messages, offset).
+
+    Long chats return only their latest CHAT_HISTORY_MESSAGES; offset is the index of the first one returned.
+    """
+    if not user_id or not chat_id:
+        return [], 0
+    if USE_DATABASE:
+        messages, offset = get_recent_chat_messages_from_db(user_id, chat_id, start, CHAT_HISTORY_MESSAGES)
+        return messages or [], offset
+    with users_db.user_lock(user_id):
+        user = users_db.get(user_id)
+        if user is None:
+            return [], 0
+        chat = user.get('chat_history', {}).get(str(chat_id))
+        messages = chat.get('messages', []) if chat else []
+        if start > len(messages):
+            start = 0  # messages were removed since; the caller starts over
+        offset = max(start, len(messages) - CHAT_HISTORY_MESSAGES)
+        return messages[offset:], offset
+
+def plan_chat(user_id, user_message, chat_id=None, guest_id=None):
+    """Decide how to answer a chat message.
+
+    Documents are searched for the user, or for guest_id (the session's
+    guest uploads) when nobody is signed in. Returns ('analysis', None) for whole-document requests, otherwise
+    ('chat', messages) with any retrieved document excerpts and the
+    conversation's earlier turns included.
+    """
+    # Questions about uploaded documents are answered from the most relevant chunks;
+    # summary requests (or document questions with nothing indexed yet) run the full analysis
+    message_lower = user_message.lower()
+    wants_analysis = any(word in message_lower for word in ANALYSIS_REQUEST_WORDS)
+    document_context = [] if wants_analysis else find_document_context(user_id or guest_id, user_message)
+    if wants_analysis or (not document_context and any(word in message_lower for word in DOCUMENT_WORDS)):
+        return 'analysis', None
+
+    if document_context:
+        print(f"Answering from {len(document_context)} document excerpts")
+        messages = build_document_messages(user_message, document_context)
+    else:
+        messages = [{"role": "user", "content": user_message}]
+
+    key = (user_id, str(chat_id))
+    history, offset = get_chat_history(user_id, chat_id, conversation_context.history_start(key))
+    if history:
+        messages = conversation_context.build(key, history, messages, offset)
+    return 'chat', messages
+
+def format_analysis_error(error):
+    """Build the chat reply for an analysis that raised"""
+    if "timeout" in error.lower():
+        return f"⏱️ PDF analysis timed out. The document might be too large or Ollama is slow. Try:\n1. Restart Ollama: `ollama serve`\n2. Use a smaller PDF\n3. Try again in a moment"
+    elif "connection" in error.lower():
+        return f"🔌 Cannot connect to Ollama. Please:\n1. Start Ollama: `ollama serve`\n2. Run: `ollama run tinyllama`\n3. Try uploading again"
+    else:
+        return f"❌ Error analyzing PDF: {error}"
+
 # Authentication Routes
 @app.route('/login')
 def login_page():
@@ -446,31 +1118,14 @@ def signup():
         print(f"Request content type: {request.content_type}")
         print(f"Raw request data: {request.data}")
 
-        # Simple validation for signup
-        if not data.get('email') or not data.get('username') or not data.get('password'):
-            print("Signup failed: Missing required fields")
-            return jsonify({"success": False, "message": "Please fill in all fields"}), 400
-
-        # Basic email validation
-        email = data['email'].strip().lower()
-        if '@' not in email or '.' not in email:
-            print("Signup failed: Invalid email format")
-            return jsonify({"success": False, "message": "Please enter a valid email address"}), 400
-
-        # Basic password validation
-        password = data['password']
-        if len(password) < 6:
-            print("Signup failed: Password too short")
-            return jsonify({"success": False, "message": "Password must be at least 6 characters"}), 400
-
-        username = data['username'].strip()
+        error, email, username, password = check_signup_data(data)
+        if error:
+            return jsonify({"success": False, "message": error}), 400
 
         # Check if user already exists
-        for user_id, user in users_db.items():
-            if user['email'] == email:
-                return jsonify({"success": False, "message": "Email already registered"}), 400
-            if user['username'] == username:
-                return jsonify({"success": False, "message": "Username already taken"}), 400
+        taken = find_taken_account(email, username)
+        if taken:
+            return jsonify({"success": False, "message": taken}), 400
 
         # Create new user
         user_id = secrets.token_hex(16)
@@ -481,25 +1136,13 @@ def signup():
             if not success:
                 return jsonify({"success": False, "message": message}), 400
 
+            user_directory.add(user_id, email, username)
             print(f"New user registered in PostgreSQL: {username} ({email}) with ID: {user_id}")
         else:
             # Fallback to file storage
-            user_data = {
-                'id': user_id,
-                'email': email,
-                'username': username,
-                'password_hash': generate_password_hash(password),
-                'created_at': datetime.now().isoformat(),
-                'chat_history': {}
-            }
-
-            # Save to memory
-            users_db[user_id] = user_data
-
-            # Save to file (persistent storage)
-            save_user_to_file(user_id, user_data)
-
-            print(f"New user registered in files: {username} ({email}) with ID: {user_id}")
+            taken = create_file_user(user_id, email, username, password)
+            if taken:
+                return jsonify({"success": False, "message": taken}), 400
 
         # Initialize user's uploaded files storage
         uploaded_files[user_id] = {}
@@ -507,11 +1150,7 @@ def signup():
         return jsonify({
             "success": True,
             "message": "Account created successfully! You can now sign in.",
-            "user": {
-                "id": user_id,
-                "username": username,
-                "email": email
-            }
+            "user": {"id": user_id, "username": username, "email": email}
         })
 
     except Exception as e:
@@ -555,21 +1194,16 @@ def login():
         print(f"Looking for user with email/username: {email_or_username}")
 
         if USE_DATABASE:
-            # Try to find user in PostgreSQL database
-            user = get_user_from_db(email=email_or_username)
+            # Try to find user in PostgreSQL database (by email or username)
+            user = find_db_user(email_or_username)
             if user:
                 user_id = user['id']
                 print(f"Found user in PostgreSQL: {user['username']}")
         else:
             # Fallback to file storage
-            print(f"Current users in database: {list(users_db.keys())}")
-            for uid, u in users_db.items():
-                print(f"Checking user: {u['email']} / {u['username']}")
-                if u['email'] == email_or_username or u['username'] == email_or_username:
-                    user = u
-                    user_id = uid
-                    print(f"Found matching user: {u['username']}")
-                    break
+            user = find_file_user(email_or_username)
+            if user:
+                user_id = user['id']
 
         if not user:
             print("No user found with that email/username")
@@ -587,11 +1221,7 @@ def login():
         return jsonify({
             "success": True,
             "message": "Login successful!",
-            "user": {
-                "id": user_id,
-                "username": user['username'],
-                "email": user['email']
-            }
+            "user": public_user(user_id, user)
         })
 
     except Exception as e:
@@ -618,11 +1248,7 @@ def check_auth():
     if user:
         return jsonify({
             "authenticated": True,
-            "user": {
-                "id": user['id'],
-                "username": user['username'],
-                "email": user['email']
-            }
+            "user": public_user(user['id'], user)
         })
     else:
         return jsonify({"authenticated": False}), 401
@@ -652,13 +1278,64 @@ def debug_users():
         "users": [
             {
                 "id": user_id,
-                "email": user['email'],
-                "username": user['username']
+                "email": entry['email'],
+                "username": entry['username']
             }
-            for user_id, user in users_db.items()
-        ]
+            for user_id, entry in users_db.entries()
+        ],
+        "cache": user_cache.stats() if USE_DATABASE else users_db.stats(),
+        "journal": user_journal.stats()
     })
 
+@app.route('/api/debug/database', methods=['GET'])
+def debug_database():
+    """Debug endpoint to check database connection pool usage and contention"""
+    if not USE_DATABASE:
+        return jsonify({"enabled": False})
+    return jsonify({"enabled": True, **database_stats()})
+
+@app.route('/api/debug/ollama', methods=['GET'])
+def debug_ollama():
+    """Debug endpoint to check Ollama backends, client pool and streaming state"""
+    return jsonify({**ollama_client.stats(), "streams": stream_totals.stats()})
+
+@app.route('/api/debug/ollama/drain', methods=['POST'])
+def debug_ollama_drain():
+    """Stop routing new calls to an Ollama backend ({"url": ...}), or resume it with "resume": true.
+
+    Disabled unless ADMIN_TOKEN is set; the request must send it in the X-Admin-Token header.
+    """
+    if not ADMIN_TOKEN:
+        return jsonify({"success": False, "message": "Not found"}), 404
+    if not secrets.compare_digest(request.headers.get('X-Admin-Token', ''), ADMIN_TOKEN):
+        return jsonify({"success": False, "message": "Admin token required"}), 403
+
+    data = request.get_json() or {}
+    backend = ollama_backends.drain(data.get('url', ''), draining=not data.get('resume', False))
+    if backend is None:
+        return jsonify({"success": False, "message": "Unknown Ollama backend"}), 404
+    return jsonify({"success": True, "backend": backend})
+
+@app.route('/api/debug/admission', methods=['GET'])
+def debug_admission():
+    """Debug endpoint to check Ollama admission control: load, queue and rejections"""
+    return jsonify(admission.stats())
+
+@app.route('/api/debug/response-cache', methods=['GET'])
+def debug_response_cache():
+    """Debug endpoint to check the chat reply cache"""
+    return jsonify(response_cache.stats())
+
+@app.route('/api/debug/conversations', methods=['GET'])
+def debug_conversations():
+    """Debug endpoint to check conversation context summaries"""
+    return jsonify(conversation_context.stats())
+
+@app.route('/api/debug/analysis-cache', methods=['GET'])
+def debug_analysis_cache():
+    """Debug endpoint to check document analysis cache hit/miss counters"""
+    return jsonify(analysis_cache.stats())
+
 @app.route('/api/test', methods=['GET', 'POST'])
 def test_endpoint():
     """Simple test endpoint to verify backend connectivity"""
@@ -764,115 +1441,66 @@ def chat():
     else:
         print(f"Received message from guest: {user_message} (stream: {stream_response})")
 
-    # Check if user is asking about document analysis (PDF or Excel)
-    message_lower = user_message.lower()
-    if any(word in message_lower for word in ['analyze', 'pdf', 'excel', 'spreadsheet', 'document', 'summary', 'points', 'data']):
-        # Check for uploaded files (works for both authenticated and guest users)
-        all_user_files = {}
-
-        # If authenticated, check their files
-        if user_id:
-            all_user_files.update(uploaded_files.get(user_id, {}))
-
-        # Also check for guest files in this session
-        for uid, files in uploaded_files.items():
-            if uid.startswith('guest_'):
-                all_user_files.update(files)
-
-        if all_user_files:
-            # Get the most recently uploaded file
-            latest_file = max(all_user_files.items(), key=lambda x: x[1]['upload_time'])
-            file_path = latest_file[1]['path']
-            filename = latest_file[0]
-
-            print(f"Analyzing PDF: {filename}")
-
-            try:
-                result = document_analyzer.analyze_document_full(file_path)
-
-                if result['success']:
-                    # Determine document type for response
-                    doc_icon = "📄" if filename.lower().endswith('.pdf') else "📊"
-                    doc_type = "PDF" if filename.lower().endswith('.pdf') else "Excel"
-                    response_text = f"""{doc_icon} {doc_type} Analysis Complete for "{filename}"
-
-🔍 Summary:
-{result['summary']}
-
-📊 Processed {result['chunks_processed']} sections of the document.
-
-💡 You can ask me specific questions about the content!"""
-
-                    return jsonify({"reply": response_text})
-                else:
-                    return jsonify({"reply": f"❌ Could not analyze PDF: {result['error']}"})
-
-            except Exception as e:
-                print(f"PDF analysis error: {e}")
-                if "timeout" in str(e).lower():
-                    return jsonify({"reply": f"⏱️ PDF analysis timed out. The document might be too large or Ollama is slow. Try:\n1. Restart Ollama: `ollama serve`\n2. Use a smaller PDF\n3. Try again in a moment"})
-                elif "connection" in str(e).lower():
-                    return jsonify({"reply": f"🔌 Cannot connect to Ollama. Please:\n1. Start Ollama: `ollama serve`\n2. Run: `ollama run tinyllama`\n3. Try uploading again"})
-                else:
-                    return jsonify({"reply": f"❌ Error analyzing PDF: {str(e)}"})
-        else:
-            return jsonify({"reply": "📁 No documents uploaded yet. Please upload a PDF or Excel file first, then ask me to analyze it."})
+    mode, messages = plan_chat(user_id, user_message, data.get('chat_id'), session.get('guest_id'))
+    if mode == 'analysis':
+        latest_upload = find_latest_upload(user_id)
+        if not latest_upload:
+            return jsonify({"reply": NO_UPLOADS_REPLY})
+
+        # Analysis runs in the background; report progress instead of blocking
+        filename, file_info = latest_upload
+        job = get_analysis_job(filename, file_info)
+
+        if stream_response and job.status != 'failed':
+            # Stream sections and summary tokens as the job produces them; a client
+            # that disconnects only stops listening, the job keeps running
+            return sse_response(with_heartbeats(generate_analysis_stream(job, filename, file_info)))
+
+        return jsonify(analysis_status_reply(job, filename, file_info))
+
+    # Repeated deterministic questions are answered without calling Ollama at all
+    options = chat_options(data)
+    cacheable = use_response_cache(stream_response, options)
+    if cacheable:
+        cached = response_cache.get(ollama_client.model, messages, options)
+        if cached:
+            reply, match = cached
+            print(f"Response cache hit ({match})")
+            return jsonify({"reply": reply, "cached": match})
+
+    # Regular chat with TinyLlama, admitted ahead of any queued document analysis
+    client_key = admission_key(user_id, request.remote_addr)
+    try:
+        ticket = admission.acquire(client_key, INTERACTIVE)
+    except AdmissionRejected as e:
+        print(f"Chat not admitted ({e.reason}, queue position {e.queue_position})")
+        return jsonify(busy_reply(e)), 429, {'Retry-After': str(int(e.retry_after + 0.5))}
 
-    # Regular chat with TinyLlama
     try:
-        # Connect to Ollama's API running locally
-        response = requests.post(
-            'http://localhost:11434/api/chat',
-            json={
-                "model": "tinyllama",
-                "messages": [{"role": "user", "content": user_message}],
-                "stream": stream_response
-            },
-            timeout=30,
-            stream=stream_response
-        )
-
-        if response.status_code != 200:
-            print(f"Ollama API error: {response.status_code} - {response.text}")
-            raise requests.exceptions.ConnectionError("Ollama not responding")
-
-        # Handle streaming vs non-streaming responses
+        # Connect to the least busy Ollama backend (pooled, with failover and circuit breakers),
+        # preferring the one this user was on; identical requests already in flight share that generation
         if stream_response:
-            # Return streaming response
-            def generate_stream():
-                try:
-                    full_content = ""
-                    for line in response.iter_lines():
-                        if line:
-                            line_data = json.loads(line.decode('utf-8'))
-                            if 'message' in line_data and 'content' in line_data['message']:
-                                content = line_data['message']['content']
-                                full_content += content
-                                yield f"data: {json.dumps({'content': content})}\n\n"
-
-                            # Check if this is the final message
-                            if line_data.get('done', False):
-                                yield f"data: {json.dumps({'done': True, 'full_content': full_content})}\n\n"
-                                break
-                except Exception as e:
-                    print(f"Streaming error: {e}")
-                    yield f"data: {json.dumps({'error': str(e)})}\n\n"
-
-            return Response(generate_stream(),
-                          mimetype='text/plain',
-                          headers={'Cache-Control': 'no-cache',
-                                 'Connection': 'keep-alive',
-                                 'Access-Control-Allow-Origin': '*'})
+            response = ollama_client.open_chat_stream(messages, operation='chat', options=options, affinity=client_key)
+
+            if response.status_code != 200:
+                print(f"Ollama API error: {response.status_code} - {response.text}")
+                response.close()
+                raise requests.exceptions.ConnectionError("Ollama not responding")
+
+            # Relay tokens as server-sent events; a client disconnect closes the
+            # Ollama response so the abandoned generation stops right away
+            streamed = sse_response(stream_ollama_chat(response))
+            # Hand the slot back when the response is closed, not when this function returns
+            stream_ticket, ticket = ticket, None
+            streamed.call_on_close(lambda: admission.release(stream_ticket))
+            return streamed
         else:
-            # Handle non-streaming response
-            response_data = response.json()
-            print(f"OLLAMA response: {json.dumps(response_data, indent=2)}")
-
-            # Extract the assistant's reply from Ollama response
-            if "message" in response_data and "content" in response_data["message"]:
-                reply = response_data["message"]["content"]
-            else:
-                reply = "No response from AI model"
+            reply = ollama_client.chat(messages, operation='chat', options=options, affinity=client_key)
+            if reply is None:
+                raise requests.exceptions.ConnectionError("Ollama not responding")
+            print(f"OLLAMA reply: {reply[:200]}")
+            if cacheable:
+                response_cache.put(ollama_client.model, messages, options, reply)
 
             return jsonify({"reply": reply})
 
@@ -893,6 +1521,10 @@ def chat():
         print(f"ERROR: {str(e)}")
         return jsonify({"reply": f"AI backend error: {str(e)}"})
 
+    finally:
+        if ticket is not None:
+            admission.release(ticket)
+
 @app.route('/api/upload', methods=['POST'])
 def upload_file():
     try:
@@ -900,9 +1532,10 @@ def upload_file():
         user_id = session.get('user_id')
         user = get_current_user()
 
-        # Create a guest user ID if not authenticated
+        # Guests keep one ID per session, so chat can find their own uploads
         if not user_id:
-            user_id = f"guest_{secrets.token_hex(8)}"
+            user_id = session.get('guest_id') or f"guest_{secrets.token_hex(8)}"
+            session['guest_id'] = user_id
             print(f"Guest upload with ID: {user_id}")
 
         if 'file' not in request.files:
@@ -913,44 +1546,14 @@ def upload_file():
             return jsonify({"error": "No file selected"}), 400
 
         # Check file type
-        allowed_extensions = ['.pdf', '.xlsx', '.xls']
-        if not any(file.filename.lower().endswith(ext) for ext in allowed_extensions):
+        if not any(file.filename.lower().endswith(ext) for ext in ALLOWED_UPLOAD_EXTENSIONS):
             return jsonify({"error": "Only PDF and Excel files (.pdf, .xlsx, .xls) are supported"}), 400
 
-        # Create user-specific uploads directory
-        upload_dir = os.path.join('uploads', user_id)
-        if not os.path.exists(upload_dir):
-            os.makedirs(upload_dir)
-
         # Secure the filename and save the file
-        filename = secure_filename(file.filename)
-        file_path = os.path.join(upload_dir, filename)
+        filename, file_path = upload_path(user_id, file.filename)
         file.save(file_path)
 
-        # Initialize user files storage if not exists
-        if user_id not in uploaded_files:
-            uploaded_files[user_id] = {}
-
-        # Store file info for this user
-        uploaded_files[user_id][filename] = {
-            'path': file_path,
-            'upload_time': datetime.now().isoformat(),
-            'size': os.path.getsize(file_path)
-        }
-
-        # Different messages for authenticated vs guest users
-        if user:
-            print(f"File uploaded by {user['username']}: {filename} ({uploaded_files[user_id][filename]['size']} bytes)")
-            message = f"✅ PDF uploaded successfully! Now you can ask me to 'analyze the PDF' or ask questions about it."
-        else:
-            print(f"File uploaded by guest {user_id}: {filename} ({uploaded_files[user_id][filename]['size']} bytes)")
-            message = f"✅ PDF uploaded successfully! You can analyze it in this session. For persistent file storage, please log in."
-
-        return jsonify({
-            "filename": filename,
-            "message": message,
-            "size": uploaded_files[user_id][filename]['size']
-        })
+        return jsonify(register_upload(user, user_id, filename, file_path))
 
     except Exception as e:
         print(f"Upload error: {str(e)}")
@@ -974,16 +1577,184 @@ def list_files():
         ]
     })
 
+@app.route('/api/jobs', methods=['GET'])
+def list_jobs():
+    """List document analysis jobs visible to the current user"""
+    user_id = session.get('user_id')
+    jobs = analysis_jobs.list_jobs(lambda job: can_access_job(job, user_id))
+
+    return jsonify({
+        "jobs": [
+            {key: value for key, value in job.to_dict().items() if key != 'result'}
+            for job in jobs
+        ]
+    })
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Report status, per-chunk progress and (when done) the result of an analysis job"""
+    job = analysis_jobs.get(job_id)
+    if not job or not can_access_job(job, session.get('user_id')):
+        return jsonify({"error": "Job not found"}), 404
+
+    return jsonify(job.to_dict())
+
+CHATS_PAGE_MAX = 200
+
+def page_args():
+    """limit and before (cursor) query parameters; no limit means everything"""
+    limit = request.args.get('limit', type=int)
+    if limit is not None:
+        limit = max(1, min(limit, CHATS_PAGE_MAX))
+    return limit, request.args.get('before') or None
+
+def paginate_list(items, limit, before):
+    """File-mode paging over an in-memory list; the cursor is an offset"""
+    start = int(before) if before and before.isdigit() else 0
+    end = start + limit if limit else len(items)
+    return items[start:end], (str(end) if end < len(items) else None)
+
+def apply_file_chat_changes(user, changes, deleted):
+    """Apply a delta sync to a file-mode user record; returns (versions by chat id, new version).
+
+    Every sync bumps the user's change counter; changed chats and the
+    messages they add are stamped with it, and deleted chats leave a
+    tombstone, so /api/user/chats?since=N can return just what changed.
+    """
+    history = user.setdefault('chat_history', {})
+    sync = user.setdefault('chat_sync', {'version': 0, 'deleted': {}})
+    sync['version'] += 1
+    version = sync['version']
+    now = datetime.now().isoformat()
+
+    versions = {}
+    for change in changes:
+        chat_id = str(change.get('id'))
+        chat = history.get(chat_id)
+        if chat is None:
+            chat = history[chat_id] = {
+                'id': chat_id,
+                'title': 'New Chat',
+                'messages': [],
+                'createdAt': change.get('createdAt') or now
+            }
+        known = {message.get('id') for message in chat['messages']}
+        for message in change.get('messages', []):
+            if message.get('id') not in known:
+                known.add(message.get('id'))
+                chat['messages'].append({**message, 'version': version})
+        chat['title'] = change.get('title') or chat['title']
+        chat['updatedAt'] = change.get('updatedAt') or now
+        chat['version'] = version
+        sync['deleted'].pop(chat_id, None)
+        versions[chat_id] = version
+
+    for chat_id in map(str, deleted):
+        if history.pop(chat_id, None) is not None:
+            sync['deleted'][chat_id] = version
+    return versions, version
+
+def file_chat_changes(user, since):
+    """File-mode counterpart of get_chat_changes_from_db"""
+    history = user.get('chat_history', {})
+    sync = user.get('chat_sync', {'version': 0, 'deleted': {}})
+    chats = {}
+    for chat_id, chat in history.items():
+        if since > 0 and chat.get('version', 0) <= since:
+            continue
+        messages = [message for message in chat.get('messages', [])
+                    if since <= 0 or message.get('version', 0) > since]
+        chats[chat_id] = {**chat, 'messages': messages}
+    deleted = [chat_id for chat_id, version in sync['deleted'].items() if version > since]
+    return chats, deleted, sync['version']
+
 @app.route('/api/user/chats', methods=['GET'])
 @require_auth
 def get_user_chats():
-    """Get user's chat history"""
-    user = get_current_user()
+    """Get user's chat history, most recently updated first (?limit=N&before=cursor to page).
 
-    if user and 'chat_history' in user:
-        return jsonify({"chats": user['chat_history']})
+    With ?since=<cursor> only chats changed after that cursor are returned,
+    each with just its new messages, plus the ids of deleted chats and the
+    cursor to pass next time (since=0 returns everything).
+    """
+    user_id = session.get('user_id')
+    since = request.args.get('since', type=int)
+    if since is not None:
+        if USE_DATABASE:
+            changes = get_chat_changes_from_db(user_id, since)
+            if changes is None:
+                return jsonify({"error": "Failed to load chats"}), 500
+            chats, deleted, cursor = changes
+            return jsonify({"chats": chats, "deleted": deleted, "cursor": cursor})
+
+        # Serialized under the user's lock: a concurrent sync may be changing these chats
+        with users_db.user_lock(user_id):
+            user = get_current_user()
+            chats, deleted, cursor = file_chat_changes(user, since) if user else ({}, [], 0)
+            return jsonify({"chats": chats, "deleted": deleted, "cursor": cursor})
+
+    limit, before = page_args()
+
+    if USE_DATABASE:
+        chats, next_cursor = get_chat_history_from_db(user_id, limit, before)
+        return jsonify({"chats": chats, "next_cursor": next_cursor})
+
+    # Serialized under the user's lock: a concurrent sync may be changing these chats
+    with users_db.user_lock(user_id):
+        user = get_current_user()
+        history = user.get('chat_history', {}) if user else {}
+        chat_ids = sorted(history, key=lambda chat_id: history[chat_id].get('updatedAt', ''), reverse=True)
+        page, next_cursor = paginate_list(chat_ids, limit, before)
+        return jsonify({"chats": {chat_id: history[chat_id] for chat_id in page}, "next_cursor": next_cursor})
+
+@app.route('/api/user/chats/<chat_id>/messages', methods=['GET'])
+@require_auth
+def get_user_chat_messages(chat_id):
+    """Get one chat's messages, newest page first (?limit=N&before=cursor for older ones)"""
+    user_id = session.get('user_id')
+    limit, before = page_args()
+
+    if USE_DATABASE:
+        messages, next_cursor = get_chat_messages_from_db(user_id, chat_id, limit, before)
+    else:
+        messages, next_cursor = None, None
+        with users_db.user_lock(user_id):
+            user = get_current_user()
+            chat = user.get('chat_history', {}).get(chat_id) if user else None
+            if chat is not None:
+                # Pages run backwards from the newest message
+                newest_first, next_cursor = paginate_list(chat.get('messages', [])[::-1], limit, before)
+                messages = newest_first[::-1]
+
+    if messages is None:
+        return jsonify({"error": "Chat not found"}), 404
+    return jsonify({"messages": messages, "next_cursor": next_cursor})
+
+@app.route('/api/user/chats/sync', methods=['POST'])
+@require_auth
+def sync_user_chats():
+    """Save only what changed: {"changes": [chat with only its new messages, ...], "deleted": [chat id, ...]}"""
+    user_id = session.get('user_id')
+    data = request.get_json() or {}
+    changes = [change for change in data.get('changes', []) if change.get('id')]
+    deleted = data.get('deleted', [])
+
+    if USE_DATABASE:
+        result = apply_chat_changes_to_db(user_id, changes, deleted)
+    elif user_id in users_db:
+        # Apply and journal as one step, so concurrent syncs get distinct versions in order;
+        # the record is fetched under the lock, which keeps it loaded until the entry is written
+        with users_db.user_lock(user_id):
+            user = users_db[user_id]
+            result = apply_file_chat_changes(user, changes, deleted)
+            save_chat_changes_to_file(user_id, user, result[1])
     else:
-        return jsonify({"chats": {}})
+        return jsonify({"success": False, "message": "User not found"}), 404
+
+    if result is None:
+        return jsonify({"success": False, "message": "Failed to save chats"}), 500
+    versions, version = result
+    return jsonify({"success": True, "versions": versions, "version": version})
 
 @app.route('/api/user/chats', methods=['POST'])
 @require_auth
@@ -993,10 +1764,24 @@ def save_user_chats():
         user_id = session.get('user_id')
         chats_data = request.get_json()
 
+        if USE_DATABASE:
+            # Unchanged chats are skipped and changed ones only insert their new messages
+            if update_user_chat_history(user_id, chats_data.get('chats', {})):
+                return jsonify({"success": True, "message": "Chats saved successfully"})
+            return jsonify({"success": False, "message": "Failed to save chats"}), 500
+
         if user_id in users_db:
-            users_db[user_id]['chat_history'] = chats_data.get('chats', {})
-            # Also save to file for persistence
-            save_user_to_file(user_id, users_db[user_id])
+            # Apply the difference, so delta sync sees these changes too
+            chats = chats_data.get('chats', {})
+            with users_db.user_lock(user_id):
+                user = users_db[user_id]
+                history = user.get('chat_history', {})
+                changes = [{**chat, 'id': chat_id} for chat_id, chat in chats.items()
+                           if chat_id not in history or history[chat_id].get('updatedAt') != chat.get('updatedAt')]
+                deleted = [chat_id for chat_id in history if chat_id not in chats]
+                _, version = apply_file_chat_changes(user, changes, deleted)
+                # Also save to file for persistence
+                save_chat_changes_to_file(user_id, user, version)
             return jsonify({"success": True, "message": "Chats saved successfully"})
         else:
             return jsonify({"success": False, "message": "User not found"}), 404
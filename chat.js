@@ -8,6 +8,9 @@ class GrowthChat {
         this.sidebarOpen = false;
         this.currentUser = null;
         this.isAuthenticated = false;
+        this.syncState = null;
+        this.syncInFlight = false;
+        this.syncAgain = false;
 
         // Initialize the app (authentication is optional)
         this.initializeElements();
@@ -123,6 +126,9 @@ class GrowthChat {
                     const result = await response.json();
                     if (response.ok) {
                         this.showUploadSuccess(result.filename, result.size, result.message);
+                        if (result.job_id) {
+                            this.watchAnalysisJob(result.job_id, result.filename);
+                        }
                     } else {
                         this.showUploadError(result.error);
                     }
@@ -386,13 +392,13 @@ class GrowthChat {
                 "Accept": "application/json"
             },
             credentials: 'include',
-            body: JSON.stringify({ message: userMessage, stream: false })
+            body: JSON.stringify({ message: userMessage, stream: false, chat_id: this.currentChatId })
         });
 
         console.log("Response status:", response.status);
         console.log("Response headers:", response.headers);
 
-        if (!response.ok) {
+        if (!response.ok && response.status !== 429) {
             const errorText = await response.text();
             console.error("Response error:", errorText);
             throw new Error(`HTTP error! Status: ${response.status} - ${errorText}`);
@@ -419,11 +425,19 @@ class GrowthChat {
                 "Content-Type": "application/json",
             },
             credentials: 'include',
-            body: JSON.stringify({ message: userMessage, stream: true })
+            body: JSON.stringify({ message: userMessage, stream: true, chat_id: this.currentChatId })
         });
 
         console.log("Streaming response status:", response.status);
 
+        if (response.status === 429) {
+            // Server is saturated; the reply says when to try again
+            const data = await response.json();
+            this.removeTypingIndicator();
+            this.addMessage('assistant', data.reply);
+            return;
+        }
+
         if (!response.ok) {
             throw new Error(`HTTP error! Status: ${response.status}`);
         }
@@ -453,16 +467,20 @@ class GrowthChat {
         const reader = response.body.getReader();
         const decoder = new TextDecoder();
         let fullContent = '';
+        let buffered = '';
 
         try {
             while (true) {
                 const { done, value } = await reader.read();
                 if (done) break;
 
-                const chunk = decoder.decode(value);
-                const lines = chunk.split('\n');
+                // Events end with a blank line; keep any partial event for the next read
+                buffered += decoder.decode(value, { stream: true });
+                const events = buffered.split('\n\n');
+                buffered = events.pop();
 
-                for (const line of lines) {
+                for (const line of events) {
+                    // Lines starting with ':' are keep-alive comments
                     if (line.startsWith('data: ')) {
                         try {
                             const data = JSON.parse(line.slice(6));
@@ -487,8 +505,7 @@ class GrowthChat {
                                 return;
                             }
                         } catch (e) {
-                            // Ignore JSON parse errors for incomplete chunks
-                            console.log("JSON parse error (expected for partial chunks):", e);
+                            console.log("Could not parse streamed event:", e);
                         }
                     }
                 }
@@ -593,6 +610,12 @@ class GrowthChat {
         if (!this.chats[chatId]) return;
         
         delete this.chats[chatId];
+        if (this.isAuthenticated) {
+            const syncState = this.getSyncState();
+            delete syncState.chats[chatId];
+            syncState.deleted.push(chatId);
+            this.saveSyncState();
+        }
         
         // If we deleted the current chat, create a new one or load another
         if (this.currentChatId === chatId) {
@@ -690,30 +713,125 @@ class GrowthChat {
             // Save to local storage
             localStorage.setItem('growth-chats', JSON.stringify(this.chats));
 
-            // If user is logged in, also save to backend
+            // If user is logged in, also send what changed to the backend
             if (this.isAuthenticated) {
-                this.saveChatsToBackend();
+                this.syncChatsToBackend();
             }
         } catch (error) {
             console.error('Error saving chats:', error);
         }
     }
 
-    async saveChatsToBackend() {
+    // Delta sync state for the signed-in user: the server cursor, and per chat
+    // how many messages (and which updatedAt) the server already has
+    getSyncState() {
+        if (!this.syncState) {
+            try {
+                const stored = localStorage.getItem(this.syncStateKey());
+                this.syncState = stored ? JSON.parse(stored) : null;
+            } catch (error) {
+                console.error('Error loading sync state:', error);
+            }
+            this.syncState = this.syncState || { cursor: 0, chats: {}, deleted: [] };
+        }
+        return this.syncState;
+    }
+
+    syncStateKey() {
+        return `growth-chats-sync-${this.currentUser ? this.currentUser.id : 'guest'}`;
+    }
+
+    saveSyncState() {
         try {
-            await fetch('/api/user/chats', {
+            localStorage.setItem(this.syncStateKey(), JSON.stringify(this.getSyncState()));
+        } catch (error) {
+            console.error('Error saving sync state:', error);
+        }
+    }
+
+    async syncChatsToBackend() {
+        // One sync at a time; anything changed meanwhile goes out right after
+        if (this.syncInFlight) {
+            this.syncAgain = true;
+            return;
+        }
+
+        const syncState = this.getSyncState();
+        const changes = [];
+        const sent = {};
+        for (const [chatId, chat] of Object.entries(this.chats)) {
+            const state = syncState.chats[chatId];
+            if (state && state.synced === chat.messages.length && state.updatedAt === chat.updatedAt) continue;
+
+            const from = state ? Math.min(state.synced, chat.messages.length) : 0;
+            changes.push({
+                id: chatId,
+                title: chat.title,
+                createdAt: chat.createdAt,
+                updatedAt: chat.updatedAt,
+                messages: chat.messages.slice(from)
+            });
+            sent[chatId] = { synced: chat.messages.length, updatedAt: chat.updatedAt };
+        }
+        const deleted = [...syncState.deleted];
+        if (changes.length === 0 && deleted.length === 0) return;
+
+        this.syncInFlight = true;
+        try {
+            const response = await fetch('/api/user/chats/sync', {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
                 },
                 credentials: 'include',
-                body: JSON.stringify({ chats: this.chats })
+                body: JSON.stringify({ changes, deleted })
             });
+
+            if (response.ok) {
+                Object.assign(syncState.chats, sent);
+                syncState.deleted = syncState.deleted.filter(chatId => !deleted.includes(chatId));
+                this.saveSyncState();
+            }
         } catch (error) {
             console.error('Error saving chats to backend:', error);
+        } finally {
+            this.syncInFlight = false;
+            if (this.syncAgain) {
+                this.syncAgain = false;
+                this.syncChatsToBackend();
+            }
         }
     }
 
+    mergeServerChat(chatId, serverChat) {
+        // Server chats only carry the messages added since our cursor
+        const syncState = this.getSyncState();
+        const state = syncState.chats[chatId];
+        const local = this.chats[chatId];
+
+        if (!local) {
+            this.chats[chatId] = { ...serverChat };
+            syncState.chats[chatId] = { synced: serverChat.messages.length, updatedAt: serverChat.updatedAt };
+            return;
+        }
+
+        const hadUnsynced = !state || state.synced < local.messages.length;
+        const known = new Set(local.messages.map(message => message.id));
+        const added = serverChat.messages.filter(message => !known.has(message.id));
+        if (added.length > 0) {
+            local.messages = local.messages.concat(added)
+                .sort((a, b) => new Date(a.timestamp) - new Date(b.timestamp));
+        }
+        local.title = serverChat.title || local.title;
+        if (new Date(serverChat.updatedAt) > new Date(local.updatedAt)) {
+            local.updatedAt = serverChat.updatedAt;
+        }
+        // Local-only messages get resent in full once; the server ignores ones it already has
+        syncState.chats[chatId] = hadUnsynced
+            ? { synced: 0, updatedAt: null }
+            : { synced: local.messages.length, updatedAt: local.updatedAt };
+    }
+
     loadTheme() {
         try {
             const stored = localStorage.getItem('growth-theme');
@@ -805,18 +923,35 @@ class GrowthChat {
     }
 
     async loadUserChats() {
-        // This method would load user-specific chats from the server
-        // For now, we'll merge local chats with server chats
+        // Fetch only what changed on the server since the last load, then
+        // merge it with local chats and send back anything the server lacks
         try {
-            const response = await fetch('/api/user/chats', {
+            this.syncState = null;
+            const syncState = this.getSyncState();
+            const response = await fetch(`/api/user/chats?since=${syncState.cursor}`, {
                 method: 'GET',
                 credentials: 'include'
             });
 
             if (response.ok) {
                 const data = await response.json();
-                // Merge server chats with local chats
-                this.chats = { ...this.chats, ...data.chats };
+                (data.deleted || []).forEach(chatId => {
+                    delete this.chats[chatId];
+                    delete syncState.chats[chatId];
+                });
+                Object.entries(data.chats || {}).forEach(([chatId, chat]) => this.mergeServerChat(chatId, chat));
+                syncState.cursor = data.cursor || syncState.cursor;
+                this.saveSyncState();
+
+                if (this.currentChatId && !this.chats[this.currentChatId]) {
+                    // The open chat was deleted on another device
+                    const remainingChats = Object.keys(this.chats);
+                    if (remainingChats.length > 0) {
+                        this.loadChat(remainingChats[0]);
+                    } else {
+                        this.createNewChat();
+                    }
+                }
                 this.renderChatHistory();
                 this.saveChats();
             }
@@ -878,6 +1013,38 @@ class GrowthChat {
         this.showSystemMessage(`❌ Upload failed: ${error}`, 'error');
     }
 
+    async watchAnalysisJob(jobId, filename) {
+        // Poll the background analysis job until it finishes
+        while (true) {
+            await new Promise(resolve => setTimeout(resolve, 3000));
+
+            try {
+                const response = await fetch(`/api/jobs/${jobId}`, {
+                    method: 'GET',
+                    credentials: 'include'
+                });
+                if (!response.ok) return;
+
+                const job = await response.json();
+                if (job.status === 'completed') {
+                    if (job.kind === 'prepare') {
+                        this.showSystemMessage(`📄 "${filename}" has been processed. Ask me to analyze it whenever you're ready!`, 'success');
+                    } else {
+                        this.showSystemMessage(`📄 Analysis of "${filename}" is ready. Ask me to analyze it to see the summary!`, 'success');
+                    }
+                    return;
+                }
+                if (job.status === 'failed') {
+                    this.showSystemMessage(`❌ Analysis of "${filename}" failed: ${job.error}`, 'error');
+                    return;
+                }
+            } catch (error) {
+                console.error('Error checking analysis job:', error);
+                return;
+            }
+        }
+    }
+
     showSystemMessage(message, type = 'info') {
         // Create a system message that appears in the chat
         const messageId = Date.now().toString();
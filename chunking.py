@@ -0,0 +1,187 @@
+import os
+import re
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Chunking settings
+TINYLLAMA_CONTEXT_TOKENS = int(os.getenv('TINYLLAMA_CONTEXT_TOKENS', '2048'))
+CHUNK_CONTEXT_SHARE = float(os.getenv('CHUNK_CONTEXT_SHARE', '0.5'))  # rest is left for prompt and answer
+CHUNK_OVERLAP_TOKENS = int(os.getenv('CHUNK_OVERLAP_TOKENS', '32'))
+
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+# Sentence-final punctuation (plus closing quotes/brackets) followed by whitespace,
+# or a blank line. Decimals ("3.5") and URLs ("example.com/a") have no whitespace
+# after the period, so they never match.
+BOUNDARY_PATTERN = re.compile(r"[.!?]+[\"')\]]*\s+|\n\s*\n")
+LAST_WORD_PATTERN = re.compile(r"(\S+)[.!?]+[\"')\]]*\s+$")
+ABBREVIATIONS = {
+    'dr', 'mr', 'mrs', 'ms', 'prof', 'sr', 'jr', 'st', 'vs', 'etc', 'inc', 'ltd', 'co', 'corp',
+    'no', 'fig', 'vol', 'approx', 'dept', 'est', 'jan', 'feb', 'mar', 'apr', 'jun', 'jul', 'aug',
+    'sep', 'sept', 'oct', 'nov', 'dec', 'e.g', 'i.e', 'u.s', 'u.k', 'a.m', 'p.m'
+}
+
+def count_tokens(text):
+    """Estimate the number of Llama tokenizer tokens in text.
+
+    Common words are one token, long words are split into several, digits
+    are one token each (as in the Llama tokenizer) and punctuation is one
+    token per character.
+    """
+    tokens = 0
+    for piece in TOKEN_PATTERN.findall(text):
+        if piece.isdigit():
+            tokens += len(piece)
+        elif piece[0].isalnum() or piece[0] == '_':
+            tokens += 1 + len(piece) // 7
+        else:
+            tokens += 1
+    return tokens
+
+def default_chunk_tokens():
+    """Token budget per chunk: a share of the model context"""
+    return max(64, int(TINYLLAMA_CONTEXT_TOKENS * CHUNK_CONTEXT_SHARE))
+
+class TokenChunker:
+    """Incrementally pack sentences into chunks of at most max_tokens tokens.
+
+    Text is fed piece by piece (e.g. one PDF page at a time) and chunks are
+    yielded as soon as they are full, so the whole document never has to be
+    held as one string. Each chunk is a dict with its whitespace-normalized
+    text, its token estimate and the [start, end) character offsets of the
+    chunk in the fed text (pieces joined with the separator). Consecutive
+    chunks share up to overlap_tokens tokens of whole trailing sentences.
+    """
+
+    def __init__(self, max_tokens=None, overlap_tokens=CHUNK_OVERLAP_TOKENS, separator="\n"):
+        self.max_tokens = max_tokens or default_chunk_tokens()
+        self.overlap_tokens = min(overlap_tokens, self.max_tokens // 2)
+        self.separator = separator
+        self.tail = ""  # text after the last confirmed sentence boundary
+        self.tail_start = 0  # offset of tail in the fed text
+        self.started = False
+        self.sentences = []  # (start, end, tokens, text) of the chunk being built
+        self.chunk_tokens = 0
+
+    def feed(self, text):
+        """Add text and yield any chunks that are now complete"""
+        if self.started:
+            text = self.separator + text
+        self.started = True
+        self.tail += text
+        yield from self._consume(final=False)
+
+    def flush(self):
+        """Yield the remaining chunks once all text has been fed"""
+        yield from self._consume(final=True)
+        if self.sentences:
+            yield self._emit()
+            self.sentences = []
+            self.chunk_tokens = 0
+
+    def _consume(self, final):
+        position = 0
+        for match in BOUNDARY_PATTERN.finditer(self.tail):
+            if match.end() == len(self.tail) and not final:
+                # The next piece decides whether this is really a sentence end
+                break
+            if self._is_abbreviation(match):
+                continue
+            yield from self._add_span(position, match.end())
+            position = match.end()
+
+        if final:
+            yield from self._add_span(position, len(self.tail))
+            position = len(self.tail)
+        elif len(self.tail) - position > self.max_tokens * 8:
+            # Text without sentence breaks (tables, OCR output): cut at the last space
+            cut = self.tail.rfind(' ', position, len(self.tail) - 1) + 1
+            if cut > position:
+                yield from self._add_span(position, cut)
+                position = cut
+
+        self.tail = self.tail[position:]
+        self.tail_start += position
+
+    def _is_abbreviation(self, match):
+        if match.group().startswith('\n'):
+            return False
+        next_index = match.end()
+        if next_index < len(self.tail) and self.tail[next_index].islower():
+            # "e.g. this", "approx. ten": a lowercase continuation is not a new sentence
+            return True
+        last_word = LAST_WORD_PATTERN.search(self.tail, max(0, match.start() - 40), match.end())
+        if not last_word:
+            return False
+        word = last_word.group(1).lower().lstrip('("\'[')
+        return word in ABBREVIATIONS or (len(word) == 1 and word.isalpha())
+
+    def _add_span(self, start, end):
+        """Add tail[start:end] as one sentence (split further if it alone exceeds the budget)"""
+        segment = self.tail[start:end]
+        stripped = segment.strip()
+        if not stripped:
+            return
+        offset = self.tail_start + start + (len(segment) - len(segment.lstrip()))
+
+        tokens = count_tokens(stripped)
+        if tokens <= self.max_tokens:
+            yield from self._add_sentence(offset, offset + len(stripped), tokens, stripped)
+            return
+
+        # Overlong sentence: split on whitespace into budget-sized pieces
+        piece_start = piece_end = None
+        piece_tokens = 0
+        for word in re.finditer(r"\S+", stripped):
+            word_tokens = count_tokens(word.group())
+            if piece_start is not None and piece_tokens + word_tokens > self.max_tokens:
+                piece = stripped[piece_start:piece_end]
+                yield from self._add_sentence(offset + piece_start, offset + piece_end, piece_tokens, piece)
+                piece_start = None
+                piece_tokens = 0
+            if piece_start is None:
+                piece_start = word.start()
+            piece_end = word.end()
+            piece_tokens += word_tokens
+        if piece_start is not None:
+            piece = stripped[piece_start:piece_end]
+            yield from self._add_sentence(offset + piece_start, offset + piece_end, piece_tokens, piece)
+
+    def _add_sentence(self, start, end, tokens, text):
+        if self.sentences and self.chunk_tokens + tokens > self.max_tokens:
+            yield self._emit()
+            self._start_with_overlap(tokens)
+        self.sentences.append((start, end, tokens, re.sub(r"\s+", " ", text)))
+        self.chunk_tokens += tokens
+
+    def _start_with_overlap(self, incoming_tokens):
+        """Begin the next chunk with trailing sentences of the previous one"""
+        kept = []
+        kept_tokens = 0
+        for sentence in reversed(self.sentences):
+            if kept_tokens + sentence[2] > self.overlap_tokens or \
+                    kept_tokens + sentence[2] + incoming_tokens > self.max_tokens:
+                break
+            kept.append(sentence)
+            kept_tokens += sentence[2]
+        kept.reverse()
+        self.sentences = kept
+        self.chunk_tokens = kept_tokens
+
+    def _emit(self):
+        chunk = {
+            "text": " ".join(sentence[3] for sentence in self.sentences),
+            "start": self.sentences[0][0],
+            "end": self.sentences[-1][1],
+            "tokens": self.chunk_tokens
+        }
+        return chunk
+
+def iter_token_chunks(pieces, max_tokens=None, overlap_tokens=CHUNK_OVERLAP_TOKENS, separator="\n"):
+    """Yield chunk dicts for an iterable of text pieces"""
+    chunker = TokenChunker(max_tokens, overlap_tokens, separator)
+    for piece in pieces:
+        yield from chunker.feed(piece)
+    yield from chunker.flush()
@@ -0,0 +1,155 @@
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Conversation context settings
+CHAT_CONTEXT_TOKENS = int(os.getenv('CHAT_CONTEXT_TOKENS', '1200'))  # prompt budget: summary + turns + message
+CHAT_SUMMARY_WORDS = int(os.getenv('CHAT_SUMMARY_WORDS', '120'))  # target length of the rolling summary
+CHAT_CONTEXT_CONVERSATIONS = int(os.getenv('CHAT_CONTEXT_CONVERSATIONS', '1000'))  # summaries kept in memory
+CHAT_HISTORY_MESSAGES = int(os.getenv('CHAT_HISTORY_MESSAGES', '200'))  # most recent stored messages read per turn
+CHARS_PER_TOKEN = 4  # rough estimate; TinyLlama has no tokenizer available here
+
+CONVERSATION_ROLES = ('user', 'assistant')
+
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1
+
+def messages_tokens(messages):
+    return sum(estimate_tokens(message['content']) + 4 for message in messages)
+
+class ConversationState:
+    """What a conversation's prompt is built from: a summary of stored messages [0, summarized)
+    and the turns from message start on, sent verbatim"""
+
+    def __init__(self):
+        self.start = 0
+        self.summary = ""
+        self.summarized = 0
+        self.summarizing = False
+
+class ConversationContext:
+    """Build the messages for a chat turn from the conversation's earlier turns.
+
+    Recent turns are sent verbatim and older ones as a rolling summary, all
+    within max_tokens. The verbatim window only moves forward in blocks
+    (dropping about half of it at once) and the summary only changes when a
+    block is folded in, so consecutive turns share the same prompt prefix
+    and Ollama can reuse its KV cache instead of re-reading the whole
+    conversation. Folding a block into the summary calls summarize_fn in
+    the background; until it finishes the previous summary is used.
+
+    Only the stored messages from history_start() on are needed, so the
+    caller does not have to load the whole conversation every turn.
+    """
+
+    def __init__(self, summarize_fn, max_tokens=CHAT_CONTEXT_TOKENS, max_conversations=CHAT_CONTEXT_CONVERSATIONS):
+        self.summarize_fn = summarize_fn
+        self.max_tokens = max_tokens
+        self.max_conversations = max_conversations
+        self.lock = threading.Lock()
+        self.states = OrderedDict()  # conversation key -> ConversationState, least recently used first
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='chat-summary')
+        self.summaries = 0
+        self.summary_failures = 0
+
+    def _state(self, key):
+        state = self.states.get(key)
+        if state is None:
+            state = self.states[key] = ConversationState()
+            if len(self.states) > self.max_conversations:
+                self.states.popitem(last=False)
+        self.states.move_to_end(key)
+        return state
+
+    def history_start(self, key):
+        """Index of the first stored message build() still needs: the first one not yet summarized"""
+        with self.lock:
+            state = self.states.get(key)
+            return state.summarized if state else 0
+
+    def build(self, key, history, messages, offset=0):
+        """Return history context + messages, where messages ends with the new user turn.
+
+        key identifies the conversation (e.g. user id and chat id); history is
+        its stored messages from index offset on, oldest first. Messages before
+        offset that were never summarized are left out.
+        """
+        turns = [(index, {"role": message['role'], "content": message['content']})
+                 for index, message in enumerate(history, offset)
+                 if message.get('role') in CONVERSATION_ROLES and message.get('content')]
+        # The client may already have saved the message being answered
+        if turns and turns[-1][1] == messages[-1]:
+            turns.pop()
+        if not turns:
+            return messages
+
+        with self.lock:
+            state = self._state(key)
+            if state.start > offset + len(history):
+                # Messages were deleted or the chat was replaced; start over
+                self.states[key] = state = ConversationState()
+            if state.summarized < offset:
+                # The caller read only the latest messages; older unsummarized ones are skipped
+                state.summarized = offset
+                state.start = max(state.start, offset)
+
+            budget = self.max_tokens - messages_tokens(messages) - estimate_tokens(state.summary)
+            window = [turn for index, turn in turns if index >= state.start]
+            if messages_tokens(window) > budget:
+                # Drop a block of old turns at once so the prefix stays stable for a while
+                while window and messages_tokens(window) > budget // 2:
+                    window = window[1:]
+                while window and window[0]['role'] != 'user':
+                    window = window[1:]
+                state.start = turns[-len(window)][0] if window else turns[-1][0] + 1
+
+            if state.summarized < state.start and not state.summarizing:
+                folded = [turn for index, turn in turns if state.summarized <= index < state.start]
+                if folded:
+                    state.summarizing = True
+                    self.executor.submit(self._fold, key, state, folded, state.start)
+                else:
+                    state.summarized = state.start
+
+            context = list(window)
+            if state.summary:
+                context.insert(0, {"role": "system",
+                                   "content": f"Summary of the earlier conversation: {state.summary}"})
+        return context + messages
+
+    def _fold(self, key, state, turns, upto):
+        """Fold turns into the conversation's summary (runs on the summary thread)"""
+        try:
+            summary = self.summarize_fn(state.summary, turns, CHAT_SUMMARY_WORDS)
+        except Exception as e:
+            summary = None
+            print(f"⚠️ Conversation summary failed: {e}")
+
+        with self.lock:
+            state.summarizing = False
+            if not summary:
+                self.summary_failures += 1
+                return
+            state.summary = summary.strip()
+            state.summarized = upto
+            self.summaries += 1
+        print(f"🧾 Conversation summary updated ({upto} messages covered)")
+
+    def forget(self, key):
+        with self.lock:
+            self.states.pop(key, None)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "conversations": len(self.states),
+                "max_tokens": self.max_tokens,
+                "summaries": self.summaries,
+                "summary_failures": self.summary_failures,
+                "summarizing": sum(1 for state in self.states.values() if state.summarizing)
+            }
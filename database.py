@@ -1,11 +1,17 @@
 import os
 import json
-from datetime import datetime
+from datetime import datetime, timezone
 from dotenv import load_dotenv
-from sqlalchemy import create_engine, Column, String, Text, DateTime, Integer
+from sqlalchemy import (
+    create_engine, Column, String, Text, DateTime, Integer, Boolean, ForeignKey, Index, UniqueConstraint,
+    and_, or_, func, text
+)
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, scoped_session, deferred
 from werkzeug.security import generate_password_hash
+from user_directory import normalize_email, normalize_username
+from user_cache import UserCache
+from db_pool import pool_options, pool_stats, retry_stale, stale_connection
 
 # Load environment variables
 load_dotenv()
@@ -22,10 +28,19 @@ if not DATABASE_URL:
     # Fallback to individual components
     DATABASE_URL = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
 
+# asyncpg driver for the ASGI serving mode
+ASYNC_DATABASE_URL = os.getenv('ASYNC_DATABASE_URL') or DATABASE_URL.replace('postgresql://', 'postgresql+asyncpg://', 1)
+
 # SQLAlchemy setup
 Base = declarative_base()
 engine = None
 SessionLocal = None
+db_session = None  # one session per thread, i.e. per request; removed when the request ends
+async_engine = None
+AsyncSessionLocal = None
+
+# Users by id for auth and session checks
+user_cache = UserCache()
 
 class User(Base):
     __tablename__ = 'users'
@@ -35,7 +50,41 @@ class User(Base):
     username = Column(String(100), unique=True, nullable=False)
     password_hash = Column(String(255), nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
-    chat_history = Column(Text, default='{}')  # JSON string
+    # Legacy JSON string, moved into conversations/messages on first read; never loaded with the user
+    chat_history = deferred(Column(Text, default='{}'))
+
+class Conversation(Base):
+    __tablename__ = 'conversations'
+    __table_args__ = (
+        UniqueConstraint('user_id', 'chat_id', name='uq_conversations_user_chat'),
+        Index('ix_conversations_user_updated', 'user_id', 'updated_at'),
+        Index('ix_conversations_user_version', 'user_id', 'version'),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    user_id = Column(String(32), nullable=False)
+    chat_id = Column(String(64), nullable=False)  # id the browser gave the chat
+    title = Column(String(255), default='New Chat')
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+    version = Column(Integer, nullable=False, default=0)  # user's change counter at the last change
+    deleted = Column(Boolean, nullable=False, default=False)  # kept as a tombstone for delta sync
+
+class Message(Base):
+    __tablename__ = 'messages'
+    __table_args__ = (
+        UniqueConstraint('conversation_id', 'message_id', name='uq_messages_conversation_message'),
+        Index('ix_messages_conversation_id', 'conversation_id', 'id'),
+        Index('ix_messages_conversation_version', 'conversation_id', 'version'),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    conversation_id = Column(Integer, ForeignKey('conversations.id', ondelete='CASCADE'), nullable=False)
+    message_id = Column(String(64), nullable=False)  # id the browser gave the message
+    role = Column(String(20), nullable=False)
+    content = Column(Text, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    version = Column(Integer, nullable=False, default=0)  # conversation version that added it
 
 class UploadedFile(Base):
     __tablename__ = 'uploaded_files'
@@ -49,17 +98,22 @@ class UploadedFile(Base):
 
 def init_database():
     """Initialize database connection and create tables"""
-    global engine, SessionLocal
+    global engine, SessionLocal, db_session
     
     try:
-        # Create engine
-        engine = create_engine(DATABASE_URL, echo=False)
+        # Create engine (pool size, overflow, recycle and pre-ping come from DB_POOL_* settings)
+        engine = create_engine(DATABASE_URL, echo=False, **pool_options())
         
         # Create session factory
         SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+        db_session = scoped_session(SessionLocal)
         
         # Create tables
         Base.metadata.create_all(bind=engine)
+
+        # Login by username is case-insensitive; index the lookup (also on existing tables)
+        with engine.begin() as connection:
+            connection.execute(text("CREATE INDEX IF NOT EXISTS ix_users_username_lower ON users (lower(username))"))
         
         print("✅ PostgreSQL database connected successfully")
         # Safely mask password in URL for logging
@@ -75,24 +129,57 @@ def init_database():
         print("💡 Make sure PostgreSQL is running and credentials are correct")
         return False
 
+async def init_async_database():
+    """Initialize the asyncio database engine (tables are created by init_database)"""
+    global async_engine, AsyncSessionLocal
+
+    try:
+        from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+        async_engine = create_async_engine(ASYNC_DATABASE_URL, echo=False, **pool_options(asyncio=True))
+        AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False)
+
+        # Check the connection now rather than on the first request
+        async with async_engine.connect():
+            pass
+
+        print("✅ Async PostgreSQL engine connected successfully")
+        return True
+
+    except Exception as e:
+        print(f"❌ Async database connection failed: {e}")
+        print("💡 The asyncio mode needs the asyncpg driver: pip install asyncpg")
+        return False
+
 def get_db_session():
-    """Get database session"""
-    if SessionLocal is None:
+    """Get the current request's database session (one per thread outside requests)"""
+    if db_session is None:
         raise Exception("Database not initialized. Call init_database() first.")
-    return SessionLocal()
+    return db_session()
+
+def remove_db_session():
+    """End the current request's session, rolling back anything left open and returning its connection"""
+    if db_session is not None:
+        db_session.remove()
+
+def database_stats():
+    """Connection pool usage and checkout waits for the sync and asyncio engines"""
+    return {
+        "pool": pool_stats(engine) if engine is not None else None,
+        "async_pool": pool_stats(async_engine) if async_engine is not None else None,
+        "user_cache": user_cache.stats()
+    }
 
 def create_user_in_db(user_id, email, username, password):
     """Create user in PostgreSQL database"""
+    session = get_db_session()
     try:
-        session = get_db_session()
-        
         # Check if user already exists
-        existing_user = session.query(User).filter(
-            (User.email == email) | (User.username == username)
+        existing_user = session.query(User.id).filter(
+            (User.email == normalize_email(email)) | (func.lower(User.username) == normalize_username(username))
         ).first()
         
         if existing_user:
-            session.close()
             return False, "User already exists"
         
         # Create new user
@@ -106,71 +193,498 @@ def create_user_in_db(user_id, email, username, password):
         
         session.add(new_user)
         session.commit()
-        session.close()
+        user_cache.invalidate(user_id)
         
         print(f"✅ User created in database: {username} ({email})")
         return True, "User created successfully"
         
     except Exception as e:
+        session.rollback()
         print(f"❌ Error creating user in database: {e}")
         return False, str(e)
 
-def get_user_from_db(email=None, user_id=None):
-    """Get user from PostgreSQL database"""
+    finally:
+        session.close()
+
+def user_to_dict(user):
+    """Convert a User row to the dict format used by the backend"""
+    return {
+        'id': user.id,
+        'email': user.email,
+        'username': user.username,
+        'password_hash': user.password_hash,
+        'created_at': user.created_at.isoformat()
+    }
+
+def user_lookup_filter(email=None, username=None, email_or_username=None):
+    """Indexed filter for a user by email, username (case-insensitive) or either"""
+    if email_or_username:
+        value = email_or_username.strip().casefold()
+        return or_(User.email == value, func.lower(User.username) == value)
+    if email:
+        return User.email == normalize_email(email)
+    return func.lower(User.username) == normalize_username(username)
+
+@retry_stale
+def get_user_from_db(email=None, user_id=None, username=None, email_or_username=None):
+    """Get user from PostgreSQL database (by id from the user cache when possible)"""
+    by_id = user_id and not (email or username or email_or_username)
+    if by_id:
+        cached = user_cache.get(user_id)
+        if cached:
+            return cached
+    elif not (email or username or email_or_username):
+        return None
+
+    loaded_at = user_cache.clock()
+    session = get_db_session()
     try:
-        session = get_db_session()
-        
-        if email:
-            user = session.query(User).filter(User.email == email).first()
-        elif user_id:
+        if by_id:
             user = session.query(User).filter(User.id == user_id).first()
         else:
-            session.close()
-            return None
+            user = session.query(User).filter(user_lookup_filter(email, username, email_or_username)).first()
         
-        if user:
-            user_data = {
-                'id': user.id,
-                'email': user.email,
-                'username': user.username,
-                'password_hash': user.password_hash,
-                'created_at': user.created_at.isoformat(),
-                'chat_history': json.loads(user.chat_history) if user.chat_history else {}
-            }
-            session.close()
-            return user_data
+        if user is None:
+            return None
+        user_data = user_to_dict(user)
+        user_cache.put(user_data, loaded_at)
+        return user_data
         
+    except Exception as e:
+        session.rollback()
+        if stale_connection(e):
+            raise
+        print(f"❌ Error getting user from database: {e}")
+        return None
+
+    finally:
         session.close()
+
+async def create_user_in_db_async(user_id, email, username, password_hash):
+    """Create user in PostgreSQL database (asyncio).
+
+    Takes the password already hashed: hashing is slow and blocking, so the
+    caller does it in a thread before calling this on the event loop.
+    """
+    from sqlalchemy import select
+
+    try:
+        async with AsyncSessionLocal() as session:
+            # Check if user already exists
+            result = await session.execute(
+                select(User.id).where(
+                    (User.email == normalize_email(email)) | (func.lower(User.username) == normalize_username(username))
+                ).limit(1)
+            )
+            if result.first():
+                return False, "User already exists"
+
+            session.add(User(
+                id=user_id,
+                email=email,
+                username=username,
+                password_hash=password_hash,
+                chat_history='{}'
+            ))
+            await session.commit()
+        user_cache.invalidate(user_id)
+
+        print(f"✅ User created in database: {username} ({email})")
+        return True, "User created successfully"
+
+    except Exception as e:
+        print(f"❌ Error creating user in database: {e}")
+        return False, str(e)
+
+async def get_user_from_db_async(email=None, user_id=None, username=None, email_or_username=None):
+    """Get user from PostgreSQL database (asyncio)"""
+    from sqlalchemy import select
+
+    if email or username or email_or_username:
+        query = select(User).where(user_lookup_filter(email, username, email_or_username))
+    elif user_id:
+        cached = user_cache.get(user_id)
+        if cached:
+            return cached
+        query = select(User).where(User.id == user_id)
+    else:
         return None
-        
+
+    try:
+        loaded_at = user_cache.clock()
+        async with AsyncSessionLocal() as session:
+            user = (await session.execute(query)).scalars().first()
+        if user is None:
+            return None
+        user_data = user_to_dict(user)
+        user_cache.put(user_data, loaded_at)
+        return user_data
+
     except Exception as e:
         print(f"❌ Error getting user from database: {e}")
         return None
 
 def update_user_chat_history(user_id, chat_history):
-    """Update user's chat history in database"""
+    """Update user's chat history in database (only new and changed chats are written)"""
+    return save_chat_history_to_db(user_id, chat_history)
+
+def parse_client_time(value):
+    """Browser ISO timestamp -> naive UTC datetime (now if missing or invalid)"""
     try:
-        session = get_db_session()
-        
-        user = session.query(User).filter(User.id == user_id).first()
-        if user:
-            user.chat_history = json.dumps(chat_history)
-            session.commit()
-            session.close()
-            return True
-        
+        parsed = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    except ValueError:
+        return datetime.utcnow()
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+def client_time(value):
+    """Naive UTC datetime -> ISO timestamp the browser parses as UTC"""
+    return value.isoformat() + 'Z'
+
+def message_to_dict(message):
+    return {
+        'id': message.message_id,
+        'role': message.role,
+        'content': message.content,
+        'timestamp': client_time(message.created_at)
+    }
+
+def conversation_to_dict(conversation, messages=None):
+    """Conversation row (and optionally its messages) in the browser's chat format"""
+    chat = {
+        'id': conversation.chat_id,
+        'title': conversation.title,
+        'createdAt': client_time(conversation.created_at),
+        'updatedAt': client_time(conversation.updated_at),
+        'version': conversation.version
+    }
+    if messages is not None:
+        chat['messages'] = [message_to_dict(message) for message in messages]
+    return chat
+
+def _next_version(session, user_id):
+    """Next value of the user's change counter (the user row is locked so concurrent saves differ)"""
+    session.query(User.id).filter(User.id == user_id).with_for_update().first()
+    latest = session.query(func.max(Conversation.version)).filter(Conversation.user_id == user_id).scalar()
+    return (latest or 0) + 1
+
+def _append_messages(session, conversation, messages, version):
+    """Insert the messages that are not stored yet; only their ids are looked up"""
+    message_ids = [str(message.get('id') or message.get('timestamp') or index) for index, message in enumerate(messages)]
+    existing = set()
+    if message_ids:
+        existing = {
+            row.message_id for row in session.query(Message.message_id).filter(
+                Message.conversation_id == conversation.id, Message.message_id.in_(message_ids)
+            )
+        }
+
+    added = 0
+    for message_id, message in zip(message_ids, messages):
+        if message_id in existing or not message.get('role'):
+            continue
+        existing.add(message_id)
+        session.add(Message(
+            conversation_id=conversation.id,
+            message_id=message_id,
+            role=message['role'],
+            content=message.get('content') or '',
+            created_at=parse_client_time(message.get('timestamp')),
+            version=version
+        ))
+        added += 1
+    return added
+
+def _save_chat(session, user_id, chat_id, chat, conversation, version):
+    """Create or update one conversation from a browser chat object; returns (conversation, messages added)"""
+    if conversation is None:
+        conversation = Conversation(
+            user_id=user_id,
+            chat_id=chat_id,
+            title=chat.get('title') or 'New Chat',
+            created_at=parse_client_time(chat.get('createdAt'))
+        )
+        session.add(conversation)
+        session.flush()  # assigns conversation.id
+
+    added = _append_messages(session, conversation, chat.get('messages', []), version)
+    conversation.title = (chat.get('title') or conversation.title)[:255]
+    conversation.updated_at = parse_client_time(chat.get('updatedAt'))
+    conversation.version = version
+    conversation.deleted = False
+    return conversation, added
+
+def _delete_chats(session, conversations, version):
+    """Drop the conversations' messages and leave tombstones behind for delta sync"""
+    removed_ids = [conversation.id for conversation in conversations if not conversation.deleted]
+    if not removed_ids:
+        return
+    session.query(Message).filter(Message.conversation_id.in_(removed_ids)).delete(synchronize_session=False)
+    session.query(Conversation).filter(Conversation.id.in_(removed_ids)).update(
+        {Conversation.deleted: True, Conversation.version: version}, synchronize_session=False
+    )
+
+@retry_stale
+def apply_chat_changes_to_db(user_id, changes, deleted):
+    """Apply a delta sync: changed chats carry only their new messages, deleted is a list of chat ids.
+
+    Returns (versions by chat id, new version), or None on error.
+    """
+    session = get_db_session()
+    try:
+        version = _next_version(session, user_id)
+        chat_ids = [str(change.get('id')) for change in changes] + [str(chat_id) for chat_id in deleted]
+        stored = {}
+        if chat_ids:
+            stored = {
+                conversation.chat_id: conversation
+                for conversation in session.query(Conversation).filter(
+                    Conversation.user_id == user_id, Conversation.chat_id.in_(chat_ids)
+                )
+            }
+
+        versions = {}
+        for change in changes:
+            chat_id = str(change.get('id'))
+            stored[chat_id], _ = _save_chat(session, user_id, chat_id, change, stored.get(chat_id), version)
+            versions[chat_id] = version
+
+        _delete_chats(session, [stored[str(chat_id)] for chat_id in deleted if str(chat_id) in stored], version)
+        session.commit()
+        return versions, version
+
+    except Exception as e:
+        session.rollback()
+        if stale_connection(e):
+            raise
+        print(f"❌ Error applying chat changes: {e}")
+        return None
+
+    finally:
         session.close()
-        return False
-        
+
+@retry_stale
+def save_chat_history_to_db(user_id, chats):
+    """Store a browser's full chats object.
+
+    Chats whose updatedAt has not changed are skipped, changed chats only
+    insert their new messages, and chats missing from the object are deleted.
+    """
+    session = get_db_session()
+    try:
+        stored = {
+            conversation.chat_id: conversation
+            for conversation in session.query(Conversation).filter(Conversation.user_id == user_id)
+        }
+
+        version = None
+        for chat_id, chat in chats.items():
+            conversation = stored.pop(str(chat_id), None)
+            if (conversation is not None and not conversation.deleted
+                    and parse_client_time(chat.get('updatedAt')) == conversation.updated_at):
+                continue
+            version = version or _next_version(session, user_id)
+            _save_chat(session, user_id, str(chat_id), chat, conversation, version)
+
+        if any(not conversation.deleted for conversation in stored.values()):
+            _delete_chats(session, stored.values(), version or _next_version(session, user_id))
+
+        session.commit()
+        return True
+
     except Exception as e:
-        print(f"❌ Error updating chat history: {e}")
+        session.rollback()
+        if stale_connection(e):
+            raise
+        print(f"❌ Error saving chat history: {e}")
         return False
 
+    finally:
+        session.close()
+
+def import_legacy_chat_history(session, user_id):
+    """Move a user's old chat_history JSON blob into conversations/messages (once)"""
+    legacy = session.query(User.chat_history).filter(User.id == user_id).scalar()
+    if not legacy or legacy.strip() in ('', '{}'):
+        return
+
+    chats = json.loads(legacy)
+    version = _next_version(session, user_id)
+    for chat_id, chat in chats.items():
+        conversation = session.query(Conversation).filter(
+            Conversation.user_id == user_id, Conversation.chat_id == str(chat_id)
+        ).first()
+        _save_chat(session, user_id, str(chat_id), chat, conversation, version)
+    session.query(User).filter(User.id == user_id).update({User.chat_history: '{}'}, synchronize_session=False)
+    session.commit()
+    print(f"✅ Moved {len(chats)} legacy chats into conversations for user {user_id}")
+
+@retry_stale
+def get_chat_changes_from_db(user_id, since):
+    """Chats changed after version since, as (chats with only their new messages, deleted chat ids, cursor).
+
+    since=0 returns every chat in full.
+    """
+    session = get_db_session()
+    try:
+        import_legacy_chat_history(session, user_id)
+        query = session.query(Conversation).filter(Conversation.user_id == user_id)
+        if since > 0:
+            query = query.filter(Conversation.version > since)
+        conversations = query.all()
+
+        messages_by_conversation = {conversation.id: [] for conversation in conversations if not conversation.deleted}
+        if messages_by_conversation:
+            rows = session.query(Message).filter(Message.conversation_id.in_(list(messages_by_conversation)))
+            if since > 0:
+                rows = rows.filter(Message.version > since)
+            for message in rows.order_by(Message.conversation_id, Message.id):
+                messages_by_conversation[message.conversation_id].append(message)
+
+        chats = {
+            conversation.chat_id: conversation_to_dict(conversation, messages_by_conversation[conversation.id])
+            for conversation in conversations if not conversation.deleted
+        }
+        deleted = [conversation.chat_id for conversation in conversations if conversation.deleted]
+        cursor = max([since] + [conversation.version for conversation in conversations])
+        return chats, deleted, cursor
+
+    except Exception as e:
+        session.rollback()
+        if stale_connection(e):
+            raise
+        print(f"❌ Error getting chat changes: {e}")
+        return None
+
+    finally:
+        session.close()
+
+@retry_stale
+def get_chat_history_from_db(user_id, limit=None, before=None):
+    """Most recently updated conversations with their messages, as (chats, next_cursor).
+
+    before is the next_cursor of the previous page; next_cursor is None on the last page.
+    """
+    session = get_db_session()
+    try:
+        if before is None:
+            import_legacy_chat_history(session, user_id)
+
+        query = session.query(Conversation).filter(Conversation.user_id == user_id, Conversation.deleted.is_(False))
+        if before:
+            updated_at, _, last_id = before.partition('|')
+            updated_at = datetime.fromisoformat(updated_at)
+            query = query.filter(or_(
+                Conversation.updated_at < updated_at,
+                and_(Conversation.updated_at == updated_at, Conversation.id < int(last_id))
+            ))
+        query = query.order_by(Conversation.updated_at.desc(), Conversation.id.desc())
+        conversations = query.limit(limit + 1).all() if limit else query.all()
+
+        next_cursor = None
+        if limit and len(conversations) > limit:
+            conversations = conversations[:limit]
+            last = conversations[-1]
+            next_cursor = f"{last.updated_at.isoformat()}|{last.id}"
+
+        messages_by_conversation = {conversation.id: [] for conversation in conversations}
+        if conversations:
+            rows = session.query(Message).filter(
+                Message.conversation_id.in_(list(messages_by_conversation))
+            ).order_by(Message.conversation_id, Message.id)
+            for message in rows:
+                messages_by_conversation[message.conversation_id].append(message)
+
+        chats = {
+            conversation.chat_id: conversation_to_dict(conversation, messages_by_conversation[conversation.id])
+            for conversation in conversations
+        }
+        return chats, next_cursor
+
+    except Exception as e:
+        session.rollback()
+        if stale_connection(e):
+            raise
+        print(f"❌ Error getting chat history: {e}")
+        return {}, None
+
+    finally:
+        session.close()
+
+@retry_stale
+def get_chat_messages_from_db(user_id, chat_id, limit=None, before=None):
+    """A conversation's latest messages (oldest first) as (messages, next_cursor), or (None, None) if unknown.
+
+    before is the next_cursor of the previous page, which holds older messages.
+    """
+    session = get_db_session()
+    try:
+        conversation = session.query(Conversation).filter(
+            Conversation.user_id == user_id, Conversation.chat_id == str(chat_id)
+        ).first()
+        if conversation is None or conversation.deleted:
+            return None, None
+
+        query = session.query(Message).filter(Message.conversation_id == conversation.id)
+        if before:
+            query = query.filter(Message.id < int(before))
+        query = query.order_by(Message.id.desc())
+        rows = query.limit(limit + 1).all() if limit else query.all()
+
+        next_cursor = None
+        if limit and len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = str(rows[-1].id)
+        return [message_to_dict(message) for message in reversed(rows)], next_cursor
+
+    except Exception as e:
+        session.rollback()
+        if stale_connection(e):
+            raise
+        print(f"❌ Error getting chat messages: {e}")
+        return None, None
+
+    finally:
+        session.close()
+
+@retry_stale
+def get_recent_chat_messages_from_db(user_id, chat_id, start=0, limit=None):
+    """A conversation's messages from index start on, at most the latest limit, as (messages, offset).
+
+    offset is the index of the first message returned; (None, 0) if the conversation is unknown.
+    """
+    session = get_db_session()
+    try:
+        conversation = session.query(Conversation).filter(
+            Conversation.user_id == user_id, Conversation.chat_id == str(chat_id)
+        ).first()
+        if conversation is None or conversation.deleted:
+            return None, 0
+
+        query = session.query(Message).filter(Message.conversation_id == conversation.id)
+        total = query.count()
+        if start > total:
+            start = 0  # messages were removed since; the caller starts over
+        if limit:
+            start = max(start, total - limit)
+        rows = query.order_by(Message.id).offset(start).all()
+        return [message_to_dict(message) for message in rows], start
+
+    except Exception as e:
+        session.rollback()
+        if stale_connection(e):
+            raise
+        print(f"❌ Error getting chat messages: {e}")
+        return None, 0
+
+    finally:
+        session.close()
+
 def save_uploaded_file_to_db(user_id, filename, file_path, file_size):
     """Save uploaded file info to database"""
+    session = get_db_session()
     try:
-        session = get_db_session()
-        
         uploaded_file = UploadedFile(
             user_id=user_id,
             filename=filename,
@@ -180,19 +694,22 @@ def save_uploaded_file_to_db(user_id, filename, file_path, file_size):
         
         session.add(uploaded_file)
         session.commit()
-        session.close()
         
         return True
         
     except Exception as e:
+        session.rollback()
         print(f"❌ Error saving file to database: {e}")
         return False
 
+    finally:
+        session.close()
+
+@retry_stale
 def get_user_files_from_db(user_id):
     """Get user's uploaded files from database"""
+    session = get_db_session()
     try:
-        session = get_db_session()
-        
         files = session.query(UploadedFile).filter(UploadedFile.user_id == user_id).all()
         
         file_list = []
@@ -204,13 +721,18 @@ def get_user_files_from_db(user_id):
                 'size': file.file_size
             })
         
-        session.close()
         return file_list
         
     except Exception as e:
+        session.rollback()
+        if stale_connection(e):
+            raise
         print(f"❌ Error getting user files: {e}")
         return []
 
+    finally:
+        session.close()
+
 # Test database connection
 if __name__ == "__main__":
     if init_database():
@@ -0,0 +1,142 @@
+import os
+import time
+import threading
+from functools import wraps
+from dotenv import load_dotenv
+from sqlalchemy.exc import DBAPIError, TimeoutError as PoolTimeout
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+
+# Load environment variables
+load_dotenv()
+
+# Connection pool settings (shared by the sync and asyncio engines)
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '5'))  # connections kept open
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '10'))  # extra connections opened under load
+DB_POOL_TIMEOUT = int(os.getenv('DB_POOL_TIMEOUT', '30'))  # seconds to wait for a free connection
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', '1800'))  # reconnect connections older than this (seconds)
+DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', 'true').lower() == 'true'
+DB_STALE_RETRIES = int(os.getenv('DB_STALE_RETRIES', '1'))  # reruns of a call whose connection dropped
+DB_SLOW_CHECKOUT = 0.1  # seconds; checkouts that waited longer count as contended
+
+class PoolMetrics:
+    """How long checkouts waited for a connection, and how many were in use"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checkouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.slow_checkouts = 0
+        self.timeouts = 0
+        self.peak_checked_out = 0
+
+    def record(self, wait, checked_out, timed_out=False):
+        with self.lock:
+            if timed_out:
+                self.timeouts += 1
+                return
+            self.checkouts += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+            if wait > DB_SLOW_CHECKOUT:
+                self.slow_checkouts += 1
+            self.peak_checked_out = max(self.peak_checked_out, checked_out)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "checkouts": self.checkouts,
+                "wait_avg_ms": round(self.wait_total / self.checkouts * 1000, 2) if self.checkouts else 0,
+                "wait_max_ms": round(self.wait_max * 1000, 2),
+                "slow_checkouts": self.slow_checkouts,
+                "timeouts": self.timeouts,
+                "peak_checked_out": self.peak_checked_out
+            }
+
+class MeteredPool:
+    """Pool mixin that times every checkout, including waiting for a connection to free up"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = PoolMetrics()
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except PoolTimeout:
+            self.metrics.record(time.perf_counter() - start, 0, timed_out=True)
+            raise
+        self.metrics.record(time.perf_counter() - start, self.checkedout())
+        return connection
+
+    def recreate(self):
+        # The engine replaces its pool after a disconnect; keep counting in the new one
+        pool = super().recreate()
+        pool.metrics = self.metrics
+        return pool
+
+class MeteredQueuePool(MeteredPool, QueuePool):
+    pass
+
+class MeteredAsyncQueuePool(MeteredPool, AsyncAdaptedQueuePool):
+    pass
+
+def pool_options(asyncio=False):
+    """create_engine() keyword arguments for the configured pool"""
+    return {
+        "poolclass": MeteredAsyncQueuePool if asyncio else MeteredQueuePool,
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": DB_POOL_PRE_PING
+    }
+
+def pool_stats(engine):
+    pool = engine.pool
+    capacity = DB_POOL_SIZE + max(DB_MAX_OVERFLOW, 0)
+    checked_out = pool.checkedout()
+    return {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "checked_out": checked_out,
+        "idle": pool.checkedin(),
+        "utilization": round(checked_out / capacity, 3) if capacity else 0,
+        **pool.metrics.stats()
+    }
+
+retry_state = threading.local()
+
+def stale_connection(e):
+    """True if e is a dropped connection and the current call will be run again.
+
+    Database functions that catch their own errors re-raise these so
+    retry_stale can rerun them.
+    """
+    return (isinstance(e, DBAPIError) and e.connection_invalidated
+            and getattr(retry_state, 'remaining', 0) > 0)
+
+def retry_stale(fn):
+    """Rerun a database call whose connection dropped while it ran.
+
+    Pre-ping replaces connections that died while idle in the pool; this
+    covers the ones lost mid-call, e.g. to a database restart or failover.
+    Only use it on reads and idempotent writes.
+    """
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        outer = getattr(retry_state, 'remaining', 0)
+        retry_state.remaining = DB_STALE_RETRIES
+        try:
+            while True:
+                try:
+                    return fn(*args, **kwargs)
+                except DBAPIError as e:
+                    if not (e.connection_invalidated and retry_state.remaining > 0):
+                        raise
+                    retry_state.remaining -= 1
+                    print(f"⚠️ Database connection lost, retrying: {e.orig}")
+        finally:
+            retry_state.remaining = outer
+    return wrapper
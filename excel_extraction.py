@@ -0,0 +1,75 @@
+import os
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Excel summary settings
+EXCEL_SAMPLE_ROWS = int(os.getenv('EXCEL_SAMPLE_ROWS', '10'))
+EXCEL_TOP_VALUES = int(os.getenv('EXCEL_TOP_VALUES', '5'))
+EXCEL_MAX_COLUMNS = int(os.getenv('EXCEL_MAX_COLUMNS', '50'))  # columns described per sheet
+
+def format_number(value):
+    """Format a statistic compactly for the prompt"""
+    if value is None or value != value:  # NaN check without importing numpy
+        return "n/a"
+    if isinstance(value, float):
+        return f"{value:.4g}"
+    return str(value)
+
+def describe_sheet(sheet_name, df):
+    """Render one sheet as schema, per-column statistics and sampled rows"""
+    rows, cols = df.shape
+    lines = [f"Sheet: {sheet_name} ({rows} rows x {cols} columns)"]
+    if rows == 0 or cols == 0:
+        lines.append("(empty sheet)")
+        return "\n".join(lines)
+
+    df = df.iloc[:, :EXCEL_MAX_COLUMNS]
+
+    # Column-wide aggregates are computed once for the whole frame
+    missing = df.isna().sum()
+    unique = df.nunique(dropna=True)
+    numeric = df.select_dtypes(include='number')
+    numeric_stats = numeric.agg(['min', 'max', 'mean', 'median']) if not numeric.empty else None
+    datetimes = df.select_dtypes(include='datetime')
+    date_stats = datetimes.agg(['min', 'max']) if not datetimes.empty else None
+
+    lines.append("Columns:")
+    for column in df.columns:
+        details = [str(df[column].dtype)]
+        if numeric_stats is not None and column in numeric_stats.columns:
+            stats = numeric_stats[column]
+            details.append(
+                f"min {format_number(stats['min'])}, max {format_number(stats['max'])}, "
+                f"mean {format_number(stats['mean'])}, median {format_number(stats['median'])}"
+            )
+        elif date_stats is not None and column in date_stats.columns:
+            details.append(f"from {date_stats[column]['min']} to {date_stats[column]['max']}")
+        else:
+            details.append(f"{unique[column]} unique")
+            top_values = df[column].value_counts(dropna=True).head(EXCEL_TOP_VALUES)
+            if len(top_values):
+                details.append("top: " + ", ".join(f"{value} ({count})" for value, count in top_values.items()))
+        if missing[column]:
+            details.append(f"{missing[column]} missing")
+        lines.append(f"- {column}: " + "; ".join(details))
+
+    if cols > EXCEL_MAX_COLUMNS:
+        lines.append(f"- ... {cols - EXCEL_MAX_COLUMNS} more columns not shown")
+
+    # Evenly spaced sample so the rows cover the whole sheet, deterministically
+    step = max(1, rows // EXCEL_SAMPLE_ROWS)
+    sample = df.iloc[::step].head(EXCEL_SAMPLE_ROWS)
+    lines.append(f"Sample rows ({len(sample)} of {rows}):")
+    lines.append(sample.to_string(index=False, na_rep=''))
+
+    return "\n".join(lines)
+
+def extract_excel_summary(excel_path):
+    """Read every sheet in one pass and return a compact text summary"""
+    import pandas as pd
+
+    # sheet_name=None parses the workbook once and returns all sheets
+    sheets = pd.read_excel(excel_path, sheet_name=None)
+    return "\n\n".join(describe_sheet(sheet_name, df) for sheet_name, df in sheets.items())
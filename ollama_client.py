@@ -0,0 +1,540 @@
+import os
+import time
+import random
+import asyncio
+import threading
+from collections import OrderedDict
+import requests
+from requests.adapters import HTTPAdapter
+from singleflight import flight_key, SingleFlight, StreamFanout, AsyncSingleFlight, AsyncStreamFanout
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Ollama configuration
+OLLAMA_URL = os.getenv('OLLAMA_URL', 'http://localhost:11434')
+OLLAMA_MODEL = os.getenv('OLLAMA_MODEL', 'tinyllama')
+OLLAMA_POOL_SIZE = int(os.getenv('OLLAMA_POOL_SIZE', '10'))
+OLLAMA_KEEP_ALIVE = os.getenv('OLLAMA_KEEP_ALIVE', '30m')  # keep the model (and its prompt cache) loaded between turns
+OLLAMA_ASYNC_MAX_CONNECTIONS = int(os.getenv('OLLAMA_ASYNC_MAX_CONNECTIONS', '100'))  # async serving mode
+
+# Per-operation read timeouts (seconds); connecting should always be quick
+OLLAMA_CONNECT_TIMEOUT = float(os.getenv('OLLAMA_CONNECT_TIMEOUT', '3'))
+OLLAMA_TIMEOUTS = {
+    'chat': float(os.getenv('OLLAMA_CHAT_TIMEOUT', '30')),
+    'analysis': float(os.getenv('OLLAMA_ANALYSIS_TIMEOUT', '120')),
+    'summary': float(os.getenv('OLLAMA_SUMMARY_TIMEOUT', '120')),
+}
+
+# Retry and circuit breaker settings
+OLLAMA_RETRIES = int(os.getenv('OLLAMA_RETRIES', '2'))
+OLLAMA_BACKOFF_BASE = float(os.getenv('OLLAMA_BACKOFF_BASE', '0.25'))  # seconds
+OLLAMA_BREAKER_THRESHOLD = int(os.getenv('OLLAMA_BREAKER_THRESHOLD', '5'))  # consecutive failures
+OLLAMA_BREAKER_RESET = float(os.getenv('OLLAMA_BREAKER_RESET', '30'))  # seconds before a trial call
+
+# Backend pool: comma-separated Ollama servers that all serve OLLAMA_MODEL
+OLLAMA_URLS = [url.strip().rstrip('/') for url in os.getenv('OLLAMA_URLS', OLLAMA_URL).split(',') if url.strip()]
+OLLAMA_HEALTH_INTERVAL = float(os.getenv('OLLAMA_HEALTH_INTERVAL', '10'))  # seconds between checks (0 = off)
+OLLAMA_HEALTH_TIMEOUT = float(os.getenv('OLLAMA_HEALTH_TIMEOUT', '2'))
+OLLAMA_AFFINITY = os.getenv('OLLAMA_AFFINITY', 'true').lower() == 'true'  # keep a user on one server
+OLLAMA_AFFINITY_SLACK = int(os.getenv('OLLAMA_AFFINITY_SLACK', '2'))  # extra load tolerated to stay there
+OLLAMA_AFFINITY_MAX_KEYS = 10000
+
+class OllamaUnavailable(requests.exceptions.ConnectionError):
+    """Raised without touching the network while the circuit breaker is open"""
+
+class CircuitBreaker:
+    """Stop calling Ollama after repeated failures and probe again after a cool-down"""
+
+    def __init__(self, threshold=OLLAMA_BREAKER_THRESHOLD, reset_after=OLLAMA_BREAKER_RESET, name='Ollama'):
+        self.name = name
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_progress = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_after:
+            return 'half_open'
+        return 'open'
+
+    def allow(self):
+        """Return True if a call may go out now"""
+        with self.lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half_open' and not self.trial_in_progress:
+                # Let exactly one trial request through
+                self.trial_in_progress = True
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_progress = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_in_progress = False
+            if self.failures >= self.threshold or self.opened_at is not None:
+                if self.opened_at is None:
+                    print(f"⚠️ {self.name} circuit breaker opened after {self.failures} failures")
+                self.opened_at = time.monotonic()
+
+    def abort_trial(self):
+        """Settle a call that ended in an unexpected error: if it was the half-open trial,
+        count it as failed so the breaker probes again after the next cool-down"""
+        with self.lock:
+            if self.trial_in_progress:
+                self.trial_in_progress = False
+                self.failures += 1
+                self.opened_at = time.monotonic()
+
+class OllamaBackend:
+    """One Ollama server in the pool and its routing state"""
+
+    def __init__(self, url):
+        self.url = url
+        self.chat_url = f"{url}/api/chat"
+        self.breaker = CircuitBreaker(name=f"Ollama {url}")
+        self.outstanding = 0
+        self.requests = 0
+        self.healthy = True  # until a health check says otherwise
+        self.health_error = None
+        self.last_checked = None
+        self.draining = False
+
+    def routable(self):
+        return self.healthy and not self.draining and self.breaker.state != 'open'
+
+    def to_dict(self):
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "health_error": self.health_error,
+            "last_checked": self.last_checked,
+            "draining": self.draining,
+            "drained": self.draining and self.outstanding == 0,
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "breaker_state": self.breaker.state,
+            "consecutive_failures": self.breaker.failures
+        }
+
+class BackendPool:
+    """Route Ollama calls across several servers that serve the same model.
+
+    Each call goes to the healthy backend with the fewest outstanding
+    requests. With affinity, a user's calls stay on the backend that served
+    them last, so Ollama can reuse the conversation's KV cache, unless that
+    backend is more than affinity_slack requests busier than the least
+    loaded one. A draining backend gets no new calls while its in-flight
+    ones finish. Backends are probed in the background and skipped while
+    unhealthy or while their circuit breaker is open.
+    """
+
+    def __init__(self, urls=OLLAMA_URLS, model=OLLAMA_MODEL, affinity=OLLAMA_AFFINITY,
+                 affinity_slack=OLLAMA_AFFINITY_SLACK):
+        self.backends = [OllamaBackend(url) for url in (urls or [OLLAMA_URL])]
+        self.model = model
+        self.affinity = affinity
+        self.affinity_slack = affinity_slack
+        self.lock = threading.Lock()
+        self.pinned = OrderedDict()  # affinity key -> backend, least recently used first
+        self.affinity_hits = 0
+        self.affinity_moves = 0
+        self.health_thread = None
+
+    def __len__(self):
+        return len(self.backends)
+
+    def routable_count(self):
+        """Backends that can take calls now (healthy, not draining, breaker not open)"""
+        return sum(1 for backend in self.backends if backend.routable())
+
+    def find(self, url):
+        url = url.strip().rstrip('/')
+        return next((backend for backend in self.backends if backend.url == url), None)
+
+    def _choose(self, candidates, affinity_key):
+        least = min(candidates, key=lambda backend: (backend.outstanding, backend.requests))
+        pinned = self.pinned.get(affinity_key) if affinity_key is not None and self.affinity else None
+        if pinned is None:
+            return least
+        if pinned in candidates and pinned.outstanding <= least.outstanding + self.affinity_slack:
+            self.affinity_hits += 1
+            return pinned
+        self.affinity_moves += 1
+        return least
+
+    def acquire(self, affinity_key=None, avoid=()):
+        """Pick a backend for one call and count it as outstanding; raises OllamaUnavailable.
+
+        Backends in avoid (already tried for this call) are used only if nothing else is left.
+        """
+        with self.lock:
+            candidates = [backend for backend in self.backends if backend.routable()]
+            candidates = [backend for backend in candidates if backend not in avoid] or candidates
+            while candidates:
+                backend = self._choose(candidates, affinity_key)
+                if backend.breaker.allow():
+                    backend.outstanding += 1
+                    backend.requests += 1
+                    if affinity_key is not None and self.affinity:
+                        self.pinned[affinity_key] = backend
+                        self.pinned.move_to_end(affinity_key)
+                        if len(self.pinned) > OLLAMA_AFFINITY_MAX_KEYS:
+                            self.pinned.popitem(last=False)
+                    return backend
+                candidates.remove(backend)
+        raise OllamaUnavailable("No Ollama backend is available")
+
+    def release(self, backend):
+        with self.lock:
+            backend.outstanding -= 1
+
+    def drain(self, url, draining=True):
+        """Stop (or resume) sending new calls to a backend; returns its state, or None if unknown"""
+        backend = self.find(url)
+        if backend is None:
+            return None
+        with self.lock:
+            backend.draining = draining
+            if draining:
+                for key in [key for key, pinned in self.pinned.items() if pinned is backend]:
+                    del self.pinned[key]
+        print(f"{'🚰 Draining' if draining else '▶️ Resuming'} Ollama backend {backend.url}")
+        return backend.to_dict()
+
+    def serves_model(self, names):
+        return self.model in names or f"{self.model}:latest" in names
+
+    def check_health(self):
+        """Probe each backend's /api/tags and check that it has the model"""
+        for backend in self.backends:
+            try:
+                response = requests.get(f"{backend.url}/api/tags", timeout=OLLAMA_HEALTH_TIMEOUT)
+                response.raise_for_status()
+                names = {model.get('name', '') for model in response.json().get('models', [])}
+                error = None if self.serves_model(names) else f"model {self.model} is not available"
+            except (requests.exceptions.RequestException, ValueError) as e:
+                error = str(e)
+
+            if backend.healthy and error:
+                print(f"⚠️ Ollama backend {backend.url} is unhealthy: {error}")
+            elif not backend.healthy and not error:
+                print(f"✅ Ollama backend {backend.url} is healthy again")
+            backend.healthy = error is None
+            backend.health_error = error
+            backend.last_checked = time.time()
+
+    def start_health_checks(self, interval=OLLAMA_HEALTH_INTERVAL):
+        """Run check_health every interval seconds in a daemon thread"""
+        if interval <= 0 or self.health_thread is not None:
+            return
+
+        def run():
+            while True:
+                self.check_health()
+                time.sleep(interval)
+
+        self.health_thread = threading.Thread(target=run, daemon=True, name='ollama-health')
+        self.health_thread.start()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "backends": [backend.to_dict() for backend in self.backends],
+                "affinity": self.affinity,
+                "affinity_keys": len(self.pinned),
+                "affinity_hits": self.affinity_hits,
+                "affinity_moves": self.affinity_moves
+            }
+
+class PooledResponse:
+    """Streaming response that hands its backend back to the pool once closed"""
+
+    def __init__(self, response, release):
+        self.response = response
+        self.release = release
+        self.lock = threading.Lock()
+        self.released = False
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+    def _release(self):
+        with self.lock:
+            if self.released:
+                return
+            self.released = True
+        self.release()
+
+    def close(self):
+        try:
+            self.response.close()
+        finally:
+            self._release()
+
+    async def aclose(self):
+        try:
+            await self.response.aclose()
+        finally:
+            self._release()
+
+class OllamaClient:
+    """Shared keep-alive HTTP client for every call to the Ollama chat API"""
+
+    def __init__(self, backends=None, model=OLLAMA_MODEL, pool_size=OLLAMA_POOL_SIZE):
+        self.backends = backends or BackendPool(model=model)
+        self.model = model
+        self.pool_size = pool_size
+
+        # One pooled session reuses TCP connections across requests and threads
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=len(self.backends), pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        # Identical concurrent requests share one upstream call or stream
+        self.flights = SingleFlight()
+        self.streams = StreamFanout()
+
+    def timeout_for(self, operation):
+        """Return the (connect, read) timeout tuple for an operation"""
+        return (OLLAMA_CONNECT_TIMEOUT, OLLAMA_TIMEOUTS.get(operation, OLLAMA_TIMEOUTS['chat']))
+
+    def post_chat(self, messages, operation='chat', stream=False, options=None, affinity=None):
+        """POST to /api/chat on a pool backend, failing over on connection errors; returns the raw response.
+
+        affinity (e.g. the user id) keeps related calls on the same backend when it is not overloaded.
+        """
+        payload = {
+            "model": self.model,
+            "messages": messages,
+            "stream": stream
+        }
+        if options:
+            payload["options"] = options
+        if OLLAMA_KEEP_ALIVE:
+            payload["keep_alive"] = OLLAMA_KEEP_ALIVE
+
+        tried = []
+        for attempt in range(OLLAMA_RETRIES + 1):
+            backend = self.backends.acquire(affinity, avoid=tried)
+            tried.append(backend)
+            try:
+                response = self.session.post(
+                    backend.chat_url,
+                    json=payload,
+                    timeout=self.timeout_for(operation),
+                    stream=stream
+                )
+            except requests.exceptions.ConnectionError:
+                # Covers refused connections and connect timeouts; safe to retry on another backend
+                self.backends.release(backend)
+                backend.breaker.record_failure()
+                if attempt >= OLLAMA_RETRIES:
+                    raise
+                if len(set(tried)) >= len(self.backends):
+                    time.sleep(random.uniform(0, OLLAMA_BACKOFF_BASE * (2 ** attempt)))
+                continue
+            except requests.exceptions.Timeout:
+                # A read timeout means Ollama is overloaded; retrying would only pile on
+                self.backends.release(backend)
+                backend.breaker.record_failure()
+                raise
+            except Exception:
+                self.backends.release(backend)
+                backend.breaker.abort_trial()
+                raise
+
+            if response.status_code >= 500:
+                backend.breaker.record_failure()
+            else:
+                backend.breaker.record_success()
+            if stream:
+                # The backend stays busy until the stream is closed
+                return PooledResponse(response, lambda: self.backends.release(backend))
+            self.backends.release(backend)
+            return response
+
+    def chat(self, messages, operation='chat', options=None, affinity=None):
+        """Run a non-streaming chat call and return the reply text (or None).
+
+        Concurrent calls with the same model, operation, messages and options share one request.
+        """
+        key = flight_key(self.model, messages, options, operation)
+        return self.flights.do(key, lambda: self._chat_once(messages, operation, options, affinity))
+
+    def _chat_once(self, messages, operation, options, affinity):
+        response = self.post_chat(messages, operation=operation, options=options, affinity=affinity)
+        if response.status_code != 200:
+            return None
+        data = response.json()
+        if "message" in data and "content" in data["message"]:
+            return data["message"]["content"]
+        return None
+
+    def embed(self, text, model):
+        """Embedding vector for text from an embedding model (e.g. nomic-embed-text), or None"""
+        backend = self.backends.acquire()
+        try:
+            response = self.session.post(f"{backend.url}/api/embed",
+                                         json={"model": model, "input": text},
+                                         timeout=self.timeout_for('chat'))
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            backend.breaker.record_failure()
+            raise
+        except Exception:
+            backend.breaker.abort_trial()
+            raise
+        finally:
+            self.backends.release(backend)
+        if response.status_code >= 500:
+            backend.breaker.record_failure()
+        else:
+            backend.breaker.record_success()
+        if response.status_code != 200:
+            return None
+        embeddings = response.json().get("embeddings")
+        return embeddings[0] if embeddings else None
+
+    def open_chat_stream(self, messages, operation='chat', options=None, affinity=None):
+        """Open a streaming chat and return a response-like subscriber.
+
+        Concurrent identical requests share one generation: each subscriber
+        gets every line from the start, and closing the last one closes the
+        upstream response.
+        """
+        key = flight_key(self.model, messages, options, operation)
+        return self.streams.open(
+            key, lambda: self.post_chat(messages, operation=operation, stream=True, options=options, affinity=affinity)
+        )
+
+    def stats(self):
+        """Return connection pool, backend and request sharing status"""
+        return {
+            "model": self.model,
+            "pool_size": self.pool_size,
+            **self.backends.stats(),
+            "calls": {"started": self.flights.started, "shared": self.flights.joined},
+            "shared_streams": {"started": self.streams.started, "shared": self.streams.joined}
+        }
+
+class AsyncOllamaClient:
+    """asyncio counterpart of OllamaClient for the ASGI serving mode (uses httpx)"""
+
+    def __init__(self, backends=None, model=OLLAMA_MODEL, max_connections=OLLAMA_ASYNC_MAX_CONNECTIONS):
+        import httpx
+
+        self.httpx = httpx
+        self.backends = backends or BackendPool(model=model)
+        self.model = model
+        self.max_connections = max_connections
+
+        # Requests beyond max_connections wait for a free connection instead of failing
+        self.client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=OLLAMA_POOL_SIZE)
+        )
+        self.flights = AsyncSingleFlight()
+        self.streams = AsyncStreamFanout()
+
+    def timeout_for(self, operation):
+        """Return the httpx timeout for an operation"""
+        read_timeout = OLLAMA_TIMEOUTS.get(operation, OLLAMA_TIMEOUTS['chat'])
+        return self.httpx.Timeout(read_timeout, connect=OLLAMA_CONNECT_TIMEOUT, pool=None)
+
+    async def post_chat(self, messages, operation='chat', stream=False, options=None, affinity=None):
+        """POST to /api/chat on a pool backend, failing over on connection errors; returns the raw httpx response.
+
+        With stream=True the body is not read yet; the caller must aclose() the response.
+        """
+        payload = {
+            "model": self.model,
+            "messages": messages,
+            "stream": stream
+        }
+        if options:
+            payload["options"] = options
+        if OLLAMA_KEEP_ALIVE:
+            payload["keep_alive"] = OLLAMA_KEEP_ALIVE
+
+        tried = []
+        for attempt in range(OLLAMA_RETRIES + 1):
+            backend = self.backends.acquire(affinity, avoid=tried)
+            tried.append(backend)
+            request = self.client.build_request('POST', backend.chat_url, json=payload,
+                                                timeout=self.timeout_for(operation))
+            try:
+                response = await self.client.send(request, stream=stream)
+            except (self.httpx.ConnectError, self.httpx.ConnectTimeout):
+                self.backends.release(backend)
+                backend.breaker.record_failure()
+                if attempt >= OLLAMA_RETRIES:
+                    raise
+                if len(set(tried)) >= len(self.backends):
+                    await asyncio.sleep(random.uniform(0, OLLAMA_BACKOFF_BASE * (2 ** attempt)))
+                continue
+            except self.httpx.TimeoutException:
+                self.backends.release(backend)
+                backend.breaker.record_failure()
+                raise
+            except BaseException:
+                # Includes cancellation while waiting for the response
+                self.backends.release(backend)
+                backend.breaker.abort_trial()
+                raise
+
+            if response.status_code >= 500:
+                backend.breaker.record_failure()
+            else:
+                backend.breaker.record_success()
+            if stream:
+                return PooledResponse(response, lambda: self.backends.release(backend))
+            self.backends.release(backend)
+            return response
+
+    async def chat(self, messages, operation='chat', options=None, affinity=None):
+        """Run a non-streaming chat call and return the reply text (or None), shared like OllamaClient.chat"""
+        key = flight_key(self.model, messages, options, operation)
+        return await self.flights.do(key, lambda: self._chat_once(messages, operation, options, affinity))
+
+    async def _chat_once(self, messages, operation, options, affinity):
+        response = await self.post_chat(messages, operation=operation, options=options, affinity=affinity)
+        if response.status_code != 200:
+            return None
+        data = response.json()
+        if "message" in data and "content" in data["message"]:
+            return data["message"]["content"]
+        return None
+
+    async def open_chat_stream(self, messages, operation='chat', options=None, affinity=None):
+        """Open a streaming chat shared with identical in-flight requests (see OllamaClient.open_chat_stream)"""
+        key = flight_key(self.model, messages, options, operation)
+        return await self.streams.open(
+            key, lambda: self.post_chat(messages, operation=operation, stream=True, options=options, affinity=affinity)
+        )
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    def stats(self):
+        """Return connection limit, backend and request sharing status"""
+        return {
+            "model": self.model,
+            "max_connections": self.max_connections,
+            **self.backends.stats(),
+            "calls": {"started": self.flights.started, "shared": self.flights.joined},
+            "shared_streams": {"started": self.streams.started, "shared": self.streams.joined}
+        }
@@ -0,0 +1,169 @@
+import os
+import time
+import queue
+import multiprocessing
+from contextlib import ExitStack
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+import PyPDF2
+import pdfplumber
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Parallel extraction settings
+PDF_EXTRACT_WORKERS = int(os.getenv('PDF_EXTRACT_WORKERS', str(os.cpu_count() or 1)))
+PDF_PARALLEL_MIN_PAGES = int(os.getenv('PDF_PARALLEL_MIN_PAGES', '20'))  # smaller files stay in-process
+PDF_PAGES_PER_TASK = int(os.getenv('PDF_PAGES_PER_TASK', '10'))
+PDF_PAGE_TIMEOUT = float(os.getenv('PDF_PAGE_TIMEOUT', '10'))  # seconds per page, from when a worker starts the range
+PDF_QUEUED_POLL = 0.5  # seconds between checks whether a queued range has started
+
+_range_started = None  # in worker processes: queue reporting (first page, time) as each range starts
+
+def extract_pages(pdf_path, start=0, end=None):
+    """Yield the text of pages [start, end) lazily, one page at a time.
+
+    pdfplumber is tried first for every page; pages where it finds no text
+    fall back to PyPDF2 individually instead of re-parsing the whole file.
+    """
+    with ExitStack() as stack:
+        pdf = stack.enter_context(pdfplumber.open(pdf_path))
+        fallback_reader = None
+
+        for index, page in enumerate(pdf.pages[start:end], start):
+            try:
+                page_text = page.extract_text() or ""
+            except Exception as e:
+                print(f"⚠️ pdfplumber failed on page {index + 1}: {e}")
+                page_text = ""
+            finally:
+                # Drop pdfplumber's parsed objects so memory stays flat in page count
+                page.close()
+
+            if not page_text.strip():
+                try:
+                    if fallback_reader is None:
+                        pdf_file = stack.enter_context(open(pdf_path, 'rb'))
+                        fallback_reader = PyPDF2.PdfReader(pdf_file)
+                    page_text = fallback_reader.pages[index].extract_text() or ""
+                except Exception as e:
+                    print(f"⚠️ PyPDF2 failed on page {index + 1}: {e}")
+                    page_text = ""
+
+            yield page_text
+
+def _init_worker(started):
+    global _range_started
+    _range_started = started
+
+def extract_page_range(pdf_path, start, end):
+    """Extract pages [start, end) in a worker process"""
+    if _range_started is not None:
+        _range_started.put((start, time.time()))
+    return list(extract_pages(pdf_path, start, end))
+
+def count_pdf_pages(pdf_path):
+    """Return the number of pages in a PDF"""
+    with open(pdf_path, 'rb') as f:
+        return len(PyPDF2.PdfReader(f).pages)
+
+class ExtractionPool:
+    """Worker processes for one document's extraction.
+
+    Each extraction gets its own pool, so killing a stuck worker never
+    touches another upload's ranges. Workers report when they start a
+    range, so its timeout runs from then rather than from when it was queued.
+    """
+
+    def __init__(self, workers):
+        self.started = multiprocessing.Queue()
+        self.started_at = {}  # first page of a range -> time a worker started it
+        self.executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                            initargs=(self.started,))
+
+    def submit(self, pdf_path, start, end):
+        return self.executor.submit(extract_page_range, pdf_path, start, end)
+
+    def start_time(self, start):
+        while True:
+            try:
+                page, started_at = self.started.get_nowait()
+            except queue.Empty:
+                break
+            self.started_at[page] = started_at
+        return self.started_at.get(start)
+
+    def result(self, future, start, end, page_timeout):
+        """Wait for a range; raises FutureTimeoutError once it has run longer than its timeout"""
+        limit = page_timeout * (end - start)
+        while True:
+            started_at = self.start_time(start)
+            if started_at is None:
+                wait = PDF_QUEUED_POLL
+            else:
+                wait = limit - (time.time() - started_at)
+                if wait <= 0:
+                    raise FutureTimeoutError()
+            try:
+                return future.result(timeout=wait)
+            except FutureTimeoutError:
+                continue
+
+    def close(self, terminate=False):
+        """Stop the pool; terminate also kills its workers, which shutdown() leaves running when stuck"""
+        workers = list((getattr(self.executor, '_processes', None) or {}).values()) if terminate else []
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        for process in workers:
+            if process.is_alive():
+                process.terminate()
+
+def finished_ok(future):
+    return future.done() and not future.cancelled() and future.exception() is None
+
+def iter_pdf_pages_parallel(pdf_path, page_count, pages_per_task=PDF_PAGES_PER_TASK,
+                            page_timeout=PDF_PAGE_TIMEOUT):
+    """Extract page ranges on a process pool of their own and yield page text in order"""
+    ranges = [(start, min(start + pages_per_task, page_count))
+              for start in range(0, page_count, pages_per_task)]
+    workers = min(PDF_EXTRACT_WORKERS, len(ranges))
+    pool = ExtractionPool(workers)
+    futures = [pool.submit(pdf_path, start, end) for start, end in ranges]
+
+    def restart():
+        # Replace the pool and queue the ranges that have not finished on the new one
+        nonlocal pool
+        pool.close(terminate=True)
+        pool = ExtractionPool(workers)
+        for later in range(index + 1, len(ranges)):
+            if not finished_ok(futures[later]):
+                futures[later] = pool.submit(pdf_path, *ranges[later])
+
+    try:
+        for index, (start, end) in enumerate(ranges):
+            try:
+                pages = pool.result(futures[index], start, end, page_timeout)
+            except FutureTimeoutError:
+                print(f"⚠️ Pages {start + 1}-{end} timed out after {page_timeout}s per page, skipping")
+                restart()
+                pages = [""] * (end - start)
+            except Exception as e:
+                # A crashed worker breaks the pool; finish this range in-process
+                print(f"⚠️ Parallel extraction failed for pages {start + 1}-{end}: {e}")
+                restart()
+                pages = list(extract_pages(pdf_path, start, end))
+
+            yield from pages
+    finally:
+        # Also stops queued ranges if the consumer gives up early
+        pool.close(terminate=True)
+
+def iter_pdf_pages(pdf_path):
+    """Yield PDF page text in order, using the process pool for large files"""
+    if PDF_EXTRACT_WORKERS > 1:
+        page_count = count_pdf_pages(pdf_path)
+        if page_count >= PDF_PARALLEL_MIN_PAGES:
+            print(f"Extracting {page_count} pages with {PDF_EXTRACT_WORKERS} processes...")
+            yield from iter_pdf_pages_parallel(pdf_path, page_count)
+            return
+
+    yield from extract_pages(pdf_path)
@@ -0,0 +1,229 @@
+import os
+import json
+import math
+import time
+import random
+import hashlib
+import threading
+from array import array
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Response cache settings (only used for deterministic requests)
+RESPONSE_CACHE_ENABLED = os.getenv('RESPONSE_CACHE_ENABLED', 'true').lower() == 'true'
+RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', '3600'))  # seconds
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', '2000'))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv('RESPONSE_CACHE_MAX_BYTES', str(16 * 1024 * 1024)))
+# Near-duplicate questions: 0 = exact matches only (default). Matching uses a sentence embedding
+# model served by Ollama; keep the threshold strict (e.g. 0.97), as questions that differ by one
+# word ("install" / "uninstall") can still score above 0.9.
+RESPONSE_CACHE_SIMILARITY = float(os.getenv('RESPONSE_CACHE_SIMILARITY', '0'))
+RESPONSE_CACHE_EMBED_MODEL = os.getenv('RESPONSE_CACHE_EMBED_MODEL', 'nomic-embed-text')
+LSH_TABLES = 4  # random-hyperplane hash tables for the similarity index
+LSH_BITS = 8  # hyperplanes per table
+
+def is_deterministic(options):
+    """Replies can be reused only when sampling is pinned: temperature 0 or a fixed seed"""
+    if not options:
+        return False
+    return options.get('temperature') == 0 or options.get('seed') is not None
+
+def normalize_text(text):
+    """Case-fold and collapse whitespace so trivially different prompts match"""
+    return " ".join(text.casefold().split())
+
+def unit_vector(vector):
+    norm = math.sqrt(sum(value * value for value in vector))
+    return array('d', (value / norm for value in vector)) if norm else None
+
+def dot(a, b):
+    return sum(x * y for x, y in zip(a, b))
+
+class SimilarityIndex:
+    """Random-hyperplane LSH over unit vectors: vectors at a small angle share a
+    bucket in at least one table with high probability, so a lookup compares
+    only against the entries in its buckets"""
+
+    def __init__(self, tables=LSH_TABLES, bits=LSH_BITS):
+        self.tables = tables
+        self.bits = bits
+        self.planes = None  # [table][bit] -> hyperplane, created for the embedding's dimension
+        self.planes_lock = threading.Lock()
+        self.buckets = {}  # (settings, table, signature) -> set of cache keys
+
+    def signatures(self, vector):
+        """Bucket of the vector in each table (no shared state is changed after the first call)"""
+        with self.planes_lock:
+            if self.planes is None:
+                rng = random.Random(len(vector))
+                self.planes = [[[rng.gauss(0, 1) for _ in vector] for _ in range(self.bits)]
+                               for _ in range(self.tables)]
+        return [sum(1 << bit for bit, plane in enumerate(planes) if dot(plane, vector) >= 0)
+                for planes in self.planes]
+
+    def add(self, settings, signatures, key):
+        for table, signature in enumerate(signatures):
+            self.buckets.setdefault((settings, table, signature), set()).add(key)
+
+    def remove(self, settings, signatures, key):
+        for table, signature in enumerate(signatures):
+            bucket = self.buckets.get((settings, table, signature))
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self.buckets[(settings, table, signature)]
+
+    def candidates(self, settings, signatures):
+        keys = set()
+        for table, signature in enumerate(signatures):
+            keys |= self.buckets.get((settings, table, signature), set())
+        return keys
+
+class ResponseCache:
+    """In-memory cache of chat replies for deterministic requests.
+
+    Lookups match the normalized conversation exactly. If a similarity
+    threshold and an embed_fn (text -> vector, or None on failure) are
+    given, a lone user question that misses is also compared with cached
+    questions asked with the same model and options, through an LSH index.
+    Embeddings are computed outside the lock. Entries expire after ttl
+    seconds and the least recently used ones are evicted beyond
+    max_entries or max_bytes.
+    """
+
+    def __init__(self, ttl=RESPONSE_CACHE_TTL, max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+                 max_bytes=RESPONSE_CACHE_MAX_BYTES, similarity=RESPONSE_CACHE_SIMILARITY, embed_fn=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.similarity = similarity
+        self.embed_fn = embed_fn if similarity > 0 else None
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> entry dict, least recently used first
+        self.index = SimilarityIndex()
+        self.total_bytes = 0
+        self.hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+
+    @property
+    def uses_embeddings(self):
+        """True if lookups may call the embedding model (callers on an event loop should use a thread)"""
+        return self.embed_fn is not None
+
+    def _keys(self, model, messages, options):
+        normalized = [(message['role'], normalize_text(message['content'])) for message in messages]
+        settings = json.dumps([model, options or {}], sort_keys=True)
+        key = hashlib.sha256(json.dumps([settings, normalized]).encode('utf-8')).hexdigest()
+        # Near-duplicate matching only applies to a lone user question
+        question = normalized[0][1] if len(normalized) == 1 and normalized[0][0] == 'user' else None
+        return key, settings, question
+
+    def _embed(self, question):
+        if not question or self.embed_fn is None:
+            return None
+        try:
+            vector = self.embed_fn(question)
+        except Exception as e:
+            print(f"⚠️ Response cache embedding failed: {e}")
+            return None
+        return unit_vector(vector) if vector else None
+
+    def _remove(self, key):
+        entry = self.entries.pop(key)
+        self.total_bytes -= entry['size']
+        if entry['vector'] is not None:
+            self.index.remove(entry['settings'], entry['signatures'], key)
+
+    def get(self, model, messages, options):
+        """Return (reply, match) with match 'exact' or 'similar', or None"""
+        key, settings, question = self._keys(model, messages, options)
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and time.time() - entry['created_at'] > self.ttl:
+                self._remove(key)
+                entry = None
+            if entry:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry['reply'], 'exact'
+
+        vector = self._embed(question)
+        if vector is not None:
+            signatures = self.index.signatures(vector)
+            with self.lock:
+                candidates = [(other_key, self.entries[other_key]['vector'])
+                              for other_key in self.index.candidates(settings, signatures)]
+            # Scored outside the lock; only the handful of keys sharing a bucket
+            best_key, best_score = None, self.similarity
+            for other_key, other_vector in candidates:
+                score = dot(vector, other_vector)
+                if score >= best_score:
+                    best_key, best_score = other_key, score
+
+            if best_key:
+                with self.lock:
+                    entry = self.entries.get(best_key)
+                    if entry and time.time() - entry['created_at'] <= self.ttl:
+                        self.entries.move_to_end(best_key)
+                        self.similar_hits += 1
+                        return entry['reply'], 'similar'
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, model, messages, options, reply):
+        key, settings, question = self._keys(model, messages, options)
+        vector = self._embed(question)
+        signatures = self.index.signatures(vector) if vector is not None else None
+        # Rough footprint: the strings plus the vector's 8-byte components
+        size = len(reply) + len(question or "") + len(settings) + (len(vector) * 8 if vector is not None else 0) + 200
+
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = {
+                "reply": reply,
+                "settings": settings,
+                "vector": vector,
+                "signatures": signatures,
+                "size": size,
+                "created_at": time.time()
+            }
+            if vector is not None:
+                self.index.add(settings, signatures, key)
+            self.total_bytes += size
+            self._evict()
+
+    def _evict(self):
+        """Drop expired entries, then least recently used ones until within budget"""
+        cutoff = time.time() - self.ttl
+        # Least recently used first; stop at the first live one (get() also checks expiry)
+        while self.entries and next(iter(self.entries.values()))['created_at'] < cutoff:
+            self._remove(next(iter(self.entries)))
+        while self.entries and (len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes):
+            self._remove(next(iter(self.entries)))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.index.buckets.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.total_bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "similarity": self.similarity if self.embed_fn else 0,
+                "hits": self.hits,
+                "similar_hits": self.similar_hits,
+                "misses": self.misses
+            }
@@ -0,0 +1,120 @@
+import os
+import re
+import math
+import heapq
+import threading
+from array import array
+from collections import Counter, defaultdict
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Retrieval settings
+RETRIEVAL_TOP_K = int(os.getenv('RETRIEVAL_TOP_K', '3'))
+RETRIEVAL_MIN_SCORE = float(os.getenv('RETRIEVAL_MIN_SCORE', '1.0'))
+# Questions that do not mention a document need a stronger match (several distinctive words)
+RETRIEVAL_CONFIDENT_SCORE = float(os.getenv('RETRIEVAL_CONFIDENT_SCORE', '6.0'))
+RETRIEVAL_CHUNK_TOKENS = int(os.getenv('RETRIEVAL_CHUNK_TOKENS', '256'))  # chunk size for the index
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:\.[0-9]+)?")
+STOPWORDS = {
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'can', 'did', 'do', 'does', 'for', 'from',
+    'how', 'i', 'in', 'is', 'it', 'its', 'me', 'my', 'of', 'on', 'or', 'tell', 'that', 'the',
+    'this', 'to', 'was', 'we', 'what', 'when', 'where', 'which', 'who', 'why', 'with', 'you'
+}
+
+def tokenize(text):
+    """Lowercase word tokens without stopwords"""
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if token not in STOPWORDS]
+
+class BM25Index:
+    """BM25 index over one document's chunks (dicts with text and character offsets).
+
+    Postings are kept as parallel typed arrays (chunk ids and term
+    frequencies) rather than Python lists of tuples, so an index over a
+    large document stays a few bytes per posting.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+        self.doc_lengths = array('I')
+        self.postings = defaultdict(lambda: (array('I'), array('H')))
+
+        for chunk_id, chunk in enumerate(self.chunks):
+            counts = Counter(tokenize(chunk['text']))
+            self.doc_lengths.append(sum(counts.values()))
+            for term, frequency in counts.items():
+                chunk_ids, frequencies = self.postings[term]
+                chunk_ids.append(chunk_id)
+                frequencies.append(min(frequency, 65535))
+
+        self.postings = dict(self.postings)
+        self.avg_length = (sum(self.doc_lengths) / len(self.doc_lengths)) if self.doc_lengths else 0.0
+
+    def search(self, query, k=RETRIEVAL_TOP_K):
+        """Return up to k (score, chunk_id) pairs, best first"""
+        total = len(self.chunks)
+        if not total or not self.avg_length:
+            return []
+
+        scores = defaultdict(float)
+        for term in set(tokenize(query)):
+            if term not in self.postings:
+                continue
+            chunk_ids, frequencies = self.postings[term]
+            document_frequency = len(chunk_ids)
+            idf = math.log(1 + (total - document_frequency + 0.5) / (document_frequency + 0.5))
+            for chunk_id, frequency in zip(chunk_ids, frequencies):
+                length_norm = 1 - BM25_B + BM25_B * self.doc_lengths[chunk_id] / self.avg_length
+                scores[chunk_id] += idf * frequency * (BM25_K1 + 1) / (frequency + BM25_K1 * length_norm)
+
+        return heapq.nlargest(k, ((score, chunk_id) for chunk_id, score in scores.items()))
+
+class DocumentIndexStore:
+    """Per-user retrieval indexes, one per uploaded document"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.indexes = {}  # user_id -> {filename: BM25Index}
+
+    def add(self, user_id, filename, chunks):
+        """Build and store the index for a document"""
+        index = BM25Index(chunks)
+        with self.lock:
+            self.indexes.setdefault(user_id, {})[filename] = index
+        print(f"📚 Indexed {len(index.chunks)} chunks of {filename} for retrieval")
+        return index
+
+    def get(self, user_id, filename):
+        with self.lock:
+            return self.indexes.get(user_id, {}).get(filename)
+
+    def remove(self, user_id, filename):
+        with self.lock:
+            self.indexes.get(user_id, {}).pop(filename, None)
+
+    def search(self, documents, query, k=RETRIEVAL_TOP_K, min_score=RETRIEVAL_MIN_SCORE):
+        """Search (user_id, filename) documents; returns up to k hits as dicts, best first"""
+        hits = []
+        for user_id, filename in documents:
+            index = self.get(user_id, filename)
+            if index is None:
+                continue
+            for score, chunk_id in index.search(query, k):
+                if score >= min_score:
+                    hits.append((score, filename, chunk_id, index.chunks[chunk_id]))
+
+        return [
+            {
+                "score": round(score, 3),
+                "filename": filename,
+                "chunk": chunk_id,
+                "text": chunk['text'],
+                "start": chunk['start'],
+                "end": chunk['end']
+            }
+            for score, filename, chunk_id, chunk in heapq.nlargest(k, hits, key=lambda hit: hit[0])
+        ]
@@ -0,0 +1,354 @@
+import json
+import asyncio
+import hashlib
+import threading
+
+def flight_key(model, messages, options=None, operation=None):
+    """Key identical requests share: model, operation, messages with whitespace collapsed, and options"""
+    normalized = [(message['role'], " ".join(message['content'].split())) for message in messages]
+    # The operation picks the timeout and is recorded per request, so it is part of the identity
+    payload = json.dumps([model, operation, normalized, options or {}], sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    """Run a blocking call once for all concurrent callers with the same key"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.started = 0
+        self.joined = 0
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+                self.started += 1
+            else:
+                self.joined += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+class SharedStream:
+    """One upstream streaming response fanned out to every subscriber.
+
+    A pump thread reads the upstream lines into a shared list; each
+    subscriber replays it from the start, so joining mid-generation still
+    yields the whole reply. The upstream is closed as soon as the last
+    subscriber leaves, so an abandoned generation still stops right away.
+    """
+
+    def __init__(self, on_finished):
+        self.on_finished = on_finished
+        self.changed = threading.Condition()
+        self.opened = threading.Event()
+        self.lines = []
+        self.response = None
+        self.status_code = None
+        self.text = ""
+        self.open_error = None
+        self.error = None
+        self.finished = False
+        self.subscribers = 0
+
+    def start(self, open_fn):
+        """Open the upstream (in the first subscriber's thread) and start pumping it"""
+        try:
+            self.response = open_fn()
+            self.status_code = self.response.status_code
+        except Exception as e:
+            self.open_error = e
+            self.opened.set()
+            self._finish()
+            raise
+
+        if self.status_code != 200:
+            self.text = self.response.text
+            self.response.close()
+            self.opened.set()
+            self._finish()
+            return
+
+        self.opened.set()
+        threading.Thread(target=self._pump, daemon=True, name='shared-stream').start()
+
+    def _pump(self):
+        try:
+            for line in self.response.iter_lines():
+                if line:
+                    with self.changed:
+                        self.lines.append(line)
+                        self.changed.notify_all()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.response.close()
+            self._finish()
+
+    def _finish(self):
+        with self.changed:
+            self.finished = True
+            self.changed.notify_all()
+        self.on_finished(self)
+
+    def iter_lines(self):
+        index = 0
+        while True:
+            with self.changed:
+                while index >= len(self.lines) and not self.finished:
+                    self.changed.wait()
+                new_lines = self.lines[index:]
+                index = len(self.lines)
+                finished = self.finished
+            yield from new_lines
+            if finished and index >= len(self.lines):
+                if self.error is not None:
+                    raise self.error
+                return
+
+    def unsubscribe(self):
+        with self.changed:
+            self.subscribers -= 1
+            abandoned = self.subscribers == 0 and not self.finished
+        if abandoned and self.response is not None:
+            # Nobody is listening any more; stop the generation
+            self.response.close()
+
+class StreamSubscriber:
+    """Response-like view of a SharedStream (status_code, text, iter_lines, close)"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.closed = False
+
+    @property
+    def status_code(self):
+        return self.stream.status_code
+
+    @property
+    def text(self):
+        return self.stream.text
+
+    def iter_lines(self):
+        return self.stream.iter_lines()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.stream.unsubscribe()
+
+class StreamFanout:
+    """Share one upstream stream between concurrent identical requests"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.streams = {}
+        self.started = 0
+        self.joined = 0
+
+    def open(self, key, open_fn):
+        """Return a subscriber, opening the upstream with open_fn() if nothing is in flight"""
+        with self.lock:
+            stream = self.streams.get(key)
+            # A stream whose last subscriber just left is being torn down; start afresh
+            leader = stream is None or stream.finished or stream.subscribers == 0
+            if leader:
+                stream = SharedStream(on_finished=lambda finished: self._forget(key, finished))
+                self.streams[key] = stream
+                self.started += 1
+            else:
+                self.joined += 1
+            with stream.changed:
+                stream.subscribers += 1
+
+        if leader:
+            stream.start(open_fn)
+        else:
+            stream.opened.wait()
+            if stream.open_error is not None:
+                raise stream.open_error
+        return StreamSubscriber(stream)
+
+    def _forget(self, key, stream):
+        with self.lock:
+            if self.streams.get(key) is stream:
+                del self.streams[key]
+
+class AsyncSingleFlight:
+    """asyncio version of SingleFlight.
+
+    The shared call runs in its own task rather than in the first caller's,
+    so it finishes for everyone else even if that caller is cancelled (e.g.
+    its client disconnected).
+    """
+
+    def __init__(self):
+        self.calls = {}
+        self.started = 0
+        self.joined = 0
+
+    async def do(self, key, fn):
+        task = self.calls.get(key)
+        if task is None:
+            task = self.calls[key] = asyncio.ensure_future(fn())
+            task.add_done_callback(lambda finished: self._forget(key, finished))
+            self.started += 1
+        else:
+            self.joined += 1
+        # shield: a caller going away, the first one included, must not cancel the shared call
+        return await asyncio.shield(task)
+
+    def _forget(self, key, task):
+        if self.calls.get(key) is task:
+            del self.calls[key]
+        if not task.cancelled():
+            task.exception()  # mark retrieved when every caller had already gone
+
+class AsyncSharedStream:
+    """asyncio version of SharedStream, pumped by a task instead of a thread"""
+
+    def __init__(self, on_finished):
+        self.on_finished = on_finished
+        self.changed = asyncio.Event()
+        self.opened = asyncio.Event()
+        self.lines = []
+        self.response = None
+        self.status_code = None
+        self.open_error = None
+        self.error = None
+        self.finished = False
+        self.subscribers = 0
+        self.pump_task = None
+
+    def _notify(self):
+        # Wake everyone waiting on the current event and start a fresh one
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    async def start(self, open_fn):
+        try:
+            self.response = await open_fn()
+            self.status_code = self.response.status_code
+        except Exception as e:
+            self.open_error = e
+            self.opened.set()
+            self._finish()
+            raise
+
+        self.opened.set()
+        if self.status_code != 200:
+            await self.response.aclose()
+            self._finish()
+            return
+        self.pump_task = asyncio.ensure_future(self._pump())
+
+    async def _pump(self):
+        try:
+            async for line in self.response.aiter_lines():
+                if line:
+                    self.lines.append(line)
+                    self._notify()
+        except Exception as e:
+            self.error = e
+        finally:
+            await self.response.aclose()
+            self._finish()
+
+    def _finish(self):
+        self.finished = True
+        self._notify()
+        self.on_finished(self)
+
+    async def aiter_lines(self):
+        index = 0
+        while True:
+            changed = self.changed
+            new_lines = self.lines[index:]
+            index = len(self.lines)
+            for line in new_lines:
+                yield line
+            if self.finished and index >= len(self.lines):
+                if self.error is not None:
+                    raise self.error
+                return
+            if not new_lines:
+                await changed.wait()
+
+    async def unsubscribe(self):
+        self.subscribers -= 1
+        if self.subscribers == 0 and not self.finished and self.pump_task is not None:
+            # Nobody is listening any more; stop the generation
+            self.pump_task.cancel()
+
+class AsyncStreamSubscriber:
+    """Response-like view of an AsyncSharedStream (status_code, aiter_lines, aclose)"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.closed = False
+
+    @property
+    def status_code(self):
+        return self.stream.status_code
+
+    def aiter_lines(self):
+        return self.stream.aiter_lines()
+
+    async def aclose(self):
+        if not self.closed:
+            self.closed = True
+            await self.stream.unsubscribe()
+
+class AsyncStreamFanout:
+    """asyncio version of StreamFanout"""
+
+    def __init__(self):
+        self.streams = {}
+        self.started = 0
+        self.joined = 0
+
+    async def open(self, key, open_fn):
+        stream = self.streams.get(key)
+        leader = stream is None or stream.finished or stream.subscribers == 0
+        if leader:
+            stream = AsyncSharedStream(on_finished=lambda finished: self._forget(key, finished))
+            self.streams[key] = stream
+            self.started += 1
+        else:
+            self.joined += 1
+        stream.subscribers += 1
+
+        if leader:
+            await stream.start(open_fn)
+        else:
+            await stream.opened.wait()
+            if stream.open_error is not None:
+                raise stream.open_error
+        return AsyncStreamSubscriber(stream)
+
+    def _forget(self, key, stream):
+        if self.streams.get(key) is stream:
+            del self.streams[key]
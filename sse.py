@@ -0,0 +1,267 @@
+import os
+import json
+import time
+import queue
+import asyncio
+import threading
+from collections import deque
+from flask import Response
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Streaming settings
+SSE_HEARTBEAT_INTERVAL = float(os.getenv('SSE_HEARTBEAT_INTERVAL', '15'))  # seconds between keep-alive comments
+SSE_BUFFER_FRAMES = int(os.getenv('SSE_BUFFER_FRAMES', '64'))  # frames read ahead of a slow client
+
+HEARTBEAT_FRAME = ": keep-alive\n\n"
+_END = object()
+
+def sse_frame(payload):
+    """Encode one server-sent event carrying a JSON payload"""
+    return f"data: {json.dumps(payload)}\n\n"
+
+def sse_response(frames):
+    """Wrap a frame generator in a text/event-stream response"""
+    return Response(frames,
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             'Connection': 'keep-alive',
+                             'X-Accel-Buffering': 'no',
+                             'Access-Control-Allow-Origin': '*'})
+
+class StreamStats:
+    """Per-stream timing: time to first token and generation rate"""
+
+    def __init__(self, label):
+        self.label = label
+        self.started_at = time.time()
+        self.first_token_at = None
+        self.finished_at = None
+        self.tokens = 0
+        self.outcome = None
+
+    def record_token(self):
+        if self.first_token_at is None:
+            self.first_token_at = time.time()
+        self.tokens += 1
+
+    def finish(self, outcome):
+        """Mark the stream completed, cancelled or failed and log its numbers"""
+        if self.outcome is not None:
+            return
+        self.finished_at = time.time()
+        self.outcome = outcome
+        stream_totals.record(self)
+        print(f"📈 {self.label} stream {outcome}: {self.to_dict()}")
+
+    def to_dict(self):
+        end = self.finished_at or time.time()
+        ttft = (self.first_token_at - self.started_at) if self.first_token_at else None
+        generation_time = (end - self.first_token_at) if self.first_token_at else 0
+        return {
+            "tokens": self.tokens,
+            "ttft_ms": round(ttft * 1000) if ttft is not None else None,
+            "tokens_per_sec": round(self.tokens / generation_time, 2) if generation_time > 0 else None,
+            "duration_ms": round((end - self.started_at) * 1000)
+        }
+
+class StreamTotals:
+    """Counts of finished streams and averages over the most recent ones"""
+
+    def __init__(self, window=100):
+        self.lock = threading.Lock()
+        self.counts = {"completed": 0, "cancelled": 0, "failed": 0}
+        self.recent = deque(maxlen=window)
+
+    def record(self, stats):
+        with self.lock:
+            self.counts[stats.outcome] = self.counts.get(stats.outcome, 0) + 1
+            self.recent.append(stats.to_dict())
+
+    def stats(self):
+        with self.lock:
+            recent = list(self.recent)
+            counts = dict(self.counts)
+        ttfts = [entry['ttft_ms'] for entry in recent if entry['ttft_ms'] is not None]
+        rates = [entry['tokens_per_sec'] for entry in recent if entry['tokens_per_sec'] is not None]
+        return {
+            **counts,
+            "avg_ttft_ms": round(sum(ttfts) / len(ttfts)) if ttfts else None,
+            "avg_tokens_per_sec": round(sum(rates) / len(rates), 2) if rates else None
+        }
+
+stream_totals = StreamTotals()
+
+def with_heartbeats(frames, on_close=None, interval=SSE_HEARTBEAT_INTERVAL, buffer_frames=SSE_BUFFER_FRAMES):
+    """Relay frames from a reader thread, sending keep-alive comments while the source is quiet.
+
+    The source is read at most buffer_frames ahead of the client (the bounded
+    queue is the backpressure). A heartbeat write is also what notices a
+    client that has gone away: the server then closes this generator, and
+    on_close runs so the upstream request can be closed immediately.
+    """
+    pending = queue.Queue(maxsize=buffer_frames)
+    stopped = threading.Event()
+
+    def put(item):
+        # Give up instead of blocking forever once the client is gone
+        while not stopped.is_set():
+            try:
+                pending.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def read():
+        try:
+            for frame in frames:
+                if not put(frame):
+                    break
+        except Exception as e:
+            if not stopped.is_set():
+                put(sse_frame({'error': str(e)}))
+        finally:
+            put(_END)
+
+    threading.Thread(target=read, daemon=True, name='sse-reader').start()
+
+    try:
+        while True:
+            try:
+                frame = pending.get(timeout=interval)
+            except queue.Empty:
+                yield HEARTBEAT_FRAME
+                continue
+            if frame is _END:
+                return
+            yield frame
+    finally:
+        stopped.set()
+        if on_close:
+            on_close()
+
+class ChatRelay:
+    """Turn Ollama /api/chat stream lines into SSE frames, keeping the text and timing"""
+
+    def __init__(self, label):
+        self.stats = StreamStats(label)
+        self.buffer = []
+        self.done = False
+
+    def frames_for(self, line):
+        """Return the frames for one raw stream line"""
+        if not line:
+            return []
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        line_data = json.loads(line)
+        frames = []
+        if 'message' in line_data and 'content' in line_data['message']:
+            content = line_data['message']['content']
+            if content:
+                self.buffer.append(content)
+                self.stats.record_token()
+                frames.append(sse_frame({'content': content}))
+
+        # Check if this is the final message
+        if line_data.get('done', False):
+            self.done = True
+            self.stats.finish('completed')
+            frames.append(sse_frame({'done': True, 'full_content': "".join(self.buffer),
+                                     'stats': self.stats.to_dict()}))
+        return frames
+
+    def incomplete_frames(self):
+        """Frames for an upstream that ended without its final message"""
+        self.stats.finish('failed')
+        return [sse_frame({'error': "Ollama stream ended before completion"})]
+
+def stream_ollama_chat(response, label='chat'):
+    """Relay a streaming Ollama /api/chat response as SSE frames.
+
+    Returns a generator; closing it (client disconnect) closes the Ollama
+    response so the model stops generating right away.
+    """
+    relay = ChatRelay(label)
+
+    def frames():
+        try:
+            for line in response.iter_lines():
+                yield from relay.frames_for(line)
+                if relay.done:
+                    return
+        except Exception:
+            relay.stats.finish('failed')
+            raise
+        yield from relay.incomplete_frames()
+
+    def close():
+        # No-op if the stream already finished; otherwise the client left early
+        relay.stats.finish('cancelled')
+        # Closing the socket is what tells Ollama to abandon the generation
+        response.close()
+
+    return with_heartbeats(frames(), on_close=close)
+
+async def awith_heartbeats(frames, on_close=None, interval=SSE_HEARTBEAT_INTERVAL):
+    """asyncio version of with_heartbeats for an async frame generator.
+
+    Frames are pulled one at a time as the client takes them, so a slow
+    client slows the source down. When the server cancels the stream
+    (client disconnect), on_close is awaited.
+    """
+    pending = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(frames.__anext__())
+            done, _ = await asyncio.wait({pending}, timeout=interval)
+            if not done:
+                yield HEARTBEAT_FRAME
+                continue
+
+            task, pending = pending, None
+            try:
+                frame = task.result()
+            except StopAsyncIteration:
+                return
+            except Exception as e:
+                yield sse_frame({'error': str(e)})
+                return
+            yield frame
+    finally:
+        if pending is not None:
+            pending.cancel()
+        if on_close:
+            await on_close()
+
+def astream_ollama_chat(response, label='chat', on_close=None):
+    """Relay a streaming httpx response from Ollama as SSE frames (async generator).
+
+    on_close, if given, is called once the stream has finished or been cancelled.
+    """
+    relay = ChatRelay(label)
+
+    async def frames():
+        try:
+            async for line in response.aiter_lines():
+                for frame in relay.frames_for(line):
+                    yield frame
+                if relay.done:
+                    return
+        except Exception:
+            relay.stats.finish('failed')
+            raise
+        for frame in relay.incomplete_frames():
+            yield frame
+
+    async def close():
+        relay.stats.finish('cancelled')
+        await response.aclose()
+        if on_close:
+            on_close()
+
+    return awith_heartbeats(frames(), on_close=close)
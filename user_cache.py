@@ -0,0 +1,69 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', '60'))  # seconds a cached database user is trusted
+DB_USER_CACHE_SIZE = int(os.getenv('DB_USER_CACHE_SIZE', '10000'))
+
+class UserCache:
+    """Read-through cache of database users by id: the account columns, never chat history.
+
+    Entries expire after ttl seconds, which bounds how long a change made
+    by another process can go unseen; writes made here call invalidate().
+    A load that started before an invalidation is not cached, so a read
+    racing a write cannot put the old row back. The least recently used
+    entries are dropped beyond max_entries.
+    """
+
+    def __init__(self, ttl=USER_CACHE_TTL, max_entries=DB_USER_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # user id -> (user dict, expires at), least recently used first
+        self.invalidated_at = 0.0
+        self.hits = 0
+        self.misses = 0
+
+    def clock(self):
+        """Timestamp to pass to put() for a load starting now"""
+        return time.monotonic()
+
+    def get(self, user_id):
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry and entry[1] > time.monotonic():
+                self.entries.move_to_end(user_id)
+                self.hits += 1
+                return dict(entry[0])
+            if entry:
+                del self.entries[user_id]
+            self.misses += 1
+            return None
+
+    def put(self, user, loaded_at=None):
+        with self.lock:
+            if loaded_at is not None and loaded_at <= self.invalidated_at:
+                return
+            self.entries[user['id']] = (dict(user), time.monotonic() + self.ttl)
+            self.entries.move_to_end(user['id'])
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self.lock:
+            self.entries.pop(user_id, None)
+            self.invalidated_at = time.monotonic()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses
+            }
@@ -0,0 +1,70 @@
+import threading
+
+def normalize_email(email):
+    return email.strip().casefold()
+
+def normalize_username(username):
+    return username.strip().casefold()
+
+class UserDirectory:
+    """Hash indexes from normalized email and username to user id.
+
+    In file mode this is the authoritative index over users_db; in database
+    mode it caches the users seen so far and misses fall through to the
+    database. Entries are kept current with add() on insert and update.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.by_email = {}
+        self.by_username = {}
+        self.keys_by_id = {}  # user id -> (email key, username key)
+
+    def __len__(self):
+        return len(self.keys_by_id)
+
+    def _remove_keys(self, user_id):
+        email_key, username_key = self.keys_by_id.pop(user_id, (None, None))
+        if self.by_email.get(email_key) == user_id:
+            del self.by_email[email_key]
+        if self.by_username.get(username_key) == user_id:
+            del self.by_username[username_key]
+
+    def _add_keys(self, user_id, email, username):
+        email_key, username_key = normalize_email(email), normalize_username(username)
+        self.by_email[email_key] = user_id
+        self.by_username[username_key] = user_id
+        self.keys_by_id[user_id] = (email_key, username_key)
+
+    def add(self, user_id, email, username):
+        """Index a new user, or re-index one whose email or username changed"""
+        with self.lock:
+            self._remove_keys(user_id)
+            self._add_keys(user_id, email, username)
+
+    def remove(self, user_id):
+        with self.lock:
+            self._remove_keys(user_id)
+
+    def taken(self, email, username, user_id=None):
+        """Return an error message if another user has this email or username"""
+        owner = self.by_email.get(normalize_email(email))
+        if owner is not None and owner != user_id:
+            return "Email already registered"
+        owner = self.by_username.get(normalize_username(username))
+        if owner is not None and owner != user_id:
+            return "Username already taken"
+        return None
+
+    def reserve(self, user_id, email, username):
+        """Check and index a new user in one step; returns an error message if taken"""
+        with self.lock:
+            error = self.taken(email, username)
+            if error is None:
+                self._add_keys(user_id, email, username)
+            return error
+
+    def find(self, email_or_username):
+        """User id for an email or username, or None"""
+        value = email_or_username.strip().casefold()
+        return self.by_email.get(value) or self.by_username.get(value)
@@ -0,0 +1,452 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', '1000'))  # full user records kept in memory
+USER_INDEX_FILE = '_index.jsonl'  # not *.json, so tools listing user files skip it
+USER_JOURNAL_FILE = '_journal.jsonl'
+USER_JOURNAL_FLUSH_MS = int(os.getenv('USER_JOURNAL_FLUSH_MS', '10'))  # how long writes gather into one fsync
+USER_JOURNAL_COMPACT_INTERVAL = int(os.getenv('USER_JOURNAL_COMPACT_INTERVAL', '60'))  # seconds
+USER_JOURNAL_MAX_BYTES = int(os.getenv('USER_JOURNAL_MAX_BYTES', str(16 * 1024 * 1024)))  # compact sooner past this
+USER_JOURNAL_WAIT_TIMEOUT = 10  # seconds a durable write waits for its commit
+USER_LOCK_STRIPES = 256  # per-user locks, shared by users whose ids hash alike
+
+def chat_journal_entry(user, version):
+    """Journal entry for the chat sync that produced version: the chats it changed,
+    each with only the messages it added, and the chats it deleted"""
+    chats = {}
+    for chat_id, chat in user.get('chat_history', {}).items():
+        if chat.get('version') == version:
+            chats[chat_id] = {**chat, 'messages': [message for message in chat.get('messages', [])
+                                                   if message.get('version') == version]}
+    deleted = [chat_id for chat_id, deleted_version in user.get('chat_sync', {}).get('deleted', {}).items()
+               if deleted_version == version]
+    return {'sync': version, 'chats': chats, 'deleted': deleted}
+
+def apply_journal_entry(user, entry):
+    """Replay a journal entry onto a user snapshot (None if there is none); returns the new snapshot"""
+    if 'user' in entry:
+        return entry['user']
+    if user is None:
+        return None
+
+    sync = user.setdefault('chat_sync', {'version': 0, 'deleted': {}})
+    if entry['sync'] <= sync['version']:
+        return user  # already in the snapshot; compaction was interrupted after writing it
+    history = user.setdefault('chat_history', {})
+    for chat_id, change in entry['chats'].items():
+        chat = history.get(chat_id)
+        if chat is None:
+            history[chat_id] = change
+        else:
+            chat.setdefault('messages', []).extend(change['messages'])
+            chat.update({key: value for key, value in change.items() if key != 'messages'})
+        sync['deleted'].pop(chat_id, None)
+    for chat_id in entry['deleted']:
+        history.pop(chat_id, None)
+        sync['deleted'][chat_id] = entry['sync']
+    sync['version'] = entry['sync']
+    return user
+
+class UserJournal:
+    """Write-behind persistence for file-mode user records.
+
+    Changes are appended to users/_journal.jsonl as one line each: a full
+    record for new users, or just what a chat sync changed. A background
+    writer gathers the lines that arrive within flush_ms into one write
+    and one fsync (group commit); callers that need the change on disk
+    before answering wait for that commit.
+
+    Every compact_interval seconds, or once the journal passes max_bytes,
+    it is replayed onto the users/<id>.json snapshots and truncated. Each
+    snapshot is written to a temporary file, fsynced and renamed over the
+    old one, so a crash never leaves a half-written user. recover() does
+    the same replay on startup; replaying twice is harmless. Users with
+    entries not yet compacted are dirty: their snapshot is behind, so the
+    store must keep their record in memory.
+    """
+
+    def __init__(self, users_dir='users', flush_ms=USER_JOURNAL_FLUSH_MS,
+                 compact_interval=USER_JOURNAL_COMPACT_INTERVAL, max_bytes=USER_JOURNAL_MAX_BYTES):
+        self.users_dir = users_dir
+        self.path = os.path.join(users_dir, USER_JOURNAL_FILE)
+        self.flush_interval = flush_ms / 1000
+        self.compact_interval = compact_interval
+        self.max_bytes = max_bytes
+        self.lock = threading.Condition()
+        self.queue = []  # (sequence number, encoded line), oldest first
+        self.seq = 0
+        self.committed = 0
+        self.dirty = {}  # user id -> sequence number of its last entry not yet in its snapshot
+        self.file = None
+        self.size = 0
+        self.thread = None
+        self.closed = False
+        self.appends = 0
+        self.commits = 0
+        self.compactions = 0
+
+    def recover(self):
+        """Fold a journal left by the previous run into the snapshots; call before reading users"""
+        os.makedirs(self.users_dir, exist_ok=True)
+        self.file = open(self.path, 'ab')
+        if os.path.getsize(self.path) > 0:
+            count = self._compact()
+            print(f"🔄 Recovered {count} journaled user changes")
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            if self.file is None:
+                self.recover()
+            self.thread = threading.Thread(target=self._run, name='user-journal', daemon=True)
+            self.thread.start()
+
+    def close(self):
+        """Commit what is queued, compact, and stop the writer"""
+        with self.lock:
+            self.closed = True
+            self.lock.notify_all()
+        if self.thread is not None:
+            self.thread.join(USER_JOURNAL_WAIT_TIMEOUT)
+
+    def write(self, user_id, entry, wait=False):
+        """Journal a change to a user; with wait, return whether it reached the disk"""
+        line = (json.dumps({'id': user_id, **entry}, separators=(',', ':')) + "\n").encode('utf-8')
+        if self.thread is None:
+            self.start()
+
+        with self.lock:
+            self.seq += 1
+            seq = self.seq
+            self.queue.append((seq, line))
+            self.dirty[user_id] = seq
+            self.appends += 1
+            self.lock.notify_all()
+            if not wait:
+                return True
+            deadline = time.monotonic() + USER_JOURNAL_WAIT_TIMEOUT
+            while self.committed < seq and not self.closed and time.monotonic() < deadline:
+                self.lock.wait(deadline - time.monotonic())
+            return self.committed >= seq
+
+    def is_dirty(self, user_id):
+        return user_id in self.dirty
+
+    def _run(self):
+        last_compaction = time.monotonic()
+        while True:
+            with self.lock:
+                if not self.queue and not self.closed:
+                    self.lock.wait(self.compact_interval)
+                closed = self.closed
+            if self.flush_interval and not closed:
+                time.sleep(self.flush_interval)  # let concurrent writes join this commit
+
+            with self.lock:
+                batch, self.queue = self.queue, []
+            if batch and not self._commit(batch):
+                with self.lock:
+                    self.queue = batch + self.queue
+                if closed:
+                    return
+                time.sleep(1)
+                continue
+
+            if self.size and (closed or self.size > self.max_bytes
+                              or time.monotonic() - last_compaction >= self.compact_interval):
+                with self.lock:
+                    upto = self.committed
+                try:
+                    self._compact()
+                except OSError as e:
+                    print(f"❌ Error compacting user journal: {e}")
+                else:
+                    with self.lock:
+                        self.dirty = {user_id: seq for user_id, seq in self.dirty.items() if seq > upto}
+                        self.compactions += 1
+                last_compaction = time.monotonic()
+            if closed:
+                return
+
+    def _commit(self, batch):
+        """Append a batch of lines with a single fsync (writer thread only)"""
+        data = b''.join(line for _, line in batch)
+        try:
+            self.file.write(data)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        except OSError as e:
+            print(f"❌ Error writing user journal: {e}")
+            try:
+                self.file.truncate(self.size)  # drop a partial line before retrying
+            except OSError:
+                pass
+            return False
+
+        self.size += len(data)
+        with self.lock:
+            self.committed = batch[-1][0]
+            self.commits += 1
+            self.lock.notify_all()
+        return True
+
+    def _compact(self):
+        """Replay the journal onto the user snapshots, then truncate it; returns the entry count"""
+        entries = {}
+        count = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # a line torn by a crash mid-write
+                entries.setdefault(entry.pop('id'), []).append(entry)
+                count += 1
+
+        for user_id, user_entries in entries.items():
+            snapshot = self._read_snapshot(user_id)
+            for entry in user_entries:
+                snapshot = apply_journal_entry(snapshot, entry)
+            if snapshot is not None:
+                self._write_snapshot(user_id, snapshot)
+        self._sync_directory()
+
+        self.file.truncate(0)
+        os.fsync(self.file.fileno())
+        self.size = 0
+        return count
+
+    def _read_snapshot(self, user_id):
+        try:
+            with open(os.path.join(self.users_dir, f"{user_id}.json"), 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            print(f"❌ Error loading user from file: {e}")
+            return None
+
+    def _write_snapshot(self, user_id, user):
+        user_file = os.path.join(self.users_dir, f"{user_id}.json")
+        temp_file = user_file + '.tmp'
+        with open(temp_file, 'w') as f:
+            json.dump(user, f, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_file, user_file)
+
+    def _sync_directory(self):
+        """Make the renames durable (not supported on Windows, where it is skipped)"""
+        try:
+            fd = os.open(self.users_dir, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "bytes": self.size,
+                "queued": len(self.queue),
+                "dirty_users": len(self.dirty),
+                "appends": self.appends,
+                "commits": self.commits,
+                "compactions": self.compactions
+            }
+
+class LazyUserStore(MutableMapping):
+    """File-mode users: a compact index in memory, full records loaded on demand.
+
+    users/_index.jsonl has one {"id", "email", "username"} line per user,
+    appended on signup and compacted on startup, so startup reads the index
+    instead of every user file with its chat history. A full record is read
+    from users/<id>.json on first access, and the least recently used ones
+    are dropped beyond cache_size. Changes are persisted through the
+    journal; records whose file is still behind it are kept until it is
+    compacted, so a dropped record is simply read again next time.
+
+    Behaves like the dict it replaces: `id in store` and len() use the index
+    only; store[id] loads the record. Code that changes a record, or reads
+    one that may be changing, takes store[id] while holding
+    user_lock(user_id); the record is not dropped while the lock is held, so
+    every holder works on the same object.
+    """
+
+    def __init__(self, users_dir='users', cache_size=USER_CACHE_SIZE, journal=None):
+        self.users_dir = users_dir
+        self.journal = journal
+        self.cache_size = max(1, cache_size)
+        self.index_path = os.path.join(users_dir, USER_INDEX_FILE)
+        self.lock = threading.RLock()
+        self.index = {}  # user id -> {"email", "username"}
+        self.records = OrderedDict()  # user id -> full record, least recently used first
+        self.user_locks = [threading.Lock() for _ in range(USER_LOCK_STRIPES)]
+        self.pinned = {}  # user id -> number of user_lock holders
+        self.loads = 0
+        self.evictions = 0
+
+    @contextmanager
+    def user_lock(self, user_id):
+        """Serialize changes to one user's record with their journal entries, keeping the record loaded"""
+        with self.user_locks[hash(user_id) % len(self.user_locks)]:
+            with self.lock:
+                self.pinned[user_id] = self.pinned.get(user_id, 0) + 1
+            try:
+                yield
+            finally:
+                with self.lock:
+                    self.pinned[user_id] -= 1
+                    if not self.pinned[user_id]:
+                        del self.pinned[user_id]
+
+    # --- index file ---
+
+    def load_index(self):
+        """Read the index, building it from the user files if it is missing; returns the user count"""
+        os.makedirs(self.users_dir, exist_ok=True)
+        with self.lock:
+            if not os.path.exists(self.index_path):
+                self.rebuild_index()
+                return len(self.index)
+
+            lines = 0
+            with open(self.index_path, 'r') as f:
+                for line in f:
+                    lines += 1
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # a line torn by a crash mid-append
+                    if entry.get('deleted'):
+                        self.index.pop(entry['id'], None)
+                    else:
+                        self.index[entry['id']] = {'email': entry['email'], 'username': entry['username']}
+
+            # Superseded lines pile up as users are re-indexed; rewrite once they dominate
+            if lines > 2 * len(self.index) + 100:
+                self._write_index()
+            return len(self.index)
+
+    def rebuild_index(self):
+        """Index every user file (one-off, e.g. on first start after upgrading)"""
+        print("🔄 Building user index from user files...")
+        with self.lock:
+            self.index.clear()
+            for filename in os.listdir(self.users_dir):
+                if filename.endswith('.json'):
+                    record = self._read(filename[:-5])
+                    if record:
+                        self.index[filename[:-5]] = {'email': record['email'], 'username': record['username']}
+            self._write_index()
+
+    def _write_index(self):
+        temp_path = self.index_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            for user_id, entry in self.index.items():
+                f.write(json.dumps({'id': user_id, **entry}) + "\n")
+        os.replace(temp_path, self.index_path)
+
+    def _append_index(self, line):
+        with open(self.index_path, 'a') as f:
+            f.write(json.dumps(line) + "\n")
+
+    def index_user(self, user_id, record):
+        """Add or update a user's index entry (only written when email or username changed)"""
+        entry = {'email': record['email'], 'username': record['username']}
+        with self.lock:
+            if self.index.get(user_id) != entry:
+                self.index[user_id] = entry
+                self._append_index({'id': user_id, **entry})
+
+    def entries(self):
+        """(user id, {"email", "username"}) for every user, without loading records"""
+        with self.lock:
+            return list(self.index.items())
+
+    # --- records ---
+
+    def _read(self, user_id):
+        try:
+            with open(os.path.join(self.users_dir, f"{user_id}.json"), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"❌ Error loading user from file: {e}")
+            return None
+
+    def _cache(self, user_id, record):
+        self.records[user_id] = record
+        self.records.move_to_end(user_id)
+        if len(self.records) <= self.cache_size:
+            return
+        for old_id in list(self.records):
+            if len(self.records) <= self.cache_size:
+                break
+            if old_id in self.pinned:
+                continue  # someone holds its user_lock and may be changing it
+            if self.journal and self.journal.is_dirty(old_id):
+                continue  # its file is behind the journal until the next compaction
+            del self.records[old_id]
+            self.evictions += 1
+
+    def __getitem__(self, user_id):
+        with self.lock:
+            record = self.records.get(user_id)
+            if record is not None:
+                self.records.move_to_end(user_id)
+                return record
+            if user_id not in self.index:
+                raise KeyError(user_id)
+
+            record = self._read(user_id)
+            if record is None:
+                raise KeyError(user_id)
+            self.loads += 1
+            self._cache(user_id, record)
+            return record
+
+    def __setitem__(self, user_id, record):
+        with self.lock:
+            self._cache(user_id, record)
+            self.index_user(user_id, record)
+
+    def __delitem__(self, user_id):
+        with self.lock:
+            if user_id not in self.index:
+                raise KeyError(user_id)
+            del self.index[user_id]
+            self.records.pop(user_id, None)
+            self._append_index({'id': user_id, 'deleted': True})
+
+    def __contains__(self, user_id):
+        return user_id in self.index
+
+    def __iter__(self):
+        return iter(list(self.index))
+
+    def __len__(self):
+        return len(self.index)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "indexed": len(self.index),
+                "loaded": len(self.records),
+                "cache_size": self.cache_size,
+                "loads": self.loads,
+                "evictions": self.evictions
+            }